@@ -0,0 +1,379 @@
+import collections
+import logging
+import random
+import threading
+import time
+
+from google.appengine.api import memcache
+
+
+# seconds an instance trusts its copy of a namespace version
+VERSION_CHECK_INTERVAL = 2
+VERSION_KEY = '__version__'
+LOCAL_CACHE_SIZE = 1000
+LOCAL_CACHE_TTL = 60
+# seconds a deleted key refuses the values of loaders, so a value loaded
+# before the delete isn't stored back after it
+DELETE_LOCK_SECONDS = 10
+# largest fraction of its ttl a computed value may expire early by, so the
+# values computed together don't expire together
+EXPIRY_JITTER = 0.1
+# seconds the request computing a value holds its lease
+LEASE_SECONDS = 10
+LEASE_PREFIX = '__lease__:'
+# seconds the requests losing the lease of a missing value wait for it
+# before computing it themselves, polling memcache
+LEASE_WAIT = 2
+LEASE_POLL_INTERVAL = 0.05
+
+
+class LRUCache(object):
+    """Bounded in-process cache with per entry expiration, evicting the
+    least recently used entry when full. Safe to share between threads.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value of key, or None if missing or expired."""
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.time():
+                return None
+            # re-insert to mark it as the most recently used
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, ttl):
+        """Store value for ttl seconds."""
+        with self._lock:
+            self._data.pop(key, None)
+            if len(self._data) >= self.size:
+                self._data.popitem(last=False)
+            self._data[key] = (value, time.time() + ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class TwoTierCache(object):
+    """Read-mostly values cached in the instance memory over memcache.
+
+    Values are stored in memcache under their own key in the namespace of
+    the cache, and copied to a bounded in-process LRU. Every write bumps the
+    version stamp of the namespace; instances check the stamp at most every
+    VERSION_CHECK_INTERVAL seconds and drop their copies when it changed.
+    """
+
+    def __init__(self, namespace, size=LOCAL_CACHE_SIZE,
+                 local_ttl=LOCAL_CACHE_TTL, ttl=0):
+        self.namespace = namespace
+        self.local_ttl = local_ttl
+        self.ttl = ttl
+        self._local = LRUCache(size)
+        self._version = None
+        self._checked = 0
+
+    def _checkVersion(self):
+        now = time.time()
+        if now - self._checked < VERSION_CHECK_INTERVAL:
+            return
+        version = memcache.get(VERSION_KEY, namespace=self.namespace)
+        if version is None:
+            # evicted or never written; any copy may be stale
+            memcache.add(VERSION_KEY, 0, namespace=self.namespace)
+            version = 0
+        if version != self._version:
+            self._local.clear()
+            self._version = version
+        self._checked = now
+
+    def _bumpVersion(self):
+        memcache.incr(VERSION_KEY, namespace=self.namespace, initial_value=0)
+        # see our own write on the next get
+        self._checked = 0
+
+    def get(self, key, loader=None):
+        """Return the value of key. On a miss of both tiers the value is
+        computed with loader(), if given, and stored. None is never cached.
+        """
+        self._checkVersion()
+        value = self._local.get(key)
+        if value is not None:
+            return value
+        value = memcache.get(key, namespace=self.namespace)
+        if value is None and loader:
+            value = loader()
+            # added, not set: a concurrent write or delete wins
+            if value is not None:
+                memcache.add(key, value, time=self.ttl,
+                             namespace=self.namespace)
+        if value is not None:
+            self._local.set(key, value, self.local_ttl)
+        return value
+
+    def get_multi(self, keys, loader=None):
+        """Return a dict with the cached values of keys, asking memcache
+        for the ones missing on the instance with a single get_multi. The
+        values missing on both tiers are computed with loader(keys), if
+        given, returning a dict of them; None is never cached.
+        """
+        self._checkVersion()
+        values = {}
+        missing = []
+        for key in keys:
+            value = self._local.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                values[key] = value
+        if missing:
+            found = memcache.get_multi(missing, namespace=self.namespace)
+            unknown = [key for key in missing if key not in found]
+            if unknown and loader:
+                loaded = dict(
+                    (key, value) for key, value in loader(unknown).items()
+                    if value is not None)
+                if loaded:
+                    memcache.add_multi(loaded, time=self.ttl,
+                                       namespace=self.namespace)
+                found.update(loaded)
+            for key, value in found.items():
+                self._local.set(key, value, self.local_ttl)
+            values.update(found)
+        return values
+
+    def set_multi(self, mapping):
+        """Store several values and invalidate the copies of instances."""
+        memcache.set_multi(mapping, time=self.ttl, namespace=self.namespace)
+        for key in mapping:
+            self._local.delete(key)
+        self._bumpVersion()
+
+    def set(self, key, value):
+        """Store the value of key and invalidate the copies of instances."""
+        memcache.set(key, value, time=self.ttl, namespace=self.namespace)
+        self._local.delete(key)
+        self._bumpVersion()
+
+    def delete(self, key):
+        """Remove key and invalidate the copies of instances. The loaders
+        can't store it again for DELETE_LOCK_SECONDS."""
+        memcache.delete(key, seconds=DELETE_LOCK_SECONDS,
+                        namespace=self.namespace)
+        self._local.delete(key)
+        self._bumpVersion()
+
+    def delete_multi(self, keys):
+        """Remove several keys as delete() does, with a single bump."""
+        memcache.delete_multi(keys, seconds=DELETE_LOCK_SECONDS,
+                              namespace=self.namespace)
+        for key in keys:
+            self._local.delete(key)
+        self._bumpVersion()
+
+
+class ComputedCache(TwoTierCache):
+    """TwoTierCache of values computed by a loader, protected against
+    stampedes.
+
+    A value is fresh for ttl seconds, less a random jitter of up to
+    EXPIRY_JITTER, and then served stale for stale more seconds while one
+    request computes it again. Computations are single-flight: only the
+    request adding the memcache lease of the key runs the loader. On a miss
+    the others wait for its value, up to LEASE_WAIT seconds; on a stale hit
+    they serve the stale value, which also survives a failing loader.
+    """
+
+    def __init__(self, namespace, ttl, stale=0, size=LOCAL_CACHE_SIZE,
+                 local_ttl=LOCAL_CACHE_TTL):
+        super(ComputedCache, self).__init__(
+            namespace, size=size, local_ttl=local_ttl, ttl=ttl + stale)
+        self.fresh_ttl = ttl
+
+    def _entry(self, value):
+        jitter = 1 - random.random() * EXPIRY_JITTER
+        return value, time.time() + self.fresh_ttl * jitter
+
+    def _isStale(self, entry):
+        return entry[1] < time.time()
+
+    def _readEntry(self, key):
+        entry = memcache.get(key, namespace=self.namespace)
+        # a plain value written before the cache computed it is a miss
+        return entry if isinstance(entry, tuple) else None
+
+    def _readEntries(self, keys):
+        entries = memcache.get_multi(keys, namespace=self.namespace)
+        return dict((key, entry) for key, entry in entries.items()
+                    if isinstance(entry, tuple))
+
+    def _leaseMulti(self, keys):
+        """Add the memcache leases of keys, returning the keys won."""
+        lost = memcache.add_multi(
+            dict((LEASE_PREFIX + key, 1) for key in keys),
+            time=LEASE_SECONDS, namespace=self.namespace)
+        lost = set(lost)
+        return [key for key in keys if LEASE_PREFIX + key not in lost]
+
+    def _lease(self, key):
+        return memcache.add(LEASE_PREFIX + key, 1, time=LEASE_SECONDS,
+                            namespace=self.namespace)
+
+    def _store(self, key, entry):
+        memcache.set(key, entry, time=self.ttl, namespace=self.namespace)
+        self._local.set(key, entry, self.local_ttl)
+
+    def _computeMulti(self, keys, loader, leased=True):
+        """Run loader(keys) once for all of keys, holding their leases if
+        leased, and store the values it returns."""
+        try:
+            values = dict((key, value) for key, value in loader(keys).items()
+                          if value is not None)
+            entries = dict((key, self._entry(value))
+                           for key, value in values.items())
+            if entries:
+                memcache.set_multi(entries, time=self.ttl,
+                                   namespace=self.namespace)
+                for key, entry in entries.items():
+                    self._local.set(key, entry, self.local_ttl)
+            return values
+        finally:
+            if leased:
+                memcache.delete_multi([LEASE_PREFIX + key for key in keys],
+                                      namespace=self.namespace)
+
+    def _compute(self, key, loader, leased=True):
+        """Run the loader, holding the lease of key if leased, and store its
+        value. A request that lost the lease leaves it to its holder."""
+        try:
+            value = loader()
+            if value is not None:
+                self._store(key, self._entry(value))
+            return value
+        finally:
+            if leased:
+                memcache.delete(LEASE_PREFIX + key, namespace=self.namespace)
+
+    def _awaitMulti(self, keys):
+        """Return a dict of the entries of keys other requests stored, once
+        all of them are or after LEASE_WAIT seconds."""
+        entries = {}
+        deadline = time.time() + LEASE_WAIT
+        while len(entries) < len(keys) and time.time() < deadline:
+            time.sleep(LEASE_POLL_INTERVAL)
+            entries.update(self._readEntries(
+                [key for key in keys if key not in entries]))
+        for key, entry in entries.items():
+            self._local.set(key, entry, self.local_ttl)
+        return entries
+
+    def _await(self, key):
+        """Return the entry of key once another request stored it, or None
+        after LEASE_WAIT seconds."""
+        deadline = time.time() + LEASE_WAIT
+        while time.time() < deadline:
+            time.sleep(LEASE_POLL_INTERVAL)
+            entry = self._readEntry(key)
+            if entry is not None:
+                self._local.set(key, entry, self.local_ttl)
+                return entry
+        return None
+
+    def _getEntry(self, key):
+        self._checkVersion()
+        entry = self._local.get(key)
+        # a stale copy may already be fresh in memcache
+        if entry is None or self._isStale(entry):
+            entry = self._readEntry(key) or entry
+            if entry is not None:
+                self._local.set(key, entry, self.local_ttl)
+        return entry
+
+    def get(self, key, loader=None):
+        """Return the value of key, fresh or stale. A missing or stale value
+        is computed with loader(), if given, by a single request at a time.
+        None is never cached.
+        """
+        entry = self._getEntry(key)
+        if entry is not None:
+            if loader and self._isStale(entry) and self._lease(key):
+                try:
+                    return self._compute(key, loader)
+                except Exception:
+                    logging.exception('Refresh of %s:%s failed, serving '
+                                      'the stale value', self.namespace, key)
+            return entry[0]
+        if not loader:
+            return None
+        if not self._lease(key):
+            entry = self._await(key)
+            if entry is not None:
+                return entry[0]
+            return self._compute(key, loader, leased=False)
+        return self._compute(key, loader)
+
+    def get_multi(self, keys, loader=None):
+        """Return a dict with the values of keys, fresh or stale, read with
+        a single memcache get_multi. Missing and stale values are computed
+        as by get(), with one loader(keys) call returning a dict of the
+        values of the keys whose leases were won; the missing values of the
+        other keys are awaited together, then computed with one more call.
+        """
+        self._checkVersion()
+        entries = {}
+        for key in keys:
+            entry = self._local.get(key)
+            if entry is not None:
+                entries[key] = entry
+        # a stale copy may already be fresh in memcache
+        outdated = [key for key in keys
+                    if key not in entries or self._isStale(entries[key])]
+        if outdated:
+            found = self._readEntries(outdated)
+            for key, entry in found.items():
+                self._local.set(key, entry, self.local_ttl)
+            entries.update(found)
+
+        outdated = [key for key in keys
+                    if key not in entries or self._isStale(entries[key])]
+        if loader and outdated:
+            won = self._leaseMulti(outdated)
+            values = {}
+            if won:
+                try:
+                    values = self._computeMulti(won, loader)
+                except Exception:
+                    if any(key not in entries for key in won):
+                        raise
+                    logging.exception('Refresh of %s keys failed, serving '
+                                      'the stale values', self.namespace)
+            missing = [key for key in outdated
+                       if key not in entries and key not in won]
+            if missing:
+                entries.update(self._awaitMulti(missing))
+                missing = [key for key in missing if key not in entries]
+            if missing:
+                values.update(self._computeMulti(missing, loader,
+                                                 leased=False))
+            entries.update((key, (value, None))
+                           for key, value in values.items())
+        return dict((key, entries[key][0]) for key in keys if key in entries)
+
+    def set_multi(self, mapping):
+        super(ComputedCache, self).set_multi(dict(
+            (key, self._entry(value)) for key, value in mapping.items()))
+
+    def set(self, key, value):
+        super(ComputedCache, self).set(key, self._entry(value))
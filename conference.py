@@ -12,14 +12,13 @@ created by wesc on 2014 apr 21
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
 from protorpc import remote
 
-from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from models import Profile
@@ -37,6 +36,14 @@ from models import SessionForms
 from models import SessionQueryForm
 from models import SessionQueryForms
 from models import Speaker
+from models import SessionRecommendationForms
+from models import AttendeeForms
+from models import ConferenceStatsForm
+from models import FeaturedSpeakerForms
+from models import RegistrationTicketForm
+from models import AutocompleteForm
+from models import SyncForm
+from models import ConferenceFacetsForm
 
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
@@ -45,12 +52,18 @@ from settings import ANDROID_AUDIENCE
 
 from utils import getUserId
 
+import profiler
+import ratelimit
+
+# the modules of the endpoints used less often are imported by their
+# methods, so the instance startup only pays for the ones used
 import process.conferences
 import process.sessions
 import process.profiles
+import process.stats
 
-from process.speakers import MEMCACHE_FEATURED_SPEAKER_KEY
-from process.announcements import MEMCACHE_ANNOUNCEMENTS_KEY
+import process.speakers
+import process.announcements
 
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
@@ -63,11 +76,29 @@ CONF_GET_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_CONDITIONAL_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2)
+)
+
+CONDITIONAL_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ifNoneMatch=messages.StringField(1)
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_ROSTER_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageToken=messages.StringField(2),
+    limit=messages.IntegerField(3)
+)
+
 SESSION_POST_REQUEST = endpoints.ResourceContainer(
     SessionForm,
     websafeConferenceKey=messages.StringField(1)
@@ -91,7 +122,8 @@ SESSION_GET_REQUEST = endpoints.ResourceContainer(
 
 SESSION_DATE_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
-    date=messages.StringField(1)
+    date=messages.StringField(1),
+    end_date=messages.StringField(2)
 )
 
 SESSION_DURATION_REQUEST = endpoints.ResourceContainer(
@@ -104,7 +136,53 @@ SESSION_FILTER_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     not_type=messages.StringField(1, repeated=True),
     start_hour=messages.IntegerField(2),
-    end_hour=messages.IntegerField(3)
+    end_hour=messages.IntegerField(3),
+    date=messages.StringField(4)
+)
+
+TICKET_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeTicketKey=messages.StringField(1)
+)
+
+CONF_BATCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKeys=messages.StringField(1, repeated=True)
+)
+
+SESSION_BATCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeSessionKeys=messages.StringField(1, repeated=True)
+)
+
+FEATURED_SPEAKER_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1)
+)
+
+FEATURED_SPEAKERS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKeys=messages.StringField(1, repeated=True)
+)
+
+SYNC_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    syncToken=messages.StringField(1),
+    websafeConferenceKeys=messages.StringField(2, repeated=True)
+)
+
+AUTOCOMPLETE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    field=messages.StringField(1),
+    prefix=messages.StringField(2),
+    limit=messages.IntegerField(3)
+)
+
+FACETS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    city=messages.StringField(1),
+    topic=messages.StringField(2),
+    month=messages.IntegerField(3)
 )
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -132,23 +210,35 @@ class ConferenceApi(remote.Service):
         """Update conference w/provided fields & return w/updated info."""
         return process.conferences.updateConferenceObject(request)
 
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    @endpoints.method(CONF_CONDITIONAL_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
     def getConference(self, request):
-        """Return requested conference (by websafeConferenceKey)."""
+        """Return requested conference (by websafeConferenceKey).
+        Only the ETag is returned if it matches ifNoneMatch."""
         # get Conference object from request; bail if not found
         conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
         if not conf:
             raise endpoints.NotFoundException((
                 'No conference found with key: %s'
             )% request.websafeConferenceKey)
+        etag = process.conferences.getEtag(conf)
+        if request.ifNoneMatch == etag:
+            return ConferenceForm(etag=etag, notModified=True)
         prof = conf.key.parent().get()
         # return ConferenceForm
         return process.conferences.copyConferenceToForm(
             conf, getattr(prof, 'displayName')
         )
 
+    @endpoints.method(CONF_BATCH_REQUEST, ConferenceForms,
+            path='conferences/get',
+            http_method='GET', name='getConferencesByKeys')
+    def getConferencesByKeys(self, request):
+        """Return the conferences of several websafe keys, in order."""
+        return process.conferences.getConferencesByKeys(
+            request.websafeConferenceKeys)
+
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
@@ -201,34 +291,58 @@ class ConferenceApi(remote.Service):
             ]
         )
 
+    @endpoints.method(CONF_GET_REQUEST, ConferenceStatsForm,
+            path='conference/{websafeConferenceKey}/stats',
+            http_method='GET', name='getConferenceStats')
+    def getConferenceStats(self, request):
+        """Return sessions, registrations and wishlist stats of conference."""
+        return process.stats.getStats(request)
+
 # - - - Session objects - - - - - - - - - - - - - - - - - - -
 
     @endpoints.method(SESSION_POST_REQUEST, SessionForm,
                       path='conference/{websafeConferenceKey}/createSession',
                       http_method='POST', name='createSession')
+    @ratelimit.limited
     def createSession(self, request):
         """Create a new session in selected conference."""
         return process.sessions.createSessionObject(request)
 
-    @endpoints.method(CONF_GET_REQUEST, SessionForms,
+    @endpoints.method(CONF_CONDITIONAL_REQUEST, SessionForms,
                       path='conference/{websafeConferenceKey}/sessions',
                       http_method='GET', name='getConferenceSessions')
     def getConferenceSessions(self, request):
-        """List all the sessions on the selected conference."""
+        """List all the sessions on the selected conference.
+        The sessions are not queried if the ETag matches ifNoneMatch."""
         c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
-        if not c_key.get():
+        # the version must be current, don't use the cached conference
+        conf = c_key.get()
+        if not isinstance(conf, Conference):
             raise endpoints.NotFoundException(
                 (
                     'No conference found with key: %s'
                 ) % request.websafeConferenceKey
             )
-        sessions = Session.query(ancestor=c_key)
-        sessions = sessions.order(Session.startTime)
-        return SessionForms(
-            items=[
-                process.sessions.copySessionToForm(sess) for sess in sessions
-            ]
-        )
+        etag = process.sessions.getScheduleEtag(conf)
+        if request.ifNoneMatch == etag:
+            return SessionForms(etag=etag, notModified=True)
+        forms = process.sessions.getSchedule(conf)
+        forms.etag = etag
+        return forms
+
+    @endpoints.method(SESSION_GET_REQUEST, BooleanMessage,
+                      path='session/{websafeSessionKey}',
+                      http_method='DELETE', name='deleteSession')
+    def deleteSession(self, request):
+        """Delete a session of a conference created by the user."""
+        return process.sessions.deleteSessionObject(request)
+
+    @endpoints.method(SESSION_BATCH_REQUEST, SessionForms,
+                      path='conference/sessions/get',
+                      http_method='GET', name='getSessionsByKeys')
+    def getSessionsByKeys(self, request):
+        """Return the sessions of several websafe keys, in order."""
+        return process.sessions.getSessionsByKeys(request.websafeSessionKeys)
 
     @endpoints.method(
         SESSION_QUERY_REQUEST, SessionForms,
@@ -238,15 +352,17 @@ class ConferenceApi(remote.Service):
     def getConferenceSessionsByType(self, request):
         """List all the sessions of the selected Type."""
         c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
-        if not c_key.get():
+        if not process.sessions.getConference(c_key):
             raise endpoints.NotFoundException(
                 (
                     'No conference found with key: %s'
                 ) % request.websafeConferenceKey
             )
-        sessions = Session.query(ancestor=c_key)
+        sessions = process.sessions.querySessions(c_key)
         sessions = sessions.filter(
-            Session.typeOfSession == request.typeOfSession
+            Session.typeOfSession == (
+                process.sessions.normalizeSessionType(request.typeOfSession)
+                or request.typeOfSession)
         )
         sessions = sessions.order(Session.startTime)
         return SessionForms(
@@ -266,7 +382,7 @@ class ConferenceApi(remote.Service):
                 'Speaker %s is not registered' % request.speaker
             )
 
-        sessions = Session.query(Session.speakerId == speaker.key.urlsafe())
+        sessions = process.sessions.querySpeakerSessions(speaker.key)
         sessions = sessions.order(Session.startTime)
         return SessionForms(
             items=[
@@ -278,14 +394,18 @@ class ConferenceApi(remote.Service):
                       path='conference/sessions/date',
                       http_method='GET', name='getSessionsByDate')
     def getSessionsByDate(self, request):
-        """List of sessions on the selected date."""
+        """List of sessions on the selected date, or starting between
+        date and end_date included."""
+        start = datetime.strptime(request.date[:10], "%Y-%m-%d")
+        end = start
+        if request.end_date:
+            end = datetime.strptime(request.end_date[:10], "%Y-%m-%d")
         sessions = Session.query()
+        sessions = sessions.filter(Session.startDateTime >= start)
         sessions = sessions.filter(
-            Session.date == datetime.strptime(
-                request.date[:10], "%Y-%m-%d"
-            ).date()
+            Session.startDateTime < end + timedelta(days=1)
         )
-        sessions.order(Session.startTime)
+        sessions = sessions.order(Session.startDateTime)
         return SessionForms(
             items=[
                 process.sessions.copySessionToForm(sess) for sess in sessions
@@ -305,7 +425,7 @@ class ConferenceApi(remote.Service):
             Session.duration <= request.max_duration
         )
         sessions = sessions.order(Session.duration)
-        sessions = sessions.order(Session.startTime)
+        sessions = sessions.order(Session.startDateTime)
         return SessionForms(
             items=[
                 process.sessions.copySessionToForm(sess) for sess in sessions
@@ -316,17 +436,35 @@ class ConferenceApi(remote.Service):
                       path='conference/sessions/filter',
                       http_method='GET', name='filterSessions')
     def queryProblem(self, request):
-        """Filter sessions by time of the day and type of session."""
-        sessions = Session.query()
-        sessions = sessions.filter(Session.startTime >= request.start_hour)
-        sessions = sessions.filter(Session.startTime <= request.end_hour)
-        sessions = sessions.order(Session.startTime)
-        items = []
-        for sess in sessions:
-            if sess.typeOfSession not in request.not_type:
-                items.append(process.sessions.copySessionToForm(sess))
+        """Filter sessions by time of the day and type of session. With
+        a date, only the sessions of that day are filtered."""
+        # the excluded types become an IN filter on the remaining ones of
+        # settings.SESSION_TYPES, so the only inequality is on the start
+        types = process.sessions.getSessionTypes(request.not_type)
+        if not types:
+            return SessionForms(items=[])
+        sessions = Session.query(Session.typeOfSession.IN(types))
+        if request.date:
+            day = datetime.strptime(request.date[:10], "%Y-%m-%d").date()
+            try:
+                start = datetime.combine(day, process.sessions.parseStartTime(
+                    request.start_hour))
+                end = datetime.combine(day, process.sessions.parseStartTime(
+                    request.end_hour))
+            except ValueError:
+                raise endpoints.BadRequestException('Invalid hours')
+            sessions = sessions.filter(Session.startDateTime >= start)
+            sessions = sessions.filter(Session.startDateTime <= end)
+            sessions = sessions.order(Session.startDateTime)
+        else:
+            sessions = sessions.filter(
+                Session.startTime >= request.start_hour)
+            sessions = sessions.filter(Session.startTime <= request.end_hour)
+            sessions = sessions.order(Session.startTime)
         return SessionForms(
-            items=items
+            items=[
+                process.sessions.copySessionToForm(sess) for sess in sessions
+            ]
         )
 
     @endpoints.method(SessionQueryForms, SessionForms,
@@ -343,20 +481,61 @@ class ConferenceApi(remote.Service):
 
 # - - - Featured Speaker - - - - - - - - - - - - - - - - - - -
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @endpoints.method(FEATURED_SPEAKER_REQUEST, StringMessage,
             path='conference/featured_speaker/get',
             http_method='GET', name='getFeaturedSpeaker')
     def getFeaturedSpeaker(self, request):
-        """Return Featured Speaker from memcache."""
-        return StringMessage(
-            data=memcache.get(MEMCACHE_FEATURED_SPEAKER_KEY) or ""
+        """Return Featured Speaker of selected conference (or the latest
+        of any conference) from the cache."""
+        return StringMessage(data=process.speakers.getFeaturedSpeaker(
+            request.websafeConferenceKey
+        ))
+
+    @endpoints.method(FEATURED_SPEAKERS_REQUEST, FeaturedSpeakerForms,
+            path='conference/featured_speakers/get',
+            http_method='GET', name='getFeaturedSpeakers')
+    def getFeaturedSpeakers(self, request):
+        """Return Featured Speakers of selected conferences."""
+        return process.speakers.getFeaturedSpeakers(
+            request.websafeConferenceKeys
         )
 
+# - - - Sync - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @endpoints.method(SYNC_REQUEST, SyncForm,
+            path='sync',
+            http_method='GET', name='syncSchedule')
+    def syncSchedule(self, request):
+        """Return the conferences attended (or listed) and their sessions
+        created, changed or deleted since syncToken."""
+        import process.sync
+        return process.sync.syncSchedule(request)
+
+# - - - Autocomplete - - - - - - - - - - - - - - - - - - - -
+
+    @endpoints.method(AUTOCOMPLETE_REQUEST, AutocompleteForm,
+            path='autocomplete/{field}',
+            http_method='GET', name='autocomplete')
+    def autocomplete(self, request):
+        """Return the speaker names, cities or topics starting with prefix."""
+        import process.autocomplete
+        return process.autocomplete.autocomplete(request)
+
+    @endpoints.method(FACETS_REQUEST, ConferenceFacetsForm,
+            path='conferences/facets',
+            http_method='GET', name='getConferenceFacets')
+    def getConferenceFacets(self, request):
+        """Return the number of conferences per city, topic and month,
+        among the ones of the optional city, topic and month."""
+        import process.facets
+        return process.facets.getFacets(request)
+
 # - - - Wishlist - - - - - - - - - - - - - - - - - - - - - - -
 
     @endpoints.method(SESSION_GET_REQUEST, BooleanMessage,
                       path='addSessionToWishlist/{websafeSessionKey}',
                       http_method='POST', name='addSessionToWishlist')
+    @ratelimit.limited
     def addSessionToWishlist(self, request):
         """Add a session to user Wishlist."""
         prof = process.profiles.getProfileFromUser()
@@ -371,22 +550,48 @@ class ConferenceApi(remote.Service):
                 'Element provided is not a Session'
             )
 
-        prof.sessionsWishlist.append(request.websafeSessionKey)
-        prof.put()
+        # adding a session twice neither duplicates it nor counts it again
+        if session.key not in prof.wishlistKeys:
+            prof.wishlistKeys.append(session.key)
+            prof.put()
+            process.stats.queueWishlistAddition(
+                session.key, process.sessions.conferenceKeyOf(session))
         return BooleanMessage(data=True)
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(CONDITIONAL_REQUEST, SessionForms,
                       path='wishlist', http_method='GET',
                       name='getSessionsWishlist')
     def getSessionsInWishlist(self, request):
-        """List sessions saved on user Wishlist."""
+        """List sessions saved on user Wishlist.
+        The sessions are not fetched if the ETag matches ifNoneMatch."""
         prof = process.profiles.getProfileFromUser()
-        sess_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.sessionsWishlist]
+        sess_keys = prof.wishlistKeys
+        # the wishlist changes if any of the conferences of its sessions does
+        conf_keys = list(set(
+            process.sessions.conferenceKeysOf(sess_keys).values()))
+        etag = process.conferences.getEtagMulti(
+            ndb.get_multi(conf_keys), [s_key.urlsafe() for s_key in sess_keys])
+        if request.ifNoneMatch == etag:
+            return SessionForms(etag=etag, notModified=True)
         sessions = ndb.get_multi(sess_keys)
         return SessionForms(
             items=[
-                process.sessions.copySessionToForm(sess) for sess in sessions
-            ]
+                # deleted sessions may stay on the wishlist
+                process.sessions.copySessionToForm(sess)
+                for sess in sessions if sess
+            ],
+            etag=etag
+        )
+
+    @endpoints.method(SESSION_GET_REQUEST, SessionRecommendationForms,
+                      path='session/{websafeSessionKey}/recommendations',
+                      http_method='GET', name='getSessionRecommendations')
+    def getSessionRecommendations(self, request):
+        """List sessions wishlisted by attendees of the selected session."""
+        # rarely used, imported on demand to keep the startup fast
+        import process.recommendations
+        return process.recommendations.getRecommendations(
+            request.websafeSessionKey
         )
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
@@ -409,10 +614,8 @@ class ConferenceApi(remote.Service):
             path='conference/announcement/get',
             http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
-        """Return Announcement from memcache."""
-        return StringMessage(
-            data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or ""
-        )
+        """Return Announcement from the cache."""
+        return StringMessage(data=process.announcements.getAnnouncement())
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
@@ -422,10 +625,7 @@ class ConferenceApi(remote.Service):
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = process.profiles.getProfileFromUser() # get user Profile
-        conf_keys = [
-            ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend
-        ]
-        conferences = ndb.get_multi(conf_keys)
+        conferences = ndb.get_multi(prof.conferencesToAttend)
 
         # get organizers
         organisers = [
@@ -448,6 +648,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
+    @ratelimit.limited
     def registerForConference(self, request):
         """Register user for selected conference."""
         return process.conferences.conferenceRegistration(request)
@@ -459,6 +660,48 @@ class ConferenceApi(remote.Service):
         """Unregister user for selected conference."""
         return process.conferences.conferenceRegistration(request, reg=False)
 
+    @endpoints.method(CONF_GET_REQUEST, RegistrationTicketForm,
+            path='conference/{websafeConferenceKey}/ticket',
+            http_method='POST', name='requestRegistration')
+    @ratelimit.limited
+    def requestRegistration(self, request):
+        """Request a seat on selected conference, queued when the
+        conference uses the admission queue. Returns a ticket."""
+        import process.admissions
+        return process.admissions.requestRegistration(request)
+
+    @endpoints.method(TICKET_GET_REQUEST, RegistrationTicketForm,
+            path='ticket/{websafeTicketKey}',
+            http_method='GET', name='getRegistrationTicket')
+    def getRegistrationTicket(self, request):
+        """Return the status of a registration ticket."""
+        import process.admissions
+        return process.admissions.getTicket(request)
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+            path='conference/{websafeConferenceKey}/waitlist',
+            http_method='POST', name='joinWaitlist')
+    def joinWaitlist(self, request):
+        """Wait for a seat on selected (sold out) conference."""
+        import process.waitlist
+        return process.waitlist.joinWaitlist(request)
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+            path='conference/{websafeConferenceKey}/waitlist',
+            http_method='DELETE', name='leaveWaitlist')
+    def leaveWaitlist(self, request):
+        """Leave the waitlist of selected conference."""
+        import process.waitlist
+        return process.waitlist.leaveWaitlist(request)
+
+    @endpoints.method(CONF_ROSTER_REQUEST, AttendeeForms,
+            path='conference/{websafeConferenceKey}/attendees',
+            http_method='GET', name='getConferenceAttendees')
+    def getConferenceAttendees(self, request):
+        """List the users registered for selected conference (paginated)."""
+        import process.registrations
+        return process.registrations.getRoster(request)
+
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='filterPlayground',
             http_method='GET', name='filterPlayground')
@@ -482,4 +725,5 @@ class ConferenceApi(remote.Service):
         )
 
 
-api = endpoints.api_server([ConferenceApi]) # register API
+api = profiler.ProfilingMiddleware(ratelimit.RateLimitMiddleware(
+    endpoints.api_server([ConferenceApi]))) # register API
@@ -12,22 +12,126 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+
 import webapp2
-from google.appengine.api import app_identity
-from google.appengine.api import mail
-import process.announcements
-import process.speakers
+
+# The process modules and APIs used by the handlers are imported when a
+# handler runs, so the instance startup only pays for the handlers used.
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """Prime the caches of a new instance."""
+        import process.warmup
+        process.warmup.warmup()
+        self.response.set_status(200)
+
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
         """Set Announcement in Memcache."""
+        import process.announcements
         process.announcements.cacheAnnouncement()
         self.response.set_status(204)
 
 
+class SetRecommendationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Precompute the session recommendations from the wishlists."""
+        import process.recommendations
+        process.recommendations.startRecommendations()
+        self.response.set_status(204)
+
+
+class FlushStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Apply the buffered stats and facet deltas."""
+        import process.facets
+        import process.stats
+        process.stats.flushDeltas()
+        process.facets.flushDeltas()
+        self.response.set_status(204)
+
+
+class RecountFacetsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start counting the conferences of every facet again."""
+        import process.facets
+        process.facets.startRecount()
+        self.response.set_status(204)
+
+    def post(self):
+        """Count the conferences of the next batch of a facet recount."""
+        import process.facets
+        process.facets.recountBatch(self.request)
+
+
+class PurgeTombstonesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Delete the tombstones older than the sync tokens."""
+        import process.sync
+        process.sync.purgeTombstones()
+        self.response.set_status(204)
+
+
+class PurgeProfilesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Delete the expired profiles of API requests."""
+        import profiler
+        profiler.purgeSamples()
+        self.response.set_status(204)
+
+
+class ProfilesAdminHandler(webapp2.RequestHandler):
+    def get(self):
+        """Without endpoint, list the profiled endpoints as JSON. With an
+        endpoint, download its merged profile: a pstats file, or a text
+        report with format=text (sorted by sort)."""
+        import profiler
+        endpoint = self.request.get('endpoint')
+        if not endpoint:
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.write(json.dumps({
+                'sampleRate': profiler.getSampleRate(),
+                'samples': profiler.countSamples(),
+            }, indent=2))
+            return
+        stats = profiler.mergeSamples(endpoint)
+        if not stats:
+            self.abort(404)
+        if self.request.get('format') == 'text':
+            try:
+                report = profiler.formatStats(
+                    stats, self.request.get('sort') or 'cumulative')
+            except KeyError:
+                self.abort(400, 'Unknown sort key')
+            self.response.headers['Content-Type'] = 'text/plain'
+            self.response.write(report)
+        else:
+            self.response.headers['Content-Type'] = 'application/octet-stream'
+            self.response.headers['Content-Disposition'] = (
+                'attachment; filename=%s.pstats' % endpoint)
+            self.response.write(profiler.dumpStats(stats))
+
+    def post(self):
+        """Set the fraction of the requests profiled (rate)."""
+        import profiler
+        try:
+            rate = float(self.request.get('rate'))
+        except ValueError:
+            self.abort(400, 'rate must be a number')
+        if not 0 <= rate <= 1:
+            self.abort(400, 'rate must be between 0 and 1')
+        profiler.setSampleRate(rate)
+        self.response.set_status(204)
+
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
         """Send email confirming Conference creation."""
+        from google.appengine.api import app_identity
+        from google.appengine.api import mail
         mail.send_mail(
             'noreply@%s.appspotmail.com' % (
                 app_identity.get_application_id()),     # from
@@ -41,10 +145,105 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
 class SetFeaturedSpeaker(webapp2.RequestHandler):
     def post(self):
         """Set Featured Speaker in memchache."""
+        import process.speakers
         process.speakers.cacheSpeaker(self.request)
 
+class UpdateAutocompleteHandler(webapp2.RequestHandler):
+    def post(self):
+        """Update the autocomplete index of a field."""
+        import process.autocomplete
+        process.autocomplete.updateIndex(self.request)
+
+
+class MapperHandler(webapp2.RequestHandler):
+    def post(self):
+        """Run the next batch of a mapper job."""
+        import mapper
+        import process.migrations
+        mapper.runBatch(
+            int(self.request.get('job')),
+            int(self.request.headers.get('X-AppEngine-TaskRetryCount', 0)))
+
+
+class MapperAdminHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report the progress of the mapper jobs as JSON."""
+        import mapper
+        import models
+        import process.migrations
+        jobs = models.MapperJob.query().order(-models.MapperJob.created)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'mappers': mapper.getMappers(),
+            'jobs': [self._jobToDict(job) for job in jobs.fetch(50)],
+        }, indent=2))
+
+    def post(self):
+        """Start, pause or resume a mapper job."""
+        import mapper
+        import process.migrations
+        action = self.request.get('action')
+        if action == 'start':
+            try:
+                job = mapper.startJob(
+                    self.request.get('mapper'),
+                    int(self.request.get('batch_size') or
+                        mapper.DEFAULT_BATCH_SIZE),
+                    float(self.request.get('delay') or mapper.DEFAULT_DELAY))
+            except ValueError as e:
+                self.abort(400, str(e))
+        elif action == 'pause':
+            job = mapper.pauseJob(int(self.request.get('job')))
+        elif action == 'resume':
+            job = mapper.resumeJob(int(self.request.get('job')))
+        else:
+            self.abort(400, 'Unknown action: %s' % action)
+        if not job:
+            self.abort(404)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(self._jobToDict(job), indent=2))
+
+    @staticmethod
+    def _jobToDict(job):
+        return {
+            'id': job.key.id(),
+            'mapper': job.mapper,
+            'status': job.status,
+            'processed': job.processed,
+            'written': job.written,
+            'batches': job.batches,
+            'error': job.error,
+            'created': str(job.created),
+            'updated': str(job.updated),
+        }
+
+class PromoteWaitlistHandler(webapp2.RequestHandler):
+    def post(self):
+        """Register waitlisted users on the free seats of a conference."""
+        import process.waitlist
+        process.waitlist.promoteWaitlist(self.request)
+
+class AdmitRegistrationsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Register the queued tickets of a conference."""
+        import process.admissions
+        process.admissions.admitRegistrations(self.request)
+
 app = webapp2.WSGIApplication([
+    ('/_ah/warmup', WarmupHandler),
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/set_recommendations', SetRecommendationsHandler),
+    ('/crons/flush_stats', FlushStatsHandler),
+    ('/crons/recount_facets', RecountFacetsHandler),
+    ('/crons/purge_tombstones', PurgeTombstonesHandler),
+    ('/crons/purge_profiles', PurgeProfilesHandler),
+    ('/admin/profiles', ProfilesAdminHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
-    ('/tasks/set_featured_speaker', SetFeaturedSpeaker)
+    ('/tasks/set_featured_speaker', SetFeaturedSpeaker),
+    ('/tasks/update_autocomplete', UpdateAutocompleteHandler),
+    ('/tasks/mapper', MapperHandler),
+    ('/tasks/recount_facets', RecountFacetsHandler),
+    ('/admin/mapper', MapperAdminHandler),
+    ('/tasks/promote_waitlist', PromoteWaitlistHandler),
+    ('/tasks/admit_registrations', AdmitRegistrationsHandler)
 ], debug=True)
@@ -0,0 +1,173 @@
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import MapperJob
+
+
+MAPPER_QUEUE = 'mapper'
+MAPPER_URL = '/tasks/mapper'
+DEFAULT_BATCH_SIZE = 100
+# seconds between two batches of a job
+DEFAULT_DELAY = 0
+# retries of a failing batch before the job is marked as failed
+MAX_RETRIES = 5
+
+RUNNING = 'RUNNING'
+PAUSED = 'PAUSED'
+DONE = 'DONE'
+FAILED = 'FAILED'
+
+# mapper name -> (kind, function)
+_mappers = {}
+
+
+def mapper(kind):
+    """Register a function as the mapper of a job walking every entity of
+    kind. The function gets an entity and returns the entities to write:
+    one, a list or None.
+
+    Mappers must be idempotent: a batch interrupted before its checkpoint
+    is mapped again when the job resumes.
+    """
+    def register(func):
+        _mappers[func.__name__] = (kind, func)
+        return func
+    return register
+
+
+def getMappers():
+    """Return the names of the registered mappers."""
+    return sorted(_mappers)
+
+
+def _scheduleBatch(job, countdown=0):
+    # named by batch, so a retried request can't fork the job
+    try:
+        taskqueue.add(
+            queue_name=MAPPER_QUEUE,
+            name='mapper-%d-%d-%d' % (job.key.id(), job.runs, job.batches),
+            params={'job': job.key.id()},
+            url=MAPPER_URL,
+            countdown=countdown
+        )
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def startJob(name, batch_size=DEFAULT_BATCH_SIZE, delay=DEFAULT_DELAY):
+    """Start a job running the mapper name. Returns the MapperJob."""
+    if name not in _mappers:
+        raise ValueError('Unknown mapper: %s' % name)
+    job = MapperJob(
+        mapper=name,
+        kind=_mappers[name][0],
+        batchSize=batch_size,
+        delay=delay,
+        status=RUNNING
+    )
+    job.put()
+    _scheduleBatch(job)
+    return job
+
+
+@ndb.transactional()
+def pauseJob(job_id):
+    """Stop a running job after its current batch."""
+    job = MapperJob.get_by_id(job_id)
+    if job and job.status == RUNNING:
+        job.status = PAUSED
+        job.put()
+    return job
+
+
+def resumeJob(job_id):
+    """Continue a paused or failed job from its last checkpoint."""
+    job, resumed = _resume(job_id)
+    if resumed:
+        _scheduleBatch(job)
+    return job
+
+
+@ndb.transactional()
+def _resume(job_id):
+    job = MapperJob.get_by_id(job_id)
+    if not job or job.status not in (PAUSED, FAILED):
+        return job, False
+    job.status = RUNNING
+    job.runs += 1
+    job.error = None
+    job.put()
+    return job, True
+
+
+def runBatch(job_id, retries=0):
+    """Map the next batch of a job and checkpoint its cursor, then chain
+    the task of the next batch. Used on the mapper task queue.
+    """
+    job = MapperJob.get_by_id(job_id)
+    if not job or job.status != RUNNING:
+        return
+    kind, func = _mappers[job.mapper]
+
+    try:
+        query = ndb.Query(kind=kind)
+        entities, cursor, more = query.fetch_page(
+            job.batchSize, start_cursor=Cursor(urlsafe=job.cursor))
+        to_put = []
+        for entity in entities:
+            result = func(entity)
+            if isinstance(result, list):
+                to_put.extend(result)
+            elif result is not None:
+                to_put.append(result)
+        ndb.put_multi(to_put)
+    except Exception as e:
+        logging.exception('Mapper %s failed', job.mapper)
+        if _recordError(job.key, job.batches,
+                        '%s: %s' % (type(e).__name__, e),
+                        retries >= MAX_RETRIES):
+            return
+        # let the task queue retry the batch
+        raise
+
+    job = _checkpoint(job.key, job.batches, cursor, len(entities),
+                      len(to_put), more)
+    if job and job.status == RUNNING:
+        _scheduleBatch(job, job.delay)
+
+
+@ndb.transactional()
+def _recordError(job_key, batches, error, last_retry):
+    """Save the error of a batch on the job, failing it after the last
+    retry. Keeps the status set by pauseJob() while the batch ran, and
+    leaves a batch saved meanwhile alone. Returns whether the batch should
+    not be retried."""
+    job = job_key.get()
+    if not job or job.batches != batches:
+        return True
+    job.error = error
+    if job.status == RUNNING and last_retry:
+        job.status = FAILED
+    job.put()
+    return job.status != RUNNING
+
+
+@ndb.transactional()
+def _checkpoint(job_key, batches, cursor, processed, written, more):
+    """Save the progress of a batch, unless it was already saved. Keeps
+    the status set by pauseJob() while the batch ran."""
+    job = job_key.get()
+    if job.batches != batches:
+        return None
+    job.cursor = cursor.urlsafe() if cursor else None
+    job.processed += processed
+    job.written += written
+    job.batches += 1
+    job.error = None
+    if not more:
+        job.status = DONE
+    job.put()
+    return job
@@ -21,11 +21,25 @@ class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
     http_status = httplib.CONFLICT
 
+class TooManyRequestsException(endpoints.ServiceException):
+    """TooManyRequestsException -- exception of a rate limited request,
+    answered with HTTP 429 by ratelimit.RateLimitMiddleware"""
+    http_status = 429
+
 class Profile(ndb.Model):
     """Profile -- User profile object"""
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
+    conferencesToAttend = ndb.KeyProperty(
+        kind='Conference', repeated=True, indexed=False)
+    # the wishlist, stored as sessionWishlist; indexed for the
+    # co-occurrences of process.recommendations
+    wishlistKeys = ndb.KeyProperty(
+        'sessionWishlist', kind='Session', repeated=True)
+    # websafe keys of the profiles saved before the KeyProperty lists, only
+    # read by process.profiles.upgradeProfile(). Remove them, and
+    # upgradeProfile(), once the migrateProfileKeys mapper has run.
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
     sessionsWishlist = ndb.StringProperty(repeated=True)
 
@@ -50,6 +64,28 @@ class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
     data = messages.BooleanField(1)
 
+def normalizeTerm(term):
+    """Return the lower case term with its whitespace collapsed."""
+    return u' '.join(term.lower().split())
+
+
+def autocompleteTermKey(field, term):
+    """Return the key of the AutocompleteTerm of field and term."""
+    return ndb.Key('AutocompleteTerm',
+                   u'%s:%s' % (field, normalizeTerm(term)))
+
+
+def _autocompleteTerms(conf):
+    # the ids of the AutocompleteTerms of the city and topics, the CITY and
+    # TOPIC fields of process.autocomplete, to find the conferences using a
+    # term whatever its case and spacing
+    terms = [('topic', topic) for topic in conf.topics or []]
+    if conf.city:
+        terms.append(('city', conf.city))
+    return sorted(set(
+        autocompleteTermKey(field, term).id() for field, term in terms
+        if normalizeTerm(term)))
+
 class Conference(ndb.Model):
     """Conference -- Conference object"""
     name            = ndb.StringProperty(required=True)
@@ -62,6 +98,17 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    # bumped by every write to the conference
+    version         = ndb.IntegerProperty(default=0, indexed=False)
+    # bumped by every write to its sessions, apart from version so the
+    # registrations leave the schedule ETag alone
+    sessionsVersion = ndb.IntegerProperty(default=0, indexed=False)
+    # registrations go through the admission queue
+    admissionQueue  = ndb.BooleanProperty(default=False, indexed=False)
+    modified        = ndb.DateTimeProperty(auto_now=True)
+    # the autocomplete terms of the city and topics, normalized
+    autocompleteTerms = ndb.ComputedProperty(_autocompleteTerms,
+                                             repeated=True)
 
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -77,6 +124,10 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10) #DateTimeField()
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    etag            = messages.StringField(13)
+    notModified     = messages.BooleanField(14)
+    admissionQueue  = messages.BooleanField(15)
+    notFound        = messages.BooleanField(16)
 
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
@@ -115,11 +166,20 @@ class Session(ndb.Model):
     """Session -- Session object"""
     name = ndb.StringProperty(required=True)
     highlights = ndb.StringProperty()
+    speakerKey = ndb.KeyProperty(kind='Speaker')
+    # websafe speaker key of the sessions saved before speakerKey, only read
+    # by process.sessions.speakerKeyOf()
     speakerId = ndb.StringProperty()
     duration = ndb.IntegerProperty()
     typeOfSession = ndb.StringProperty()
     date = ndb.DateProperty()
     startTime = ndb.IntegerProperty()
+    startDateTime = ndb.DateTimeProperty()
+    endDateTime = ndb.DateTimeProperty()
+    modified = ndb.DateTimeProperty(auto_now=True)
+    # the conference of the session, also its parent unless the session
+    # is a root entity (settings.ROOT_SESSIONS)
+    conferenceKey = ndb.KeyProperty(kind='Conference')
 
 
 class SessionForm(messages.Message):
@@ -133,11 +193,16 @@ class SessionForm(messages.Message):
     date = messages.StringField(7)
     startTime = messages.IntegerField(8)
     websafeKey = messages.StringField(9)
+    startDateTime = messages.StringField(10)
+    endDateTime = messages.StringField(11)
+    notFound = messages.BooleanField(12)
 
 
 class SessionForms(messages.Message):
     """SessionForms -- Multiple outbound Session form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
 
 
 class SessionQueryForm(messages.Message):
@@ -160,3 +225,204 @@ class Speaker(ndb.Model):
 class SpeakerForm(messages.Message):
     """SpeakerForm -- Speaker outbound form message"""
     name = messages.StringField(1)
+
+
+class SessionRecommendation(ndb.Model):
+    """SessionRecommendation -- precomputed "also wishlisted" sessions,
+    keyed by the websafe key of the session they belong to"""
+    sessionKeys = ndb.StringProperty(repeated=True, indexed=False)
+    sessionNames = ndb.StringProperty(repeated=True, indexed=False)
+    scores = ndb.IntegerProperty(repeated=True, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class SessionRecommendationForm(messages.Message):
+    """SessionRecommendationForm -- recommended Session outbound message"""
+    websafeKey = messages.StringField(1)
+    name = messages.StringField(2)
+    score = messages.IntegerField(3)
+
+
+class SessionRecommendationForms(messages.Message):
+    """SessionRecommendationForms -- multiple recommended Session message"""
+    items = messages.MessageField(SessionRecommendationForm, 1, repeated=True)
+
+
+class Registration(ndb.Model):
+    """Registration -- reverse index of a Profile attending a Conference,
+    child of the Conference and keyed by the user id"""
+    displayName = ndb.StringProperty(indexed=False)
+    mainEmail = ndb.StringProperty(indexed=False)
+    registered = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class AttendeeForm(messages.Message):
+    """AttendeeForm -- Conference attendee outbound form message"""
+    userId = messages.StringField(1)
+    displayName = messages.StringField(2)
+    mainEmail = messages.StringField(3)
+
+
+class AttendeeForms(messages.Message):
+    """AttendeeForms -- paginated Conference roster outbound message"""
+    items = messages.MessageField(AttendeeForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    total = messages.IntegerField(3)
+
+
+class WaitlistEntry(ndb.Model):
+    """WaitlistEntry -- user waiting for a seat on a Conference, child of the
+    Profile and keyed by the websafe key of the Conference"""
+    conferenceKey = ndb.KeyProperty(kind='Conference')
+    joined = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class ConferenceStats(ndb.Model):
+    """ConferenceStats -- aggregate statistics of a Conference, its only
+    child with id 1, maintained on every write that changes them"""
+    registrations = ndb.IntegerProperty(default=0, indexed=False)
+    sessions = ndb.IntegerProperty(default=0, indexed=False)
+    sessionsByType = ndb.JsonProperty()
+    sessionsBySpeaker = ndb.JsonProperty()
+    wishlistBySession = ndb.JsonProperty()
+
+
+class CountForm(messages.Message):
+    """CountForm -- outbound count of a named item"""
+    name = messages.StringField(1)
+    count = messages.IntegerField(2)
+    # the item, when the name doesn't identify it (speakers)
+    websafeKey = messages.StringField(3)
+
+
+class ConferenceStatsForm(messages.Message):
+    """ConferenceStatsForm -- Conference statistics outbound form message"""
+    registrations = messages.IntegerField(1)
+    maxAttendees = messages.IntegerField(2)
+    fillRate = messages.FloatField(3)
+    sessions = messages.IntegerField(4)
+    sessionsByType = messages.MessageField(CountForm, 5, repeated=True)
+    sessionsBySpeaker = messages.MessageField(CountForm, 6, repeated=True)
+    wishlistBySession = messages.MessageField(CountForm, 7, repeated=True)
+
+
+class ConferenceFacets(ndb.Model):
+    """ConferenceFacets -- number of conferences of each combination of
+    city, month and topics, the only entity of its kind with id 1"""
+    counts = ndb.JsonProperty()
+    # the signatures the last recount counted the conferences written
+    # around it under, by websafe key, which its later deltas move
+    signatures = ndb.JsonProperty()
+    # time of the last recount, which saw the conferences written before it
+    recounted = ndb.FloatProperty(indexed=False)
+    # the recount in progress: its start, the cursor its batches reached,
+    # their counts and signatures, and the deltas applied meanwhile
+    recountStarted = ndb.FloatProperty(indexed=False)
+    recountCursor = ndb.StringProperty(indexed=False)
+    recountCounts = ndb.JsonProperty()
+    recountSignatures = ndb.JsonProperty()
+    recountDeltas = ndb.JsonProperty()
+
+
+class ConferenceFacetsForm(messages.Message):
+    """ConferenceFacetsForm -- conference counts per city, topic and month
+    outbound form message"""
+    total = messages.IntegerField(1)
+    cities = messages.MessageField(CountForm, 2, repeated=True)
+    topics = messages.MessageField(CountForm, 3, repeated=True)
+    months = messages.MessageField(CountForm, 4, repeated=True)
+
+
+class FeaturedSpeakerForm(messages.Message):
+    """FeaturedSpeakerForm -- featured speaker of a Conference message"""
+    websafeConferenceKey = messages.StringField(1)
+    data = messages.StringField(2)
+
+
+class FeaturedSpeakerForms(messages.Message):
+    """FeaturedSpeakerForms -- multiple featured speakers outbound message"""
+    items = messages.MessageField(FeaturedSpeakerForm, 1, repeated=True)
+
+
+class RegistrationTicket(ndb.Model):
+    """RegistrationTicket -- queued registration request of a user for a
+    Conference, child of the Profile and keyed by the websafe conference key"""
+    conferenceKey = ndb.KeyProperty(kind='Conference')
+    status = ndb.StringProperty(default='PENDING', indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class RegistrationTicketForm(messages.Message):
+    """RegistrationTicketForm -- registration ticket outbound form message"""
+    websafeKey = messages.StringField(1)
+    websafeConferenceKey = messages.StringField(2)
+    status = messages.StringField(3)
+
+
+class MapperJob(ndb.Model):
+    """MapperJob -- progress and checkpoint of a batched mapper job"""
+    mapper = ndb.StringProperty()
+    kind = ndb.StringProperty(indexed=False)
+    status = ndb.StringProperty()
+    cursor = ndb.StringProperty(indexed=False)
+    batchSize = ndb.IntegerProperty(indexed=False)
+    delay = ndb.FloatProperty(indexed=False)
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    written = ndb.IntegerProperty(default=0, indexed=False)
+    batches = ndb.IntegerProperty(default=0, indexed=False)
+    runs = ndb.IntegerProperty(default=0, indexed=False)
+    error = ndb.TextProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class AutocompleteTerm(ndb.Model):
+    """AutocompleteTerm -- term of a prefix index, keyed by the field and
+    the normalized term"""
+    field = ndb.StringProperty()
+    term = ndb.StringProperty(indexed=False)
+    # number of entities using the term, which ranks the completions
+    uses = ndb.IntegerProperty(default=0)
+
+
+class AutocompleteForm(messages.Message):
+    """AutocompleteForm -- terms matching a prefix outbound message"""
+    items = messages.StringField(1, repeated=True)
+
+
+class Tombstone(ndb.Model):
+    """Tombstone -- record of a deleted Session (child of its Conference)
+    or of a Conference left by a user (child of the Profile), for sync"""
+    websafeKey = ndb.StringProperty(indexed=False)
+    kind = ndb.StringProperty(indexed=False)
+    deleted = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class TombstoneForm(messages.Message):
+    """TombstoneForm -- deleted entity outbound form message"""
+    websafeKey = messages.StringField(1)
+    kind = messages.StringField(2)
+
+
+class SyncForm(messages.Message):
+    """SyncForm -- changes since a sync token outbound form message"""
+    conferences = messages.MessageField(ConferenceForm, 1, repeated=True)
+    sessions = messages.MessageField(SessionForm, 2, repeated=True)
+    deleted = messages.MessageField(TombstoneForm, 3, repeated=True)
+    syncToken = messages.StringField(4)
+    reset = messages.BooleanField(5)
+
+
+class ProfileSample(ndb.Model):
+    """ProfileSample -- marshaled (zlib compressed) cProfile stats of a
+    sampled API request"""
+    endpoint = ndb.StringProperty()
+    wallTime = ndb.FloatProperty(indexed=False)
+    data = ndb.BlobProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class ProfilerSettings(ndb.Model):
+    """ProfilerSettings -- profiler settings changed at runtime, id 1"""
+    sampleRate = ndb.FloatProperty(indexed=False)
@@ -0,0 +1,185 @@
+# coding: utf-8
+
+import time
+
+import endpoints
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import models
+import process.conferences
+import process.profiles
+import process.stats
+import process.waitlist
+
+
+# pull queue holding the pending tickets, tagged by conference
+ADMISSIONS_QUEUE = 'admissions'
+ADMISSION_LEASE_SECONDS = 60
+# an XG transaction may touch 25 entity groups: the conference plus the
+# profile (holding its ticket) of every admitted user
+ADMISSION_BATCH_SIZE = 20
+# batches drained by a single task before it chains the next one
+ADMISSION_MAX_BATCHES = 100
+# seconds grouping the requests that schedule the same drain task
+DRAIN_INTERVAL = 1
+
+PENDING = 'PENDING'
+ADMITTED = 'ADMITTED'
+SOLD_OUT = 'SOLD_OUT'
+
+
+def ticketKey(p_key, wsck):
+    """Return the RegistrationTicket key of a profile for a conference."""
+    return ndb.Key(models.RegistrationTicket, wsck, parent=p_key)
+
+
+def copyTicketToForm(ticket):
+    return models.RegistrationTicketForm(
+        websafeKey=ticket.key.urlsafe(),
+        websafeConferenceKey=ticket.conferenceKey.urlsafe(),
+        status=ticket.status
+    )
+
+
+def scheduleDrain(wsck, name=True):
+    """Queue the task admitting the pending tickets of a conference. The
+    requests of the same interval share a single named task, that runs once
+    the interval is over so it sees all of them.
+    """
+    task_name = None
+    countdown = 0
+    if name:
+        task_name = 'admit-%s-%d' % (wsck, int(time.time() / DRAIN_INTERVAL))
+        countdown = DRAIN_INTERVAL
+    try:
+        taskqueue.add(name=task_name, countdown=countdown,
+            params={'conferenceKey': wsck},
+            url='/tasks/admit_registrations'
+        )
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+@ndb.transactional()
+def _createTicket(t_key, c_key):
+    """Return the ticket of t_key and whether it was queued. A new ticket
+    is saved and queued, like a sold out one, since seats may have been
+    freed; a pending or admitted one is returned as is, so concurrent
+    requests queue it once."""
+    ticket = t_key.get()
+    if ticket and ticket.status != SOLD_OUT:
+        return ticket, False
+    ticket = models.RegistrationTicket(key=t_key, conferenceKey=c_key)
+    ticket.put()
+    # the ticket is only queued if it is saved
+    taskqueue.Queue(ADMISSIONS_QUEUE).add(taskqueue.Task(
+        payload=t_key.urlsafe(),
+        method='PULL',
+        tag=c_key.urlsafe()
+    ), transactional=True)
+    return ticket, True
+
+
+def requestRegistration(request):
+    """Ask for a seat on a conference. Returns RegistrationTicketForm.
+
+    Conferences with admissionQueue set accept the request in a queue and
+    return a PENDING ticket at once; the others register synchronously.
+    """
+    prof = process.profiles.getProfileFromUser()
+
+    wsck = request.websafeConferenceKey
+    conf = ndb.Key(urlsafe=wsck).get()
+    if not conf or not isinstance(conf, models.Conference):
+        raise endpoints.NotFoundException(
+            'No conference found with key: %s' % wsck)
+
+    if not conf.admissionQueue:
+        process.conferences.conferenceRegistration(request)
+        return models.RegistrationTicketForm(
+            websafeConferenceKey=wsck, status=ADMITTED)
+
+    if conf.key in prof.conferencesToAttend:
+        raise models.ConflictException(
+            "You have already registered for this conference")
+
+    ticket, queued = _createTicket(ticketKey(prof.key, wsck), conf.key)
+    if queued:
+        scheduleDrain(wsck)
+    return copyTicketToForm(ticket)
+
+
+def getTicket(request):
+    """Return a ticket of the current user by its websafe key."""
+    prof = process.profiles.getProfileFromUser()
+    t_key = ndb.Key(urlsafe=request.websafeTicketKey)
+    if t_key.kind() != 'RegistrationTicket' or t_key.parent() != prof.key:
+        raise endpoints.NotFoundException('Ticket Not Found')
+    ticket = t_key.get()
+    if not ticket:
+        raise endpoints.NotFoundException('Ticket Not Found')
+    return copyTicketToForm(ticket)
+
+
+@ndb.transactional(xg=True)
+def _admitBatch(c_key, t_keys):
+    """Resolve the pending tickets of t_keys in order, registering their
+    users while there are seats available. A ticket queued twice is
+    resolved once."""
+    seen = set()
+    t_keys = [t_key for t_key in t_keys
+              if not (t_key in seen or seen.add(t_key))]
+    conf = c_key.get()
+    tickets = ndb.get_multi(t_keys)
+    profiles = [
+        process.profiles.upgradeProfile(prof) for prof in
+        ndb.get_multi([t_key.parent() for t_key in t_keys])
+    ]
+    wsck = c_key.urlsafe()
+
+    to_put = []
+    to_delete = []
+    admitted = 0
+    for ticket, prof in zip(tickets, profiles):
+        if not ticket or ticket.status != PENDING:
+            continue
+        to_put.append(ticket)
+        if c_key in prof.conferencesToAttend:
+            ticket.status = ADMITTED
+        elif not conf or conf.seatsAvailable <= 0:
+            ticket.status = SOLD_OUT
+        else:
+            to_put.append(process.conferences.takeSeat(conf, prof))
+            to_put.append(prof)
+            to_delete.append(process.waitlist.waitlistKey(prof.key, wsck))
+            ticket.status = ADMITTED
+            admitted += 1
+
+    if admitted:
+        process.conferences.touch(conf)
+        to_put.append(conf)
+        process.stats.addRegistrations(c_key, admitted)
+    ndb.put_multi(to_put)
+    ndb.delete_multi(to_delete)
+
+
+def admitRegistrations(request):
+    """Drain the queued tickets of a conference in batched transactions.
+    Used on a task queue.
+    """
+    wsck = request.get('conferenceKey')
+    c_key = ndb.Key(urlsafe=wsck)
+    queue = taskqueue.Queue(ADMISSIONS_QUEUE)
+
+    for _ in range(ADMISSION_MAX_BATCHES):
+        tasks = queue.lease_tasks_by_tag(
+            ADMISSION_LEASE_SECONDS, ADMISSION_BATCH_SIZE, tag=wsck)
+        if not tasks:
+            return
+        # tasks come back in the order they were queued
+        _admitBatch(c_key, [ndb.Key(urlsafe=task.payload) for task in tasks])
+        queue.delete_tasks(tasks)
+
+    # more tickets may be waiting, continue on a new task
+    scheduleDrain(wsck, name=False)
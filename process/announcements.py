@@ -1,8 +1,8 @@
 # coding: utf-8
 
-from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+import cache
 import models
 
 
@@ -10,26 +10,42 @@ MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
 
+# the cron job refreshes the announcement every hour; it only expires if
+# the job stops, and is then recomputed by a single request
+ANNOUNCEMENT_TTL = 90 * 60
+ANNOUNCEMENT_STALE = 30 * 60
 
-def cacheAnnouncement():
-    """Create Announcement & assign to memcache; used by
-    memcache cron job & putAnnouncement().
-    """
+announcementCache = cache.ComputedCache(
+    'announcements', ttl=ANNOUNCEMENT_TTL, stale=ANNOUNCEMENT_STALE)
+
+
+def buildAnnouncement():
+    """Return the announcement of the nearly sold out conferences, or an
+    empty string if there are none."""
     confs = models.Conference.query(ndb.AND(
         models.Conference.seatsAvailable <= 5,
         models.Conference.seatsAvailable > 0)
     ).fetch(projection=[models.Conference.name])
 
     if confs:
-        # If there are almost sold out conferences,
-        # format announcement and set it in memcache
-        announcement = ANNOUNCEMENT_TPL % (
-            ', '.join(conf.name for conf in confs))
-        memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-    else:
-        # If there are no sold out conferences,
-        # delete the memcache announcements entry
-        announcement = ""
-        memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+        # If there are almost sold out conferences, format announcement
+        return ANNOUNCEMENT_TPL % (', '.join(conf.name for conf in confs))
+    return ""
+
 
+def cacheAnnouncement():
+    """Create Announcement & assign to the cache; used by
+    memcache cron job & putAnnouncement().
+    """
+    announcement = buildAnnouncement()
+    # an empty announcement is cached too, so instances don't keep
+    # asking memcache for a missing key
+    announcementCache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
     return announcement
+
+
+def getAnnouncement():
+    """Return the cached Announcement, computing it if it was evicted or
+    expired."""
+    return announcementCache.get(
+        MEMCACHE_ANNOUNCEMENTS_KEY, loader=buildAnnouncement) or ""
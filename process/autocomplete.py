@@ -0,0 +1,186 @@
+# coding: utf-8
+
+import bisect
+import heapq
+
+import endpoints
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import cache
+import models
+
+
+SPEAKER = 'speaker'
+CITY = 'city'
+TOPIC = 'topic'
+# the fields of the terms of the conferences
+CONFERENCE_FIELDS = (CITY, TOPIC)
+FIELDS = (SPEAKER, CITY, TOPIC)
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+# the index is rebuilt at least this often, so the terms written by a
+# mapper show up without an invalidation
+INDEX_TTL = 600
+INDEX_CACHE_SIZE = 500
+# the index of a field is cached in shards of the terms starting with the
+# same SHARD_LENGTH characters, each well under the memcache item size
+SHARD_LENGTH = 2
+# the shorter prefixes are completed from the most used terms of the
+# field, up to this many of them
+TOP_SCAN = 1000
+
+# 'shard:<field>:<shard>' -> (normalized terms, terms, uses) sorted by the
+# normalized term; 'top:<field>:<prefix>' -> the most used terms
+indexCache = cache.TwoTierCache('autocomplete', size=INDEX_CACHE_SIZE,
+                                local_ttl=INDEX_TTL, ttl=INDEX_TTL)
+
+
+def newTerm(field, term, uses=0):
+    """Return an (unsaved) AutocompleteTerm of field."""
+    return models.AutocompleteTerm(
+        key=models.autocompleteTermKey(field, term), field=field,
+        term=u' '.join(term.split()), uses=uses)
+
+
+def updateTask(field, added=(), removed=()):
+    """Return the (unqueued) Task updating the index of field with the
+    terms added to and removed from an entity, or None if there are none.
+    Removed terms stay while other entities use them.
+    """
+    added = set(t for t in added if t and models.normalizeTerm(t))
+    removed = set(
+        t for t in removed if t and models.normalizeTerm(t)) - added
+    if not added and not removed:
+        return None
+    return taskqueue.Task(params={
+            'field': field,
+            'added': [t.encode('utf-8') for t in added],
+            'removed': [t.encode('utf-8') for t in removed],
+        },
+        url='/tasks/update_autocomplete'
+    )
+
+
+def queueUpdate(field, added=(), removed=(), transactional=False):
+    """Queue the update task of updateTask(). Pass transactional=True inside
+    a transaction.
+    """
+    task = updateTask(field, added, removed)
+    if task:
+        taskqueue.Queue().add(task, transactional=transactional)
+
+
+def _inUse(field, term):
+    """Return whether a conference has term, or a spelling of it with
+    another case or spacing."""
+    return models.Conference.query(
+        models.Conference.autocompleteTerms ==
+        models.autocompleteTermKey(field, term).id()
+    ).get(keys_only=True)
+
+
+@ndb.transactional_tasklet
+def _countUseAsync(field, term, delta):
+    """Add delta to the uses of a term, saving it if it is new."""
+    entity = yield models.autocompleteTermKey(field, term).get_async()
+    if not entity:
+        if delta < 0:
+            raise ndb.Return()
+        entity = newTerm(field, term)
+    entity.uses = max(0, (entity.uses or 0) + delta)
+    yield entity.put_async()
+
+
+def _cacheKeys(field, terms):
+    """Return the cached shards and top terms holding terms."""
+    keys = set()
+    for term in terms:
+        term = models.normalizeTerm(term)
+        keys.add(u'shard:%s:%s' % (field, term[:SHARD_LENGTH]))
+        keys.update(u'top:%s:%s' % (field, term[:size])
+                    for size in range(SHARD_LENGTH))
+    return list(keys)
+
+
+def updateIndex(request):
+    """Add and remove the terms of a field from its index, counting their
+    uses. Used on a task queue.
+    """
+    field = request.get('field')
+    added = request.get_all('added')
+    # speakers are never removed; the terms of conferences are removed
+    # once no conference has them
+    removed = []
+    if field in CONFERENCE_FIELDS:
+        removed = request.get_all('removed')
+    unused = [term for term in removed if not _inUse(field, term)]
+    ndb.delete_multi(
+        [models.autocompleteTermKey(field, term) for term in unused])
+    ndb.Future.wait_all(
+        [_countUseAsync(field, term, 1) for term in added] +
+        [_countUseAsync(field, term, -1) for term in removed
+         if term not in unused])
+    indexCache.delete_multi(_cacheKeys(field, added + removed))
+
+
+def _buildShard(field, shard):
+    # the ids of the terms of a shard are a contiguous key range
+    start = u'%s:%s' % (field, shard)
+    query = models.AutocompleteTerm.query(
+        models.AutocompleteTerm.key >= ndb.Key(models.AutocompleteTerm, start),
+        models.AutocompleteTerm.key <
+        ndb.Key(models.AutocompleteTerm, start + u'\ufffd'))
+    terms = sorted(
+        (models.normalizeTerm(term.term), term.term, term.uses or 0)
+        for term in query)
+    return ([t[0] for t in terms], [t[1] for t in terms],
+            [t[2] for t in terms])
+
+
+def _buildTop(field, prefix):
+    query = models.AutocompleteTerm.query(
+        models.AutocompleteTerm.field == field
+    ).order(-models.AutocompleteTerm.uses)
+    top = []
+    for term in query.iter(limit=TOP_SCAN):
+        if models.normalizeTerm(term.term).startswith(prefix):
+            top.append(term.term)
+            if len(top) == MAX_LIMIT:
+                break
+    return top
+
+
+def complete(field, prefix, limit=DEFAULT_LIMIT):
+    """Return the terms of field starting with prefix, the most used
+    first. A prefix shorter than SHARD_LENGTH only finds the terms among
+    the TOP_SCAN most used ones."""
+    prefix = models.normalizeTerm(prefix or u'')
+    if len(prefix) < SHARD_LENGTH:
+        return indexCache.get(
+            u'top:%s:%s' % (field, prefix),
+            loader=lambda: _buildTop(field, prefix))[:limit]
+
+    shard = prefix[:SHARD_LENGTH]
+    keys, terms, uses = indexCache.get(
+        u'shard:%s:%s' % (field, shard),
+        loader=lambda: _buildShard(field, shard))
+    # the matches are a contiguous range of the sorted terms
+    start = end = bisect.bisect_left(keys, prefix)
+    while end < len(keys) and keys[end].startswith(prefix):
+        end += 1
+    best = heapq.nsmallest(limit, range(start, end),
+                           key=lambda i: (-uses[i], keys[i]))
+    return [terms[i] for i in best]
+
+
+def autocomplete(request):
+    """Return the AutocompleteForm of the terms of a field matching the
+    prefix of the request."""
+    if request.field not in FIELDS:
+        raise endpoints.BadRequestException(
+            'Unknown field: %s, use one of %s' % (
+                request.field, ', '.join(FIELDS)))
+    limit = min(request.limit or DEFAULT_LIMIT, MAX_LIMIT)
+    return models.AutocompleteForm(
+        items=complete(request.field, request.prefix, limit))
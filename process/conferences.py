@@ -2,12 +2,22 @@
 
 from datetime import datetime
 
+import hashlib
+
 import endpoints
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
 import models
+import process.admissions
+import process.autocomplete
+import process.facets
 import process.profiles
+import process.registrations
+import process.sessions
+import process.stats
+import process.sync
+import process.waitlist
 import utils
 
 
@@ -19,24 +29,84 @@ DEFAULTS = {
 }
 
 
+# ConferenceForm fields that are not Conference properties
+FORM_ONLY_FIELDS = (
+    'websafeKey', 'organizerDisplayName', 'etag', 'notModified', 'notFound')
+# websafe keys of a batch get
+MAX_BATCH_KEYS = 100
+
+
+def touch(conf):
+    """Bump the version of a conference, changing its ETag."""
+    conf.version = (conf.version or 0) + 1
+
+
+def touchSessions(conf):
+    """Bump the sessions version of a conference, changing the ETag of its
+    schedule."""
+    conf.sessionsVersion = (conf.sessionsVersion or 0) + 1
+
+
+def getEtag(conf):
+    """Return the ETag of a conference."""
+    return '"%d"' % (conf.version or 0)
+
+
+def getEtagMulti(confs, keys):
+    """Return an ETag for a list of session keys within the given
+    conferences, from their sessions versions."""
+    digest = hashlib.md5('|'.join(keys))
+    versions = sorted(
+        (conf.key.urlsafe(), conf.sessionsVersion or 0)
+        for conf in confs if conf)
+    for version in versions:
+        digest.update('|%s:%d' % version)
+    return '"%s"' % digest.hexdigest()
+
+
+# convert Date to date string; just copy others
+CONFERENCE_FORM_PLAN = utils.compileFormPlan(
+    models.Conference, models.ConferenceForm,
+    {'startDate': str, 'endDate': str}
+)
+
+
 def copyConferenceToForm(conf, displayName):
     """Copy relevant fields from Conference to ConferenceForm."""
-    cf = models.ConferenceForm()
-    for field in cf.all_fields():
-        if hasattr(conf, field.name):
-            # convert Date to date string; just copy others
-            if field.name.endswith('Date'):
-                setattr(cf, field.name, str(getattr(conf, field.name)))
-            else:
-                setattr(cf, field.name, getattr(conf, field.name))
-        elif field.name == "websafeKey":
-            setattr(cf, field.name, conf.key.urlsafe())
+    # ConferenceForm has no required fields, no need to check_initialized()
+    cf = utils.copyToForm(conf, models.ConferenceForm(), CONFERENCE_FORM_PLAN)
+    cf.websafeKey = conf.key.urlsafe()
+    cf.etag = getEtag(conf)
     if displayName:
-        setattr(cf, 'organizerDisplayName', displayName)
-    cf.check_initialized()
+        cf.organizerDisplayName = displayName
     return cf
 
 
+def getConferencesByKeys(websafeConferenceKeys):
+    """Return the ConferenceForms of conferences in the order of their
+    websafe keys, with a single get_multi for the conferences and one for
+    their organizers. Missing conferences have notFound set.
+    """
+    if len(websafeConferenceKeys) > MAX_BATCH_KEYS:
+        raise endpoints.BadRequestException(
+            'At most %d keys per request' % MAX_BATCH_KEYS)
+    keys = utils.keysFromWebsafe(websafeConferenceKeys, 'Conference')
+    confs = utils.getMultiByKeys(keys)
+    profiles = utils.getMultiByKeys(
+        [conf.key.parent() for conf in confs.values() if conf])
+
+    items = []
+    for wsck, c_key in zip(websafeConferenceKeys, keys):
+        conf = confs.get(c_key)
+        if conf:
+            items.append(copyConferenceToForm(
+                conf, getattr(profiles.get(c_key.parent()), 'displayName',
+                              None)))
+        else:
+            items.append(models.ConferenceForm(websafeKey=wsck, notFound=True))
+    return models.ConferenceForms(items=items)
+
+
 def createConferenceObject(request):
     """Create or update Conference object, returning ConferenceForm/request."""
     # preload necessary data items
@@ -52,8 +122,8 @@ def createConferenceObject(request):
     data = {}
     for field in request.all_fields():
         data[field.name] = getattr(request, field.name)
-    del data['websafeKey']
-    del data['organizerDisplayName']
+    for field in FORM_ONLY_FIELDS:
+        del data[field]
 
     # add default values for those missing (both data model & outbound Message)
     for df in DEFAULTS:
@@ -77,22 +147,43 @@ def createConferenceObject(request):
     # set seatsAvailable to be same as maxAttendees on creation
     if data["maxAttendees"] > 0:
         data["seatsAvailable"] = data["maxAttendees"]
-    # generate Profile Key based on user ID and Conference
-    # ID based on Profile key get Conference key from ID
+    # the Conference is a child of the Profile of its organizer, its id is
+    # allocated by the put
     p_key = ndb.Key(models.Profile, user_id)
-    c_id = models.Conference.allocate_ids(size=1, parent=p_key)[0]
-    c_key = ndb.Key(models.Conference, c_id, parent=p_key)
-    data['key'] = c_key
     data['organizerUserId'] = request.organizerUserId = user_id
-
-    # create Conference, send email to organizer confirming
-    # creation of Conference & return (modified) ConferenceForm
-    models.Conference(**data).put()
-    taskqueue.add(params={'email': user.email(),
-        'conferenceInfo': repr(request)},
-        url='/tasks/send_confirmation_email'
-    )
-    return request
+    data['version'] = 1
+    conf = models.Conference(parent=p_key, **data)
+
+    # send email to organizer confirming creation of Conference, and index
+    # its city and topics
+    tasks = filter(None, [
+        taskqueue.Task(params={'email': user.email(),
+            'conferenceInfo': repr(request)},
+            url='/tasks/send_confirmation_email'
+        ),
+        process.autocomplete.updateTask(
+            process.autocomplete.CITY, added=[data['city']]),
+        process.autocomplete.updateTask(
+            process.autocomplete.TOPIC, added=data['topics']),
+    ])
+    prof = _createConferenceAsync(conf, tasks).get_result()
+    # the form comes from the saved entity, without reading it back
+    return copyConferenceToForm(conf, getattr(prof, 'displayName', None))
+
+
+@ndb.tasklet
+def _createConferenceAsync(conf, tasks):
+    """Save a new conference, reading the profile of its organizer at the
+    same time, then queue its tasks in one batch and its facet delta.
+    Returns the Profile."""
+    prof, _ = yield conf.key.parent().get_async(), conf.put_async()
+    # stamped once the conference is saved, see facets.deltaTask()
+    rpc = taskqueue.Queue(process.facets.FACETS_QUEUE).add_async(
+        process.facets.deltaTask(
+            conf.key, None, process.facets.signature(conf)))
+    yield taskqueue.Queue().add_async(tasks)
+    rpc.get_result()
+    raise ndb.Return(prof)
 
 
 @ndb.transactional()
@@ -120,9 +211,13 @@ def updateConferenceObject(request):
         raise endpoints.ForbiddenException(
             'Only the owner can update the conference.')
 
+    old_city, old_topics = conf.city, conf.topics
+    old_signature = process.facets.signature(conf)
     # Not getting all the fields, so don't create a new object; just
     # copy relevant fields from ConferenceForm to Conference object
     for field in request.all_fields():
+        if field.name in FORM_ONLY_FIELDS:
+            continue
         data = getattr(request, field.name)
         # only copy fields where we get data
         if data not in (None, []):
@@ -133,7 +228,23 @@ def updateConferenceObject(request):
                     conf.month = data.month
             # write to Conference object
             setattr(conf, field.name, data)
+    touch(conf)
     conf.put()
+    process.facets.queueDelta(
+        conf.key, old_signature, process.facets.signature(conf),
+        transactional=True)
+    if conf.city != old_city:
+        process.autocomplete.queueUpdate(
+            process.autocomplete.CITY, added=[conf.city],
+            removed=[old_city], transactional=True)
+    if conf.topics != old_topics:
+        process.autocomplete.queueUpdate(
+            process.autocomplete.TOPIC, added=conf.topics,
+            removed=old_topics, transactional=True)
+    # drop the cached copies once the new values are committed
+    ndb.get_context().call_on_commit(
+        lambda: process.sessions.conferenceCache.delete(
+            request.websafeConferenceKey))
     prof = ndb.Key(models.Profile, user_id).get()
     return copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
@@ -143,6 +254,16 @@ def getQuery(request):
     return utils.getQuery(request, models.Conference)
 
 
+def takeSeat(conf, prof):
+    """Register a Profile on a Conference, taking away one seat.
+    Returns the (unsaved) Registration; must be used inside a transaction.
+    """
+    prof.conferencesToAttend.append(conf.key)
+    conf.seatsAvailable -= 1
+    # the registration is in the conference entity group
+    return process.registrations.newRegistration(conf.key, prof)
+
+
 @ndb.transactional(xg=True)
 def conferenceRegistration(request, reg=True):
     """Register or unregister user for selected conference."""
@@ -160,28 +281,53 @@ def conferenceRegistration(request, reg=True):
     # register
     if reg:
         # check if user already registered otherwise add
-        if wsck in prof.conferenceKeysToAttend:
+        if conf.key in prof.conferencesToAttend:
             raise models.ConflictException(
                 "You have already registered for this conference")
 
+        # high demand conferences only admit through the queue
+        if conf.admissionQueue:
+            raise models.ConflictException(
+                "This conference admits registrations through "
+                "requestRegistration.")
+
         # check if seats avail
         if conf.seatsAvailable <= 0:
             raise models.ConflictException(
-                "There are no seats available.")
-
-        # register user, take away one seat
-        prof.conferenceKeysToAttend.append(wsck)
-        conf.seatsAvailable -= 1
+                "There are no seats available. Join the waitlist instead.")
+
+        # register user, take away one seat; a user registering directly
+        # leaves the waitlist (same entity group as the profile)
+        takeSeat(conf, prof).put()
+        touch(conf)
+        process.waitlist.waitlistKey(prof.key, wsck).delete()
+        process.stats.addRegistrations(conf.key, 1)
         retval = True
 
     # unregister
     else:
         # check if user already registered
-        if wsck in prof.conferenceKeysToAttend:
+        if conf.key in prof.conferencesToAttend:
 
             # unregister user, add back one seat
-            prof.conferenceKeysToAttend.remove(wsck)
+            prof.conferencesToAttend.remove(conf.key)
             conf.seatsAvailable += 1
+            touch(conf)
+            # the admission ticket (profile entity group) goes too, so the
+            # user may request a seat again
+            ndb.delete_multi([
+                process.registrations.registrationKey(
+                    conf.key, prof.key.id()),
+                process.admissions.ticketKey(prof.key, wsck),
+            ])
+            # let the other devices of the user drop the conference
+            process.sync.newTombstone(conf.key, prof.key).put()
+            process.stats.addRegistrations(conf.key, -1)
+            # let the waitlist worker hand the free seat to the next user
+            taskqueue.add(params={'conferenceKey': wsck},
+                url='/tasks/promote_waitlist',
+                transactional=True
+            )
             retval = True
         else:
             retval = False
@@ -0,0 +1,280 @@
+# coding: utf-8
+
+import collections
+import json
+import time
+from datetime import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import cache
+import models
+import process.stats
+
+
+# pull queue buffering the facet deltas of the conference writes until the
+# stats cron job applies them, so the writes never contend on the counters
+FACETS_QUEUE = 'facet-deltas'
+DELTA_LEASE_SECONDS = 60
+DELTA_BATCH_SIZE = 1000
+# maximum number of batches applied by a single flush
+DELTA_MAX_BATCHES = 20
+
+# the flushes set the cached counts; they only expire if the cron job stops
+MEMCACHE_FACETS_KEY = 'FACETS'
+FACETS_TTL = 60 * 60
+FACETS_STALE = 60 * 60
+
+facetsCache = cache.ComputedCache('facets', ttl=FACETS_TTL,
+                                  stale=FACETS_STALE)
+
+# the recount walks the conferences in batches chained on the task queue
+RECOUNT_URL = '/tasks/recount_facets'
+RECOUNT_BATCH_SIZE = 500
+# a delta stamped this long before a recount starts may still be committed
+# after it: the recount notes the signature it saw of the conferences
+# written since, to reconcile their deltas with it
+RECOUNT_MARGIN = 60
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def facetsKey():
+    return ndb.Key(models.ConferenceFacets, 1)
+
+
+def signature(conf):
+    """Return the facet values of a conference, its city, month and
+    topics, as the JSON key of its counter."""
+    return json.dumps(
+        [conf.city, conf.month or 0, sorted(set(conf.topics or []))])
+
+
+def deltaTask(c_key, old, new):
+    """Return the (unqueued) pull task moving the conference of c_key from
+    the facet signature old to new; either may be None for a new or
+    removed conference. None if they are the same.
+
+    The task is stamped with the current time, which a recount compares
+    with its start, within RECOUNT_MARGIN: create it around the save of
+    the conference.
+    """
+    if old == new:
+        return None
+    return taskqueue.Task(
+        payload=json.dumps({'time': time.time(), 'key': c_key.urlsafe(),
+                            'old': old, 'new': new}),
+        method='PULL'
+    )
+
+
+def queueDelta(c_key, old, new, transactional=False):
+    """Queue the task of deltaTask(). Pass transactional=True inside a
+    transaction."""
+    task = deltaTask(c_key, old, new)
+    if task:
+        taskqueue.Queue(FACETS_QUEUE).add(task, transactional=transactional)
+
+
+def _cells(counts):
+    """Return the cached form of the counters: [city, month, topics, count]
+    lists, without the empty ones."""
+    return [
+        json.loads(sig) + [count]
+        for sig, count in (counts or {}).items() if count > 0
+    ]
+
+
+def _move(counts, old, new):
+    """Move a conference from the counter of the signature old to that of
+    new; a decrement may be applied before its increment."""
+    for sig, delta in ((old, -1), (new, 1)):
+        if sig:
+            counts[sig] = counts.get(sig, 0) + delta
+            if not counts[sig]:
+                del counts[sig]
+
+
+def _reconcile(counts, signatures, payload):
+    """Apply a delta to counters built by a recount, which counted the
+    conferences of signatures under these signatures: only a delta from
+    the counted signature moves the conference, the deltas before it
+    were already seen by the recount. Applied in order."""
+    key = payload['key']
+    if key in signatures:
+        if signatures[key] != payload['old']:
+            return
+        signatures[key] = payload['new']
+    _move(counts, payload['old'], payload['new'])
+
+
+@ndb.transactional()
+def _applyDeltas(payloads):
+    facets = facetsKey().get() or models.ConferenceFacets(key=facetsKey())
+    counts = dict(facets.counts or {})
+    signatures = dict(facets.signatures or {})
+    pending = list(facets.recountDeltas or [])
+    for payload in payloads:
+        # queued before the deltas named their conference, the next
+        # recount corrects their counters
+        if 'key' not in payload:
+            continue
+        # the last recount already saw the conferences written before it
+        if payload['time'] < (facets.recounted or 0) - RECOUNT_MARGIN:
+            continue
+        _reconcile(counts, signatures, payload)
+        # the recount in progress reconciles them with what it saw once
+        # it is done
+        if (facets.recountStarted and payload['time'] >=
+                facets.recountStarted - RECOUNT_MARGIN):
+            pending.append(payload)
+    facets.counts = counts
+    facets.signatures = signatures
+    if facets.recountStarted:
+        facets.recountDeltas = pending
+    facets.put()
+    return counts
+
+
+def flushDeltas():
+    """Apply the buffered facet deltas to the counters, one transaction
+    per batch, and cache the new counts. Used by the stats cron job.
+    """
+    queue = taskqueue.Queue(FACETS_QUEUE)
+    counts = None
+    for _ in range(DELTA_MAX_BATCHES):
+        tasks = queue.lease_tasks(DELTA_LEASE_SECONDS, DELTA_BATCH_SIZE)
+        if not tasks:
+            break
+        counts = _applyDeltas([json.loads(task.payload) for task in tasks])
+        queue.delete_tasks(tasks)
+    if counts is not None:
+        facetsCache.set(MEMCACHE_FACETS_KEY, _cells(counts))
+
+
+def _recountTask(started, cursor):
+    return taskqueue.Task(
+        params={'started': repr(started), 'cursor': cursor or ''},
+        url=RECOUNT_URL
+    )
+
+
+@ndb.transactional()
+def startRecount():
+    """Start counting the conferences of every facet again, in batches
+    chained on the task queue; the last one replaces the counters. The
+    deltas applied meanwhile are kept and reconciled with the conferences
+    the recount saw. A recount started again supersedes the one in
+    progress. Used by a cron job.
+    """
+    facets = facetsKey().get() or models.ConferenceFacets(key=facetsKey())
+    facets.recountStarted = time.time()
+    facets.recountCursor = None
+    facets.recountCounts = {}
+    facets.recountSignatures = {}
+    facets.recountDeltas = []
+    taskqueue.Queue().add(_recountTask(facets.recountStarted, None),
+                          transactional=True)
+    facets.put()
+
+
+def recountBatch(request):
+    """Count the conferences of the next batch of a recount and chain the
+    task of the following one. Used on a task queue.
+    """
+    started = float(request.get('started'))
+    cursor = request.get('cursor') or None
+    confs, next_cursor, more = models.Conference.query().fetch_page(
+        RECOUNT_BATCH_SIZE, start_cursor=Cursor(urlsafe=cursor))
+    counts = collections.Counter(signature(conf) for conf in confs)
+    # the signatures of the conferences their pending deltas may move
+    since = started - RECOUNT_MARGIN
+    signatures = dict(
+        (conf.key.urlsafe(), signature(conf)) for conf in confs
+        if conf.modified and
+        (conf.modified - EPOCH).total_seconds() >= since)
+    next_cursor = next_cursor.urlsafe() if more and next_cursor else None
+    if not next_cursor:
+        # the last batch reconciles every delta queued before its read
+        flushDeltas()
+    counts = _checkpointRecount(started, cursor, counts, signatures,
+                                next_cursor)
+    if counts is not None:
+        facetsCache.set(MEMCACHE_FACETS_KEY, _cells(counts))
+
+
+@ndb.transactional()
+def _checkpointRecount(started, cursor, counts, signatures, next_cursor):
+    """Add the counts of a batch to the recount, unless a retried task
+    already did or another recount superseded it, and queue the next batch
+    with them. After the last batch, reconcile the deltas applied during
+    the recount and replace the counters; returns them, else None.
+    """
+    facets = facetsKey().get()
+    if (not facets or
+            (facets.recountStarted, facets.recountCursor) != (started, cursor)):
+        return None
+    counts.update(facets.recountCounts or {})
+    signatures.update(facets.recountSignatures or {})
+
+    if next_cursor:
+        facets.recountCursor = next_cursor
+        facets.recountCounts = dict(counts)
+        facets.recountSignatures = signatures
+        taskqueue.Queue().add(_recountTask(started, next_cursor),
+                              transactional=True)
+        facets.put()
+        return None
+
+    counts = dict(counts)
+    for payload in sorted(facets.recountDeltas or [],
+                          key=lambda payload: payload['time']):
+        _reconcile(counts, signatures, payload)
+    facets.counts = counts
+    facets.signatures = signatures
+    facets.recounted = started
+    facets.recountStarted = facets.recountCursor = None
+    facets.recountCounts = facets.recountSignatures = None
+    facets.recountDeltas = None
+    facets.put()
+    return facets.counts
+
+
+def _loadCells():
+    facets = facetsKey().get()
+    return _cells(facets.counts if facets else None)
+
+
+def getFacets(request):
+    """Return the number of conferences per city, topic and month, among
+    the conferences of the optional city, topic and month of the request.
+    Computed from the cached counters, without querying the conferences.
+    """
+    cities = collections.Counter()
+    topics = collections.Counter()
+    months = collections.Counter()
+    total = 0
+    for city, month, conf_topics, count in facetsCache.get(
+            MEMCACHE_FACETS_KEY, loader=_loadCells):
+        if request.city and city != request.city:
+            continue
+        if request.month and month != request.month:
+            continue
+        if request.topic and request.topic not in conf_topics:
+            continue
+        total += count
+        cities[city] += count
+        # month 0 is a conference without a start date
+        if month:
+            months[str(month)] += count
+        for topic in conf_topics:
+            topics[topic] += count
+
+    return models.ConferenceFacetsForm(
+        total=total,
+        cities=process.stats.countForms(cities),
+        topics=process.stats.countForms(topics),
+        months=process.stats.countForms(months)
+    )
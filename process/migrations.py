@@ -0,0 +1,209 @@
+# coding: utf-8
+
+import hashlib
+from datetime import datetime
+
+from google.appengine.ext import ndb
+
+import mapper
+import models
+import process.autocomplete
+import process.profiles
+# registers the recommendation mappers too
+import process.recommendations
+import process.registrations
+import process.sessions
+import process.stats
+
+
+# Mappers run by the mapper framework, started from /admin/mapper.
+
+
+@mapper.mapper('Conference')
+def backfillConferenceMonth(conf):
+    """Set the month of the conferences from their start date."""
+    month = conf.startDate.month if conf.startDate else 0
+    if conf.month != month:
+        conf.month = month
+        return conf
+
+
+@mapper.mapper('Session')
+def backfillSessionTimes(sess):
+    """Set the absolute start and end of the sessions."""
+    try:
+        start, end = process.sessions.sessionTimes(
+            sess.date, sess.startTime, sess.duration)
+    except ValueError:
+        # an invalid startTime, leave the session out of the time queries
+        return None
+    if (sess.startDateTime, sess.endDateTime) != (start, end):
+        sess.startDateTime = start
+        sess.endDateTime = end
+        return sess
+
+
+@mapper.mapper('Speaker')
+def normalizeSpeakerNames(speaker):
+    """Strip and collapse the whitespace of the speaker names."""
+    name = ' '.join(speaker.name.split())
+    if speaker.name != name:
+        speaker.name = name
+        return speaker
+
+
+@mapper.mapper('Profile')
+def backfillRegistrations(prof):
+    """Create the Registration index of the conferences a profile attends."""
+    prof = process.profiles.upgradeProfile(prof)
+    regs = [
+        process.registrations.newRegistration(c_key, prof)
+        for c_key in prof.conferencesToAttend
+    ]
+    # keep the registrations already indexed, with their original date
+    existing = ndb.get_multi([reg.key for reg in regs])
+    return [reg for reg, found in zip(regs, existing) if not found]
+
+
+def _missingTerms(terms):
+    # keep the terms already indexed, with their uses
+    existing = ndb.get_multi([term.key for term in terms])
+    return [term for term, found in zip(terms, existing) if not found]
+
+
+@mapper.mapper('Speaker')
+def indexSpeakerNames(speaker):
+    """Add the speaker names to the autocomplete index; run countTermUses
+    after it to rank them."""
+    return _missingTerms([process.autocomplete.newTerm(
+        process.autocomplete.SPEAKER, speaker.name)])
+
+
+@mapper.mapper('Conference')
+def indexConferenceTerms(conf):
+    """Add the cities and topics of the conferences to the autocomplete
+    index; run countTermUses after it to rank them."""
+    terms = [process.autocomplete.newTerm(process.autocomplete.TOPIC, topic)
+             for topic in conf.topics if topic.strip()]
+    if conf.city and conf.city.strip():
+        terms.append(process.autocomplete.newTerm(
+            process.autocomplete.CITY, conf.city))
+    return _missingTerms(terms)
+
+
+@mapper.mapper('AutocompleteTerm')
+def countTermUses(term):
+    """Count the uses of the autocomplete terms again: the conferences
+    having a city or topic, the sessions of the speakers of a name. Run
+    it after stampConferenceTerms."""
+    if term.field in process.autocomplete.CONFERENCE_FIELDS:
+        uses = models.Conference.query(
+            models.Conference.autocompleteTerms == term.key.id()).count()
+    else:
+        sp_keys = models.Speaker.query(
+            models.Speaker.name == term.term).fetch(keys_only=True)
+        uses = sum(
+            models.Session.query(models.Session.speakerKey == sp_key).count()
+            for sp_key in sp_keys)
+    if term.uses != uses:
+        term.uses = uses
+        return term
+
+
+@mapper.mapper('Conference')
+def stampConferenceTerms(conf):
+    """Save the conferences again to store their autocompleteTerms, which
+    the index updates check before removing a term. Bumps their modified
+    time."""
+    return conf
+
+
+@mapper.mapper('Conference')
+def stampConferences(conf):
+    """Stamp the conferences with their modified time, for sync."""
+    if not conf.modified:
+        return conf
+
+
+@mapper.mapper('Session')
+def stampSessions(sess):
+    """Stamp the sessions with their modified time, for sync."""
+    if not sess.modified:
+        return sess
+
+
+@mapper.mapper('Profile')
+def migrateProfileKeys(prof):
+    """Move the websafe keys of the profiles to their KeyProperty lists."""
+    if prof.conferenceKeysToAttend or prof.sessionsWishlist:
+        return process.profiles.upgradeProfile(prof)
+
+
+@mapper.mapper('Profile')
+def indexWishlists(prof):
+    """Save the profiles again to index their wishlists, which the
+    recommendations query."""
+    prof = process.profiles.upgradeProfile(prof)
+    if prof.wishlistKeys:
+        return prof
+
+
+@mapper.mapper('Session')
+def stampSessionConferences(sess):
+    """Set the conferenceKey of the sessions saved as children of their
+    conference, so the queries of settings.ROOT_SESSIONS find them. The
+    sessions keep their keys, which the wishlists and clients hold."""
+    if not sess.conferenceKey:
+        sess.conferenceKey = sess.key.parent()
+        return sess
+
+
+@mapper.mapper('Session')
+def normalizeSessionTypes(sess):
+    """Move the sessions to the types of settings.SESSION_TYPES, which
+    filterSessions matches: a known type in another case or spacing to
+    that type, any other one to 'other'. Run recountConferenceStats after
+    it to count the sessions by their new types."""
+    if not sess.typeOfSession:
+        return None
+    typeOfSession = (process.sessions.normalizeSessionType(
+        sess.typeOfSession) or 'other')
+    if sess.typeOfSession != typeOfSession:
+        sess.typeOfSession = typeOfSession
+        return sess
+
+
+@mapper.mapper('Session')
+def migrateSpeakerKeys(sess):
+    """Move the websafe speakerId of the sessions to speakerKey."""
+    if sess.speakerId:
+        sess.speakerKey = ndb.Key(urlsafe=sess.speakerId)
+        sess.speakerId = None
+        return sess
+
+
+@mapper.mapper('Conference')
+def recountConferenceStats(conf):
+    """Count the sessions and registrations of the conferences again,
+    replacing their stats; run recountWishlists after it."""
+    process.stats.recountStats(conf.key)
+
+
+# the additions of a wishlist recount are named by day, so a batch mapped
+# again doesn't count them twice
+WISHLIST_RECOUNT_TASK = 'wishlist-recount-%s-%s'
+
+
+@mapper.mapper('Profile')
+def recountWishlists(prof):
+    """Count the sessions of the wishlists again on the stats cleared by
+    recountConferenceStats, through the stats pull queue. Run it once a
+    day at most."""
+    prof = process.profiles.upgradeProfile(prof)
+    c_keys = process.sessions.conferenceKeysOf(prof.wishlistKeys)
+    day = datetime.utcnow().strftime('%Y%m%d')
+    for s_key, c_key in c_keys.items():
+        digest = hashlib.md5(prof.key.urlsafe() + s_key.urlsafe())
+        process.stats.queueWishlistAddition(
+            s_key, c_key,
+            name=WISHLIST_RECOUNT_TASK % (day, digest.hexdigest()))
@@ -7,23 +7,41 @@ import models
 import utils
 
 
+# convert t-shirt string to Enum; just copy others
+PROFILE_FORM_PLAN = utils.compileFormPlan(
+    models.Profile, models.ProfileForm,
+    {'teeShirtSize': lambda size: getattr(models.TeeShirtSize, size)}
+)
+
+
 def copyProfileToForm(prof):
     """Copy relevant fields from Profile to ProfileForm."""
-    # copy relevant fields from Profile to ProfileForm
-    pf = models.ProfileForm()
-    for field in pf.all_fields():
-        if hasattr(prof, field.name):
-            # convert t-shirt string to Enum; just copy others
-            if field.name == 'teeShirtSize':
-                setattr(pf, field.name,
-                        getattr(models.TeeShirtSize,
-                                getattr(prof, field.name)))
-            else:
-                setattr(pf, field.name, getattr(prof, field.name))
-    pf.check_initialized()
+    # ProfileForm has no required fields, no need to check_initialized()
+    pf = utils.copyToForm(prof, models.ProfileForm(), PROFILE_FORM_PLAN)
+    pf.conferenceKeysToAttend = [
+        c_key.urlsafe() for c_key in prof.conferencesToAttend]
+    pf.sessionsWishlist = [s_key.urlsafe() for s_key in prof.wishlistKeys]
     return pf
 
 
+def upgradeProfile(prof):
+    """Move the websafe keys of a profile saved before the KeyProperty
+    lists into them. The legacy lists are emptied, so they are dropped on the
+    next put. Returns the profile, or None for a missing one.
+    """
+    if prof and prof.conferenceKeysToAttend:
+        for wsck in prof.conferenceKeysToAttend:
+            c_key = ndb.Key(urlsafe=wsck)
+            if c_key not in prof.conferencesToAttend:
+                prof.conferencesToAttend.append(c_key)
+        prof.conferenceKeysToAttend = []
+    if prof and prof.sessionsWishlist:
+        prof.wishlistKeys.extend(
+            ndb.Key(urlsafe=wssk) for wssk in prof.sessionsWishlist)
+        prof.sessionsWishlist = []
+    return prof
+
+
 def getProfileFromUser():
     """Return user Profile from datastore, creating new one if non-existent."""
     # make sure user is authed
@@ -45,7 +63,7 @@ def getProfileFromUser():
         )
         profile.put()
 
-    return profile      # return Profile
+    return upgradeProfile(profile)      # return Profile
 
 
 def doProfile(save_request=None):
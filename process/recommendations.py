@@ -0,0 +1,92 @@
+# coding: utf-8
+
+import collections
+import operator
+
+from google.appengine.ext import ndb
+
+import mapper
+import models
+
+
+# number of neighbours stored for every session
+RECOMMENDATIONS_TOP_K = 10
+# size of the batches used to stream the profiles
+PROFILE_BATCH_SIZE = 500
+
+
+def buildRow(s_key):
+    """Return the co-occurrence row of a session: the number of wishlists
+    holding both it and each other session, as a Counter of keys."""
+    row = collections.Counter()
+    query = models.Profile.query(models.Profile.wishlistKeys == s_key)
+    for prof in query.iter(batch_size=PROFILE_BATCH_SIZE):
+        # the same session may appear twice in a wishlist
+        row.update(set(prof.wishlistKeys) - set([s_key]))
+    return row
+
+
+def topNeighbours(row, k=RECOMMENDATIONS_TOP_K):
+    """Return the (session, count) pairs of the k existing sessions with
+    the highest counts of a row. The sessions deleted since they were
+    wishlisted are dropped before taking the top k, fetching the
+    candidates by batches of k."""
+    candidates = sorted(row.items(), key=operator.itemgetter(1),
+                        reverse=True)
+    neighbours = []
+    for start in range(0, len(candidates), k):
+        batch = candidates[start:start + k]
+        sessions = ndb.get_multi([s_key for s_key, _ in batch])
+        neighbours.extend(
+            (sess, count) for sess, (_, count) in zip(sessions, batch)
+            if sess)
+        if len(neighbours) >= k:
+            break
+    return neighbours[:k]
+
+
+def startRecommendations():
+    """Start the mapper jobs computing the "also wishlisted" sessions of
+    every session and removing the ones of deleted sessions. Used by the
+    recommendations cron job.
+    """
+    mapper.startJob('recommendSession')
+    mapper.startJob('dropRecommendation')
+
+
+@mapper.mapper('Session')
+def recommendSession(sess):
+    """Store the "also wishlisted" sessions of a session, or remove them
+    when no wishlist holds it with another one."""
+    rec_key = ndb.Key(models.SessionRecommendation, sess.key.urlsafe())
+    neighbours = topNeighbours(buildRow(sess.key))
+    if not neighbours:
+        rec_key.delete()
+        return None
+    return models.SessionRecommendation(
+        key=rec_key,
+        sessionKeys=[s.key.urlsafe() for s, _ in neighbours],
+        sessionNames=[s.name for s, _ in neighbours],
+        scores=[count for _, count in neighbours]
+    )
+
+
+@mapper.mapper('SessionRecommendation')
+def dropRecommendation(rec):
+    """Remove the recommendations of a deleted session."""
+    if not ndb.Key(urlsafe=rec.key.id()).get():
+        rec.key.delete()
+
+
+def getRecommendations(websafeSessionKey):
+    """Return the stored recommendations for a session as a form."""
+    rec = ndb.Key(models.SessionRecommendation, websafeSessionKey).get()
+    forms = models.SessionRecommendationForms()
+    if rec:
+        forms.items = [
+            models.SessionRecommendationForm(
+                websafeKey=wssk, name=name, score=score
+            ) for wssk, name, score in zip(
+                rec.sessionKeys, rec.sessionNames, rec.scores)
+        ]
+    return forms
@@ -0,0 +1,76 @@
+# coding: utf-8
+
+import endpoints
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import models
+import process.stats
+import utils
+
+
+ROSTER_PAGE_SIZE = 100
+ROSTER_MAX_PAGE_SIZE = 500
+
+
+def registrationKey(c_key, user_id):
+    """Return the Registration key of a user for a conference."""
+    return ndb.Key(models.Registration, user_id, parent=c_key)
+
+
+def newRegistration(c_key, prof):
+    """Return a new (unsaved) Registration of a Profile for a conference."""
+    return models.Registration(
+        key=registrationKey(c_key, prof.key.id()),
+        displayName=prof.displayName,
+        mainEmail=prof.mainEmail
+    )
+
+
+def countAttendees(c_key):
+    """Return the exact number of users registered for a conference,
+    counting their registrations; used by the stats recount, the others
+    read ConferenceStats.registrations."""
+    return models.Registration.query(ancestor=c_key).count()
+
+
+def getRoster(request):
+    """Return a page of the attendees of a conference. Organizer only."""
+    user = endpoints.get_current_user()
+    if not user:
+        raise endpoints.UnauthorizedException('Authorization required')
+    user_id = utils.getUserId(user)
+
+    c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+    conf, stats = ndb.get_multi([c_key, process.stats.statsKey(c_key)])
+    if not conf or not isinstance(conf, models.Conference):
+        raise endpoints.NotFoundException(
+            'No conference found with key: %s' % request.websafeConferenceKey)
+    if user_id != conf.organizerUserId:
+        raise endpoints.ForbiddenException(
+            'Only the owner can see the attendees.')
+
+    if request.limit is not None and request.limit < 1:
+        raise endpoints.BadRequestException('limit must be at least 1.')
+    limit = min(request.limit or ROSTER_PAGE_SIZE, ROSTER_MAX_PAGE_SIZE)
+    try:
+        cursor = Cursor(urlsafe=request.pageToken)
+    except Exception:
+        raise endpoints.BadRequestException('Invalid page token.')
+
+    # registrations are keyed by user id, so the roster is sorted by it
+    query = models.Registration.query(ancestor=conf.key)
+    regs, next_cursor, more = query.fetch_page(limit, start_cursor=cursor)
+
+    return models.AttendeeForms(
+        items=[
+            models.AttendeeForm(
+                userId=reg.key.id(),
+                displayName=reg.displayName,
+                mainEmail=reg.mainEmail
+            ) for reg in regs
+        ],
+        nextPageToken=next_cursor.urlsafe() if more and next_cursor else None,
+        # the registrations counted in the same transactions as the seats
+        total=stats.registrations if stats else 0
+    )
@@ -1,36 +1,252 @@
 # coding: utf-8
 
-from datetime import datetime
+from datetime import datetime, time, timedelta
 
 import endpoints
+from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
+from protorpc import protojson
 
+import cache
 import models
+import process.autocomplete
+import process.conferences
+import process.stats
+import process.sync
+import settings
 import utils
 
 
-def copySessionToForm(sess):
-    """Copy relevant fields from Session to SessionForm."""
-    session = models.SessionForm()
-    for field in session.all_fields():
-        if hasattr(sess, field.name):
-            # convert Date to date string; just copy others
-            if field.name == 'date':
-                setattr(session, field.name, str(getattr(sess, field.name)))
-            else:
-                setattr(session, field.name, getattr(sess, field.name))
-            # get name of speaker based on its id
-            if field.name == 'speakerId':
-                s_id = getattr(sess, field.name)
-                if s_id:
-                    speaker = ndb.Key(urlsafe=s_id).get()
-                    if speaker:
-                        session.speaker = speaker.name
-            session.websafeKey = sess.key.urlsafe()
-    session.check_initialized()
+# speakers are never renamed, so their names can be cached for long
+speakerNameCache = cache.TwoTierCache('speaker_names', size=5000,
+                                      local_ttl=3600)
+# only the fields that don't change on registration (name, organizer) may
+# be trusted on the cached conferences; updates delete them, and a copy
+# that still slipped in expires
+CONFERENCE_TTL = 10 * 60
+conferenceCache = cache.TwoTierCache('conferences', ttl=CONFERENCE_TTL)
+# the schedules are keyed by the sessions version of their conference,
+# which every session write bumps, so an expired one is computed again at once
+SCHEDULE_TTL = 10 * 60
+scheduleCache = cache.ComputedCache('schedules', ttl=SCHEDULE_TTL)
+# root sessions bump the schedule generation of their conference when
+# saved; its version is only bumped once the cron job counts them
+SCHEDULE_GENERATION_KEY = 'schedule_generation:%s'
+EPOCH = datetime(1970, 1, 1)
+
+
+def speakerKeyOf(sess):
+    """Return the Speaker key of a session, or None. Sessions saved before
+    speakerKey only have the websafe speakerId."""
+    if sess.speakerKey:
+        return sess.speakerKey
+    if sess.speakerId:
+        return ndb.Key(urlsafe=sess.speakerId)
+    return None
+
+
+def conferenceKeyOf(sess):
+    """Return the Conference key of a session. Sessions saved before
+    conferenceKey are children of their conference."""
+    return sess.conferenceKey or sess.key.parent()
+
+
+def conferenceKeysOf(s_keys):
+    """Return a dict of the Conference keys of session keys. The root
+    sessions are read for theirs, with a single get_multi; the deleted ones
+    are skipped."""
+    c_keys = {}
+    roots = []
+    for s_key in s_keys:
+        if s_key.parent():
+            c_keys[s_key] = s_key.parent()
+        else:
+            roots.append(s_key)
+    for s_key, sess in zip(roots, ndb.get_multi(roots)):
+        if sess:
+            c_keys[s_key] = sess.conferenceKey
+    return c_keys
+
+
+def querySessions(c_key):
+    """Return the query of the sessions of a conference. With root
+    sessions it filters on their conferenceKey, and is only eventually
+    consistent."""
+    if settings.ROOT_SESSIONS:
+        return models.Session.query(models.Session.conferenceKey == c_key)
+    return models.Session.query(ancestor=c_key)
+
+
+def querySpeakerSessions(sp_key, c_key=None):
+    """Return the query of the sessions of a speaker, by speakerKey or by
+    the websafe speakerId of the sessions saved before it, in the
+    conference of c_key if given."""
+    query = querySessions(c_key) if c_key else models.Session.query()
+    return query.filter(ndb.OR(
+        models.Session.speakerKey == sp_key,
+        models.Session.speakerId == sp_key.urlsafe()
+    ))
+
+
+def getSpeakerName(sp_key):
+    """Return the name of a speaker by its key, or None."""
+    def load():
+        speaker = sp_key.get()
+        return speaker.name if speaker else None
+    # speakers are root entities, their ids are enough
+    return speakerNameCache.get(str(sp_key.id()), loader=load)
+
+
+def getSpeakerNames(sp_keys):
+    """Return a dict of the names of speakers by their keys, with a single
+    get_multi for the ones not cached. None keys are skipped."""
+    keys = dict((str(sp_key.id()), sp_key) for sp_key in sp_keys if sp_key)
+
+    def load(missing):
+        speakers = ndb.get_multi([keys[sp_id] for sp_id in missing])
+        return dict(
+            (sp_id, getattr(speaker, 'name', None))
+            for sp_id, speaker in zip(missing, speakers)
+        )
+    names = speakerNameCache.get_multi(list(keys), loader=load)
+    return dict((keys[sp_id], name) for sp_id, name in names.items())
+
+
+def getConference(c_key):
+    """Return the (cached, read-only) Conference of a key, or None."""
+    def load():
+        conf = c_key.get()
+        return conf if isinstance(conf, models.Conference) else None
+    return conferenceCache.get(c_key.urlsafe(), loader=load)
+
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M'
+
+
+def formatDateTime(value):
+    return value.strftime(DATETIME_FORMAT) if value else None
+
+
+def parseStartTime(startTime):
+    """Return the time of the day of a 0 to 2359 startTime."""
+    return time(*divmod(startTime or 0, 100))
+
+
+def sessionTimes(date, startTime, duration):
+    """Return the absolute start and end datetimes of a session, or
+    (None, None) if it has no date. Raises ValueError on invalid times.
+    """
+    if not date:
+        return None, None
+    start = datetime.combine(date, parseStartTime(startTime))
+    return start, start + timedelta(minutes=duration or 0)
+
+
+# most values of a datastore IN filter
+MAX_IN_VALUES = 30
+
+
+def normalizeSessionType(typeOfSession):
+    """Return the type of settings.SESSION_TYPES a typeOfSession spells,
+    whatever its case and spacing, or None."""
+    typeOfSession = u' '.join((typeOfSession or u'').lower().split())
+    if typeOfSession in settings.SESSION_TYPES:
+        return typeOfSession
+    return None
+
+
+def getSessionTypes(excluded=()):
+    """Return the session types of settings, but the excluded ones."""
+    excluded = set(map(normalizeSessionType, excluded))
+    types = [t for t in settings.SESSION_TYPES if t not in excluded]
+    if len(types) > MAX_IN_VALUES:
+        raise endpoints.BadRequestException(
+            'Exclude more session types, at most %d may remain' %
+            MAX_IN_VALUES)
+    return types
+
+
+# convert Date and DateTime to strings; just copy others
+SESSION_FORM_PLAN = utils.compileFormPlan(
+    models.Session, models.SessionForm, {
+        'date': str,
+        'startDateTime': formatDateTime,
+        'endDateTime': formatDateTime,
+    }
+)
+
+
+def copySessionToForm(sess, speakerNames=None):
+    """Copy relevant fields from Session to SessionForm. The speaker name
+    is looked up in speakerNames, when given."""
+    # SessionForm has no required fields, no need to check_initialized()
+    session = utils.copyToForm(sess, models.SessionForm(), SESSION_FORM_PLAN)
+    # get name of speaker based on its key
+    sp_key = speakerKeyOf(sess)
+    if sp_key:
+        session.speakerId = sp_key.urlsafe()
+        if speakerNames is not None:
+            session.speaker = speakerNames.get(sp_key)
+        else:
+            session.speaker = getSpeakerName(sp_key)
+    session.websafeKey = sess.key.urlsafe()
     return session
 
+
+def _initialGeneration():
+    return int((datetime.utcnow() - EPOCH).total_seconds() * 1000)
+
+
+def getScheduleGeneration(c_key):
+    """Return the schedule generation of a conference, 0 without root
+    sessions. An evicted generation starts again from the current time in
+    ms, past the values it had."""
+    if not settings.ROOT_SESSIONS:
+        return 0
+    key = SCHEDULE_GENERATION_KEY % c_key.urlsafe()
+    generation = memcache.get(key)
+    if generation is None:
+        memcache.add(key, _initialGeneration())
+        generation = memcache.get(key) or 0
+    return generation
+
+
+def bumpScheduleGeneration(c_key):
+    """Change the schedule and its ETag at once after a root session of
+    a conference is saved."""
+    memcache.incr(SCHEDULE_GENERATION_KEY % c_key.urlsafe(),
+                  initial_value=_initialGeneration())
+
+
+def getScheduleEtag(conf):
+    """Return the ETag of the schedule of a conference: its sessions
+    version, and its schedule generation with root sessions. The
+    registrations, which only bump the version, leave it alone."""
+    return '"%d.%d"' % (conf.sessionsVersion or 0,
+                        getScheduleGeneration(conf.key))
+
+
+def getSchedule(conf):
+    """Return the SessionForms of the sessions of a conference by start
+    time, cached for the current sessions version and schedule generation
+    of the conference. Root sessions are queried with eventual consistency,
+    so a schedule computed right after a write may miss it until the cron
+    job bumps the sessions version."""
+    def load():
+        sessions = querySessions(conf.key).order(
+            models.Session.startTime).fetch()
+        names = getSpeakerNames(map(speakerKeyOf, sessions))
+        forms = models.SessionForms(
+            items=[copySessionToForm(sess, names) for sess in sessions])
+        # messages don't pickle, cache them as JSON
+        return protojson.encode_message(forms)
+    key = '%s:%d:%d' % (conf.key.urlsafe(), conf.sessionsVersion or 0,
+                        getScheduleGeneration(conf.key))
+    return protojson.decode_message(
+        models.SessionForms, scheduleCache.get(key, loader=load))
+
+
 def createSessionObject(request):
     """Create a new Session object. Returns SessionForm/request."""
     # preload necessary data items
@@ -39,10 +255,20 @@ def createSessionObject(request):
         raise endpoints.UnauthorizedException('Authorization required')
     user_id = utils.getUserId(user)
 
-    # update existing conference
-    conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+    # the session id and the speaker don't depend on the conference, their
+    # RPCs run while the conference is loaded and checked
+    c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+    s_parent = None if settings.ROOT_SESSIONS else c_key
+    s_ids = models.Session.allocate_ids_async(size=1, parent=s_parent)
+    speaker = None
+    if request.speaker:
+        speaker = models.Speaker.query(
+            models.Speaker.name == request.speaker).get_async()
+
+    # get the conference
+    conf = getConference(c_key)
     # check that conference exists
-    if not conf or not isinstance(conf, models.Conference):
+    if not conf:
         raise endpoints.NotFoundException(
             'No conference found with key: %s' % request.websafeConferenceKey)
 
@@ -53,6 +279,11 @@ def createSessionObject(request):
 
     if not request.name:
         raise endpoints.BadRequestException("Session 'name' field required")
+    typeOfSession = normalizeSessionType(request.typeOfSession)
+    if request.typeOfSession and not typeOfSession:
+        raise endpoints.BadRequestException(
+            "Invalid 'typeOfSession', use one of: %s" %
+            ', '.join(settings.SESSION_TYPES))
 
     # copy SessionForm/ProtoRPC Message into dict
     data = {}
@@ -60,41 +291,177 @@ def createSessionObject(request):
         data[field.name] = getattr(request, field.name)
     del data['websafeConferenceKey']
     del data['websafeKey']
+    del data['notFound']
+    del data['speakerId']
 
     # convert dates from strings to Date objects
     if data['date']:
         data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
 
-    # If the request contains a speaker name, first query the database to see if the speaker already exists
-    # If not create a new entity
-    # Clean up by deleting the speaker name from the data dictionary
-    if data['speaker']:
-        speaker = models.Speaker.query(
-            models.Speaker.name == data['speaker']
-        ).get()
-        if not speaker:
-            sp_id = models.Speaker.allocate_ids(size=1)[0]
-            sp_key = ndb.Key(models.Speaker, sp_id)
-            models.Speaker(name=data['speaker']).put()
-            data['speakerId'] = sp_key.urlsafe()
+    # the absolute start may be given to the minute instead of the date and
+    # startTime; the end is always derived from the duration
+    try:
+        if data['startDateTime']:
+            start = datetime.strptime(
+                data['startDateTime'][:16], DATETIME_FORMAT)
+            data['date'] = start.date()
+            data['startTime'] = start.hour * 100 + start.minute
+        data['startDateTime'], data['endDateTime'] = sessionTimes(
+            data['date'], data['startTime'], data['duration'])
+    except ValueError:
+        raise endpoints.BadRequestException(
+            "Invalid 'startDateTime' or 'startTime' field")
+
+    data['typeOfSession'] = typeOfSession
+    speaker_name = data.pop('speaker')
+    data['conferenceKey'] = c_key
+    sess = _createSessionAsync(
+        s_parent, data, s_ids, speaker, speaker_name).get_result()
+    # the form comes from the saved entity, without reading it back
+    return copySessionToForm(sess, {sess.speakerKey: speaker_name})
+
+
+@ndb.tasklet
+def _createSessionAsync(s_parent, data, s_ids, speaker, speaker_name):
+    """Save a new session from its fields, once the futures of its id and
+    of its speaker lookup are done. A new speaker is saved first."""
+    tasks = []
+    if speaker:
+        speaker = yield speaker
+        if speaker:
+            data['speakerKey'] = speaker.key
         else:
-            data['speakerId'] = speaker.key.urlsafe()
-    del data['speaker']
-
-    c_key = conf.key
-    s_id = models.Session.allocate_ids(size=1, parent=c_key)[0]
-    s_key = ndb.Key(models.Session, s_id, parent=c_key)
-    data['key'] = s_key
-
-    models.Session(**data).put()
-    if data['speakerId']:
-        taskqueue.add(params={
-                'conferenceKey': c_key.urlsafe(),
-                'speakerKey': data['speakerId']
+            # overlaps the allocation of the session id
+            data['speakerKey'] = yield models.Speaker(
+                name=speaker_name).put_async()
+            tasks.append(process.autocomplete.updateTask(
+                process.autocomplete.SPEAKER, added=[speaker_name]))
+
+    s_id, _ = yield s_ids
+    data['key'] = ndb.Key(models.Session, s_id, parent=s_parent)
+    sess = models.Session(**data)
+    if sess.speakerKey:
+        tasks.append(taskqueue.Task(params={
+                'conferenceKey': sess.conferenceKey.urlsafe(),
+                'speakerKey': sess.speakerKey.urlsafe()
             },
             url='/tasks/set_featured_speaker'
-        )
-    return copySessionToForm(s_key.get())
+        ))
+    yield saveSessionAsync(sess, filter(None, tasks))
+    raise ndb.Return(sess)
+
+
+def getSessionsByKeys(websafeSessionKeys):
+    """Return the SessionForms of sessions in the order of their websafe
+    keys, with a single get_multi for the sessions and one for the speakers
+    not cached. Missing sessions have notFound set.
+    """
+    if len(websafeSessionKeys) > process.conferences.MAX_BATCH_KEYS:
+        raise endpoints.BadRequestException(
+            'At most %d keys per request' %
+            process.conferences.MAX_BATCH_KEYS)
+    keys = utils.keysFromWebsafe(websafeSessionKeys, 'Session')
+    sessions = utils.getMultiByKeys(keys)
+    names = getSpeakerNames(
+        [speakerKeyOf(sess) for sess in sessions.values() if sess])
+
+    items = []
+    for wssk, s_key in zip(websafeSessionKeys, keys):
+        sess = sessions.get(s_key)
+        if sess:
+            items.append(copySessionToForm(sess, names))
+        else:
+            items.append(models.SessionForm(websafeKey=wssk, notFound=True))
+    return models.SessionForms(items=items)
+
+
+def deleteSessionObject(request):
+    """Delete a session of a conference of the user, leaving a tombstone
+    for the clients to sync. Returns BooleanMessage."""
+    user = endpoints.get_current_user()
+    if not user:
+        raise endpoints.UnauthorizedException('Authorization required')
+    user_id = utils.getUserId(user)
+
+    s_key = utils.keysFromWebsafe([request.websafeSessionKey], 'Session')[0]
+    sess = s_key.get() if s_key else None
+    if not sess:
+        raise endpoints.NotFoundException(
+            'No session found with key: %s' % request.websafeSessionKey)
+    c_key = conferenceKeyOf(sess)
+    conf = getConference(c_key)
+    if not conf or user_id != conf.organizerUserId:
+        raise endpoints.ForbiddenException(
+            'Only the owner can delete a session.')
+
+    _removeSession(s_key, c_key, sess.typeOfSession, speakerKeyOf(sess))
+    return models.BooleanMessage(data=True)
+
+
+@ndb.transactional(xg=True)
+def _removeSession(s_key, c_key, typeOfSession, sp_key):
+    # a root session is in an entity group of its own
+    conf = c_key.get()
+    process.conferences.touchSessions(conf)
+    conf.put()
+    s_key.delete()
+    process.sync.newTombstone(s_key, conf.key).put()
+    if s_key.parent():
+        process.stats.addSession(conf.key, typeOfSession, sp_key, -1)
+    else:
+        # the count of a root session may still be queued, its removal is
+        # queued after it
+        taskqueue.Queue(process.stats.STATS_QUEUE).add(
+            process.stats.sessionDeltaTask(
+                conf.key, typeOfSession, sp_key, -1),
+            transactional=True)
+
+
+@ndb.tasklet
+def saveSessionAsync(sess, tasks):
+    """Save a new Session, counting it on the stats of its conference and
+    bumping the conference version, and queue its tasks."""
+    if sess.key.parent():
+        yield _saveChildSessionAsync(sess, tasks)
+    else:
+        yield _saveRootSessionAsync(sess, tasks)
+        bumpScheduleGeneration(sess.conferenceKey)
+
+
+@ndb.transactional_tasklet()
+def _saveChildSessionAsync(sess, tasks):
+    """The conference and its stats are read in one batch and written with
+    the session in another."""
+    c_key = sess.conferenceKey
+    conf, stats = yield ndb.get_multi_async(
+        [c_key, process.stats.statsKey(c_key)])
+    stats = stats or process.stats.newStats(c_key)
+    process.conferences.touchSessions(conf)
+    process.stats.countSession(stats, sess.typeOfSession, sess.speakerKey)
+    # the tasks are only queued if the session is saved; they are sent
+    # while the entities are put
+    rpc = None
+    if tasks:
+        rpc = taskqueue.Queue().add_async(tasks, transactional=True)
+    yield ndb.put_multi_async([sess, conf, stats])
+    if rpc:
+        rpc.get_result()
+
+
+@ndb.transactional_tasklet()
+def _saveRootSessionAsync(sess, tasks):
+    """Only the session is written; its count on the stats and the version
+    bump of its conference are buffered like the wishlist additions, and
+    applied by the stats cron job."""
+    rpcs = [taskqueue.Queue(process.stats.STATS_QUEUE).add_async(
+        process.stats.sessionDeltaTask(
+            sess.conferenceKey, sess.typeOfSession, sess.speakerKey),
+        transactional=True)]
+    if tasks:
+        rpcs.append(taskqueue.Queue().add_async(tasks, transactional=True))
+    yield sess.put_async()
+    for rpc in rpcs:
+        rpc.get_result()
 
 
 def getQuery(request):
@@ -1,46 +1,163 @@
 # coding: utf-8
 
-from google.appengine.api import memcache
+import endpoints
 from google.appengine.ext import ndb
 
+import cache
 import models
+import process.conferences
+import process.sessions
+import process.stats
+import settings
+import utils
 
 
+# the latest featured speaker of any conference; the featured speaker of
+# each conference is cached under the websafe key of the conference
 MEMCACHE_FEATURED_SPEAKER_KEY = "FEATURED_SPEAKER"
+FEATURED_SPEAKER_TPL = 'Featured Speaker on %s conference: %s on sessions %s'
+
+# the session tasks set the featured speakers; an evicted or expired one
+# of a conference is recomputed from its stats
+FEATURED_SPEAKER_TTL = 24 * 60 * 60
+FEATURED_SPEAKER_STALE = 60 * 60
+
+featuredSpeakerCache = cache.ComputedCache(
+    'speakers', ttl=FEATURED_SPEAKER_TTL, stale=FEATURED_SPEAKER_STALE)
+
+
+def formatFeature(conference, name, sessions):
+    """Return the featured speaker text of a speaker of a conference."""
+    return FEATURED_SPEAKER_TPL % (
+        conference.name, name,
+        ', '.join(session.name for session in sessions)
+    )
+
+
+def featuredSpeakerOf(sessionsBySpeaker):
+    """Return the websafe key of the featured speaker of a conference from
+    its session counts by speaker: the speaker with the most sessions, if
+    more than one, the greatest key on a tie. None if there is none."""
+    if not sessionsBySpeaker:
+        return None
+    total_sessions, wsspk = max(
+        (total, wsspk) for wsspk, total in sessionsBySpeaker.items())
+    return wsspk if total_sessions > 1 else None
 
 
 def cacheSpeaker(request):
-    """Save featured Speaker in memcache. Used on a task queue."""
+    """Save featured Speaker of a conference in the cache.
+    Used on a task queue.
+    """
     # get the conference and speaker keys for the recently added session
-    c_key = request.get('conferenceKey')
-    sp_key = request.get('speakerKey')
+    c_key = ndb.Key(urlsafe=request.get('conferenceKey'))
+    sp_key = ndb.Key(urlsafe=request.get('speakerKey'))
 
-    conference = ndb.Key(urlsafe=c_key).get()
-    speaker = ndb.Key(urlsafe=sp_key).get()
+    conference, stats, speaker = ndb.get_multi([
+        c_key, process.stats.statsKey(c_key), sp_key
+    ])
 
     # if no speaker is selected, return an empty string and finish the task
-    if not speaker:
+    if not conference or not speaker:
         return ''
 
-    # get all the sessions for the conference
-    sessions = models.Session.query(ancestor=conference.key)
-
-    # get the total number of sessions of the current speaker in the conference
-    total_sessions = 0
-    session_names = []
-    for session in sessions:
-        if session.speakerId == sp_key:
-            total_sessions += 1
-            session_names.append(session.name)
-
-    # if the total number of sessions is greater than 1, the speaker is
-    # selected as the featured speaker
-    if total_sessions > 1:
-        feature = 'Featured Speaker on %s conference: %s on sessions %s' % (
-            conference.name, speaker.name, ', '.join(session_names)
-        )
-        memcache.set(MEMCACHE_FEATURED_SPEAKER_KEY, feature)
-    else:
-        feature = ''
+    # the stats already count the sessions of every speaker in the
+    # conference, so only the sessions of the featured speaker are queried
+    counts = dict(stats.sessionsBySpeaker or {}) if stats else {}
+    sessions = None
+    if settings.ROOT_SESSIONS:
+        # the stats of root sessions are applied later by the cron job,
+        # count the sessions of the speaker instead
+        sessions = process.sessions.querySpeakerSessions(
+            sp_key, c_key).fetch()
+        counts[sp_key.urlsafe()] = len(sessions)
 
+    # the featured speaker is the one buildFeaturedSpeakers() finds, which
+    # may be another speaker than the one of the new session
+    wsspk = featuredSpeakerOf(counts)
+    if not wsspk:
+        return ''
+    if wsspk != sp_key.urlsafe():
+        sp_key = ndb.Key(urlsafe=wsspk)
+        speaker = sp_key.get()
+        sessions = None
+        if not speaker:
+            return ''
+    if sessions is None:
+        sessions = process.sessions.querySpeakerSessions(
+            sp_key, c_key).fetch()
+    feature = formatFeature(conference, speaker.name, sessions)
+    featuredSpeakerCache.set_multi({
+        c_key.urlsafe(): feature,
+        MEMCACHE_FEATURED_SPEAKER_KEY: feature,
+    })
     return feature
+
+
+def buildFeaturedSpeakers(websafeConferenceKeys):
+    """Return a dict of the featured speakers of conferences from their
+    stats, see featuredSpeakerOf(), or an empty string. The conferences and stats are read with one get_multi
+    and the sessions of the speakers queried at the same time. Keys of no
+    conference are left out, so they are never cached."""
+    c_keys = dict(
+        (wsck, c_key) for wsck, c_key in zip(
+            websafeConferenceKeys,
+            utils.keysFromWebsafe(websafeConferenceKeys, 'Conference'))
+        if c_key)
+    entities = ndb.get_multi(
+        [c_key for c_key in c_keys.values()] +
+        [process.stats.statsKey(c_key) for c_key in c_keys.values()])
+    found = zip(c_keys, entities[:len(c_keys)], entities[len(c_keys):])
+
+    features = {}
+    speakers = {}
+    for wsck, conference, stats in found:
+        if not conference:
+            continue
+        features[wsck] = ''
+        wsspk = featuredSpeakerOf(stats and stats.sessionsBySpeaker)
+        sp_key = wsspk and utils.keysFromWebsafe([wsspk], 'Speaker')[0]
+        if sp_key:
+            speakers[wsck] = (conference, sp_key)
+
+    names = process.sessions.getSpeakerNames(
+        [sp_key for _, sp_key in speakers.values()])
+    queries = dict(
+        (wsck, process.sessions.querySpeakerSessions(
+            sp_key, conference.key).fetch_async())
+        for wsck, (conference, sp_key) in speakers.items()
+        if names.get(sp_key))
+    for wsck, future in queries.items():
+        conference, sp_key = speakers[wsck]
+        features[wsck] = formatFeature(
+            conference, names[sp_key], future.get_result())
+    return features
+
+
+def getFeaturedSpeaker(websafeConferenceKey=None):
+    """Return the cached Featured Speaker of a conference, or the latest
+    one of any conference."""
+    if not websafeConferenceKey:
+        return featuredSpeakerCache.get(MEMCACHE_FEATURED_SPEAKER_KEY) or ""
+    return featuredSpeakerCache.get(
+        websafeConferenceKey,
+        loader=lambda: buildFeaturedSpeakers(
+            [websafeConferenceKey]).get(websafeConferenceKey)) or ""
+
+
+def getFeaturedSpeakers(websafeConferenceKeys):
+    """Return the Featured Speakers of several conferences at once."""
+    if len(websafeConferenceKeys) > process.conferences.MAX_BATCH_KEYS:
+        raise endpoints.BadRequestException(
+            'At most %d keys per request' %
+            process.conferences.MAX_BATCH_KEYS)
+    features = featuredSpeakerCache.get_multi(
+        websafeConferenceKeys, loader=buildFeaturedSpeakers)
+    return models.FeaturedSpeakerForms(
+        items=[
+            models.FeaturedSpeakerForm(
+                websafeConferenceKey=wsck,
+                data=features.get(wsck) or ""
+            ) for wsck in websafeConferenceKeys
+        ]
+    )
@@ -0,0 +1,225 @@
+# coding: utf-8
+
+import collections
+import json
+
+import endpoints
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import models
+import process.conferences
+import process.registrations
+import process.sessions
+import settings
+import utils
+
+
+# pull queue buffering the wishlist additions and the sessions of root
+# layout until they are flushed
+STATS_QUEUE = 'stats-deltas'
+# payloads of the session deltas; the others are websafe session keys
+SESSION_DELTA_PREFIX = 'session:'
+DELTA_LEASE_SECONDS = 60
+DELTA_BATCH_SIZE = 1000
+# maximum number of batches applied by a single flush
+DELTA_MAX_BATCHES = 20
+
+
+def statsKey(c_key):
+    """Return the ConferenceStats key of a conference."""
+    return ndb.Key(models.ConferenceStats, 1, parent=c_key)
+
+
+def newStats(c_key):
+    """Return new (unsaved) ConferenceStats of a conference."""
+    return models.ConferenceStats(key=statsKey(c_key))
+
+
+def _getOrCreate(c_key):
+    return statsKey(c_key).get() or newStats(c_key)
+
+
+def _increment(counts, name, delta=1):
+    """Return a copy of a counts dict with name incremented by delta."""
+    counts = dict(counts or {})
+    counts[name] = counts.get(name, 0) + delta
+    if counts[name] <= 0:
+        del counts[name]
+    return counts
+
+
+def countSession(stats, typeOfSession, sp_key, delta=1):
+    """Count a new session on the (unsaved) stats of its conference, or a
+    deleted one with a delta of -1. The sessions of a speaker are counted
+    under the websafe key of the speaker, which a rename doesn't change."""
+    stats.sessions = max(stats.sessions + delta, 0)
+    if typeOfSession:
+        stats.sessionsByType = _increment(
+            stats.sessionsByType, typeOfSession, delta)
+    if sp_key:
+        stats.sessionsBySpeaker = _increment(
+            stats.sessionsBySpeaker, sp_key.urlsafe(), delta)
+
+
+@ndb.transactional(propagation=ndb.TransactionOptions.ALLOWED)
+def addSession(c_key, typeOfSession, sp_key, delta=1):
+    """Count a new session of a conference, or a deleted one with a
+    delta of -1."""
+    stats = _getOrCreate(c_key)
+    countSession(stats, typeOfSession, sp_key, delta)
+    stats.put()
+
+
+@ndb.transactional(propagation=ndb.TransactionOptions.ALLOWED)
+def addRegistrations(c_key, delta):
+    """Add delta to the registrations of a conference. Joins the ongoing
+    registration transaction; the stats are in the conference entity group.
+    """
+    stats = _getOrCreate(c_key)
+    stats.registrations = max(stats.registrations + delta, 0)
+    stats.put()
+
+
+def queueWishlistAddition(s_key, c_key, name=None):
+    """Record that a session of a conference was added to a wishlist. The
+    delta is buffered on a pull queue, tagged by conference, so the hot path
+    never writes to the conference entity group. A named addition is only
+    queued once.
+    """
+    try:
+        taskqueue.Queue(STATS_QUEUE).add(taskqueue.Task(
+            payload=s_key.urlsafe(),
+            method='PULL',
+            tag=c_key.urlsafe(),
+            name=name
+        ))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def sessionDeltaTask(c_key, typeOfSession, sp_key, delta=1):
+    """Return the (unqueued) pull task of a session added to a conference,
+    or deleted with a delta of -1. Used by the root sessions, which are
+    saved outside the conference entity group."""
+    return taskqueue.Task(
+        payload=SESSION_DELTA_PREFIX + json.dumps(
+            [typeOfSession, sp_key.urlsafe() if sp_key else None, delta]),
+        method='PULL',
+        tag=c_key.urlsafe()
+    )
+
+
+@ndb.transactional()
+def _applyDeltas(c_key, wishlist_counts, session_deltas):
+    stats = _getOrCreate(c_key)
+    to_put = [stats]
+    if wishlist_counts:
+        wishlist = dict(stats.wishlistBySession or {})
+        for wssk, delta in wishlist_counts.items():
+            wishlist[wssk] = wishlist.get(wssk, 0) + delta
+        stats.wishlistBySession = wishlist
+    if session_deltas:
+        for typeOfSession, wsspk, delta in session_deltas:
+            countSession(stats, typeOfSession,
+                         ndb.Key(urlsafe=wsspk) if wsspk else None, delta)
+        # the sessions changed, and so does the ETag of the schedule
+        conf = c_key.get()
+        if conf:
+            process.conferences.touchSessions(conf)
+            to_put.append(conf)
+    ndb.put_multi(to_put)
+
+
+def flushDeltas():
+    """Apply the buffered wishlist additions and root session deltas, one
+    transaction per batch of a conference. Used by the stats cron job.
+    """
+    queue = taskqueue.Queue(STATS_QUEUE)
+    for _ in range(DELTA_MAX_BATCHES):
+        # leases the tasks sharing the tag of the oldest task
+        tasks = queue.lease_tasks_by_tag(
+            DELTA_LEASE_SECONDS, DELTA_BATCH_SIZE)
+        if not tasks:
+            break
+        counts = collections.Counter()
+        sessions = []
+        for task in tasks:
+            if task.payload.startswith(SESSION_DELTA_PREFIX):
+                sessions.append(
+                    json.loads(task.payload[len(SESSION_DELTA_PREFIX):]))
+            else:
+                counts[task.payload] += 1
+        _applyDeltas(ndb.Key(urlsafe=tasks[0].tag), counts, sessions)
+        queue.delete_tasks(tasks)
+
+
+def recountStats(c_key):
+    """Count the sessions and registrations of a conference again,
+    replacing its stats. The wishlist counts are cleared for the
+    recountWishlists mapper to add again. Root sessions are queried
+    before the transaction: flush the stats queue first, or their queued
+    deltas are counted twice."""
+    sessions = None
+    if settings.ROOT_SESSIONS:
+        sessions = process.sessions.querySessions(c_key).fetch()
+    _saveRecount(c_key, sessions)
+
+
+@ndb.transactional()
+def _saveRecount(c_key, sessions):
+    if sessions is None:
+        # children of the conference, counted in its entity group
+        sessions = process.sessions.querySessions(c_key).fetch()
+    stats = newStats(c_key)
+    for sess in sessions:
+        countSession(stats, sess.typeOfSession,
+                     process.sessions.speakerKeyOf(sess))
+    stats.registrations = process.registrations.countAttendees(c_key)
+    stats.put()
+
+
+def countForms(counts):
+    """Return the CountForms of a counts dict, the largest first."""
+    return [
+        models.CountForm(name=name, count=count)
+        for name, count in sorted(
+            (counts or {}).items(), key=lambda item: -item[1])
+    ]
+
+
+def getStats(request):
+    """Return the statistics of a conference with a single get_multi."""
+    c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+    conf, stats = ndb.get_multi([c_key, statsKey(c_key)])
+    if not conf or not isinstance(conf, models.Conference):
+        raise endpoints.NotFoundException(
+            'No conference found with key: %s' % request.websafeConferenceKey)
+    if not stats:
+        stats = models.ConferenceStats(key=statsKey(c_key))
+    # the speakers are counted by key, which tells apart the speakers of
+    # the same name; their names come from the cache
+    by_speaker = stats.sessionsBySpeaker or {}
+    sp_keys = utils.keysFromWebsafe(list(by_speaker), 'Speaker')
+    names = process.sessions.getSpeakerNames(sp_keys)
+    speakers = [
+        models.CountForm(
+            name=names[sp_key], count=count, websafeKey=sp_key.urlsafe())
+        for sp_key, count in sorted(
+            zip(sp_keys, by_speaker.values()), key=lambda item: -item[1])
+        if names.get(sp_key)
+    ]
+
+    fill_rate = 0.0
+    if conf.maxAttendees:
+        fill_rate = float(stats.registrations) / conf.maxAttendees
+
+    return models.ConferenceStatsForm(
+        registrations=stats.registrations,
+        maxAttendees=conf.maxAttendees,
+        fillRate=fill_rate,
+        sessions=stats.sessions,
+        sessionsByType=countForms(stats.sessionsByType),
+        sessionsBySpeaker=speakers,
+        wishlistBySession=countForms(stats.wishlistBySession)
+    )
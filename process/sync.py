@@ -0,0 +1,145 @@
+# coding: utf-8
+
+import calendar
+from datetime import datetime, timedelta
+
+import endpoints
+from google.appengine.ext import ndb
+
+import models
+import process.conferences
+import process.profiles
+import process.registrations
+import process.sessions
+import utils
+
+
+# entities are stamped when they are put, not when the transaction commits,
+# so a sync also returns the changes stamped shortly before its token
+SYNC_OVERLAP = timedelta(seconds=30)
+# tombstones are kept this long; older tokens get a full sync
+TOMBSTONE_TTL = timedelta(days=30)
+PURGE_BATCH_SIZE = 500
+
+
+def encodeToken(when):
+    """Return the sync token of a UTC datetime: microseconds since epoch."""
+    return str(calendar.timegm(when.utctimetuple()) * 1000000 +
+               when.microsecond)
+
+
+def decodeToken(token):
+    try:
+        micros = int(token)
+    except ValueError:
+        raise endpoints.BadRequestException('Invalid syncToken: %s' % token)
+    return datetime.utcfromtimestamp(micros // 1000000) + timedelta(
+        microseconds=micros % 1000000)
+
+
+def newTombstone(key, parent):
+    """Return an (unsaved) Tombstone of a deleted entity, stored in the
+    entity group of parent."""
+    return models.Tombstone(
+        parent=parent, websafeKey=key.urlsafe(), kind=key.kind())
+
+
+def _deletedSince(ancestor, since):
+    return models.Tombstone.query(
+        models.Tombstone.deleted > since, ancestor=ancestor).fetch_async()
+
+
+def syncSchedule(request):
+    """Return the changes to the conferences the user attends (plus the
+    ones of websafeConferenceKeys) and their sessions since syncToken.
+    Without a token, or with an expired one, everything is returned.
+    """
+    prof = process.profiles.getProfileFromUser()
+    now = datetime.utcnow()
+    since = None
+    reset = False
+    if request.syncToken:
+        since = decodeToken(request.syncToken) - SYNC_OVERLAP
+        if since < now - TOMBSTONE_TTL:
+            since = None
+            reset = True
+
+    attending = set(prof.conferencesToAttend)
+    c_keys = list(attending.union(
+        c_key for c_key in utils.keysFromWebsafe(
+            request.websafeConferenceKeys, 'Conference') if c_key))
+    confs = utils.getMultiByKeys(c_keys)
+    # the conferences joined since the last sync are sent whole
+    joined = set()
+    if since:
+        regs = utils.getMultiByKeys([
+            process.registrations.registrationKey(c_key, prof.key.id())
+            for c_key in attending
+        ])
+        joined = set(
+            reg.key.parent() for reg in regs.values()
+            if reg and reg.registered > since)
+
+    # one query per conference for its changes, run in parallel
+    changed = []
+    session_futures = []
+    tombstone_futures = []
+    for c_key in c_keys:
+        conf = confs.get(c_key)
+        if not conf:
+            continue
+        sessions = process.sessions.querySessions(c_key)
+        if since and c_key not in joined:
+            if conf.modified and conf.modified > since:
+                changed.append(conf)
+            sessions = sessions.filter(models.Session.modified > since)
+            tombstone_futures.append(_deletedSince(c_key, since))
+        else:
+            changed.append(conf)
+        session_futures.append(sessions.fetch_async())
+    if since:
+        # the conferences the user left
+        tombstone_futures.append(_deletedSince(prof.key, since))
+
+    sessions = [sess for f in session_futures for sess in f.get_result()]
+    # a conference left and joined again is only returned as changed
+    attending_wscks = set(c_key.urlsafe() for c_key in attending)
+    tombstones = [
+        t for f in tombstone_futures for t in f.get_result()
+        if t.websafeKey not in attending_wscks
+    ]
+
+    profiles = utils.getMultiByKeys([conf.key.parent() for conf in changed])
+    names = process.sessions.getSpeakerNames(
+        [process.sessions.speakerKeyOf(sess) for sess in sessions])
+    return models.SyncForm(
+        conferences=[
+            process.conferences.copyConferenceToForm(
+                conf, getattr(profiles.get(conf.key.parent()),
+                              'displayName', None))
+            for conf in changed
+        ],
+        sessions=[
+            process.sessions.copySessionToForm(sess, names)
+            for sess in sessions
+        ],
+        deleted=[
+            models.TombstoneForm(websafeKey=t.websafeKey, kind=t.kind)
+            for t in tombstones
+        ],
+        syncToken=encodeToken(now),
+        reset=reset
+    )
+
+
+def purgeTombstones():
+    """Delete the tombstones older than any valid sync token.
+    Used by a cron job.
+    """
+    expired = models.Tombstone.query(
+        models.Tombstone.deleted < datetime.utcnow() - TOMBSTONE_TTL)
+    while True:
+        keys = expired.fetch(PURGE_BATCH_SIZE, keys_only=True)
+        if not keys:
+            return
+        ndb.delete_multi(keys)
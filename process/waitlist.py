@@ -0,0 +1,122 @@
+# coding: utf-8
+
+import endpoints
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import models
+import process.conferences
+import process.profiles
+import process.stats
+
+
+# an XG transaction may touch 25 entity groups: the conference plus one
+# profile (holding its waitlist entry) per promoted user
+PROMOTE_BATCH_SIZE = 20
+
+
+def waitlistKey(p_key, wsck):
+    """Return the WaitlistEntry key of a profile for a conference."""
+    return ndb.Key(models.WaitlistEntry, wsck, parent=p_key)
+
+
+def joinWaitlist(request):
+    """Add the user to the waitlist of a conference. Returns BooleanMessage.
+
+    The entry lives in the entity group of the user Profile, so joining
+    doesn't contend with the registrations on the conference.
+    """
+    prof = process.profiles.getProfileFromUser()
+
+    wsck = request.websafeConferenceKey
+    conf = ndb.Key(urlsafe=wsck).get()
+    if not conf or not isinstance(conf, models.Conference):
+        raise endpoints.NotFoundException(
+            'No conference found with key: %s' % wsck)
+
+    if conf.key in prof.conferencesToAttend:
+        raise models.ConflictException(
+            "You have already registered for this conference")
+
+    w_key = waitlistKey(prof.key, wsck)
+    if w_key.get():
+        return models.BooleanMessage(data=False)
+    models.WaitlistEntry(key=w_key, conferenceKey=conf.key).put()
+
+    # a seat may have been freed since the user saw the conference full
+    if conf.seatsAvailable > 0:
+        taskqueue.add(params={'conferenceKey': wsck},
+            url='/tasks/promote_waitlist'
+        )
+    return models.BooleanMessage(data=True)
+
+
+def leaveWaitlist(request):
+    """Remove the user from the waitlist of a conference."""
+    prof = process.profiles.getProfileFromUser()
+    w_key = waitlistKey(prof.key, request.websafeConferenceKey)
+    if not w_key.get():
+        return models.BooleanMessage(data=False)
+    w_key.delete()
+    return models.BooleanMessage(data=True)
+
+
+@ndb.transactional(xg=True)
+def _promoteBatch(c_key, w_keys):
+    """Register the waitlisted users of w_keys, in order, while there are
+    seats available. Returns the number of seats left.
+    """
+    conf = c_key.get()
+    if not conf or conf.seatsAvailable <= 0:
+        return 0
+
+    entries = ndb.get_multi(w_keys)
+    profiles = [
+        process.profiles.upgradeProfile(prof) for prof in
+        ndb.get_multi([w_key.parent() for w_key in w_keys])
+    ]
+
+    to_put = []
+    to_delete = []
+    promoted = 0
+    for w_key, entry, prof in zip(w_keys, entries, profiles):
+        if conf.seatsAvailable <= 0:
+            break
+        # the user left the waitlist since the query ran
+        if not entry:
+            continue
+        to_delete.append(w_key)
+        if not prof or c_key in prof.conferencesToAttend:
+            continue
+        to_put.append(process.conferences.takeSeat(conf, prof))
+        to_put.append(prof)
+        promoted += 1
+
+    if promoted:
+        process.conferences.touch(conf)
+    to_put.append(conf)
+    ndb.put_multi(to_put)
+    ndb.delete_multi(to_delete)
+    if promoted:
+        process.stats.addRegistrations(c_key, promoted)
+    return conf.seatsAvailable
+
+
+def promoteWaitlist(request):
+    """Hand the free seats of a conference to its waitlist in FIFO order.
+    Used on a task queue.
+    """
+    c_key = ndb.Key(urlsafe=request.get('conferenceKey'))
+    query = models.WaitlistEntry.query(
+        models.WaitlistEntry.conferenceKey == c_key
+    ).order(models.WaitlistEntry.joined)
+
+    cursor = None
+    more = True
+    while more:
+        w_keys, cursor, more = query.fetch_page(
+            PROMOTE_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        if not w_keys:
+            break
+        if _promoteBatch(c_key, w_keys) <= 0:
+            break
@@ -0,0 +1,47 @@
+# coding: utf-8
+
+from datetime import date
+
+from google.appengine.ext import ndb
+
+import models
+import process.announcements
+import process.sessions
+import process.speakers
+
+
+# number of upcoming conferences whose schedules are primed on warmup
+WARMUP_CONFERENCES = 10
+
+
+def primeSchedules(limit=WARMUP_CONFERENCES):
+    """Load the sessions of the next conferences through ndb, so the
+    entities are in memcache before the first request asks for them.
+    """
+    conf_keys = models.Conference.query(
+        models.Conference.startDate >= date.today()
+    ).order(models.Conference.startDate).fetch(limit, keys_only=True)
+
+    futures = [
+        process.sessions.querySessions(c_key).order(
+            models.Session.startTime).fetch_async(keys_only=True)
+        for c_key in conf_keys
+    ]
+    s_keys = []
+    for future in futures:
+        s_keys.extend(future.get_result())
+    ndb.get_multi(conf_keys + s_keys)
+    return len(s_keys)
+
+
+def warmup():
+    """Prime the caches of a new instance. Used by the warmup request."""
+    # importing the API module here pays for its import on the warmup
+    # request instead of the first API request of the instance
+    import conference
+
+    # loads the instance caches; a missing announcement is recomputed, while
+    # the featured speaker is only set by the session tasks
+    process.announcements.getAnnouncement()
+    process.speakers.getFeaturedSpeaker()
+    primeSchedules()
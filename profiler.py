@@ -0,0 +1,146 @@
+import cProfile
+from datetime import datetime, timedelta
+import logging
+import marshal
+import pstats
+import random
+import StringIO
+import time
+import zlib
+
+import endpoints
+from google.appengine.api import oauth
+from google.appengine.ext import ndb
+
+from cache import TwoTierCache
+from models import ProfileSample
+from models import ProfilerSettings
+from settings import PROFILE_SAMPLE_RATE
+
+
+# requests with this header are profiled if they come from an admin
+PROFILE_HEADER = 'HTTP_X_PROFILE_REQUEST'
+SPI_PREFIX = '/_ah/spi/'
+# samples merged by a download
+MAX_MERGED_SAMPLES = 500
+# samples are deleted after this many days
+SAMPLE_TTL_DAYS = 7
+PURGE_BATCH_SIZE = 500
+
+_settings = TwoTierCache('profiler', size=10, local_ttl=30)
+
+
+def getSampleRate():
+    """Return the fraction of the requests profiled, set by an admin or
+    PROFILE_SAMPLE_RATE by default."""
+    def load():
+        settings = ndb.Key(ProfilerSettings, 1).get()
+        return settings.sampleRate if settings else PROFILE_SAMPLE_RATE
+    return _settings.get('sampleRate', loader=load)
+
+
+def setSampleRate(rate):
+    """Change the fraction of the requests profiled on every instance."""
+    ProfilerSettings(id=1, sampleRate=rate).put()
+    _settings.set('sampleRate', rate)
+
+
+def _isAdmin():
+    try:
+        return oauth.is_current_user_admin(endpoints.EMAIL_SCOPE)
+    except oauth.Error:
+        return False
+
+
+class ProfilingMiddleware(object):
+    """WSGI middleware running a sample of the API requests under cProfile
+    and saving their stats as a ProfileSample of their method.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def _shouldProfile(self, environ):
+        if environ.get(PROFILE_HEADER) and _isAdmin():
+            return True
+        rate = getSampleRate()
+        return rate > 0 and random.random() < rate
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(SPI_PREFIX) or not self._shouldProfile(environ):
+            return self.app(environ, start_response)
+
+        profile = cProfile.Profile()
+        start = time.time()
+        # consume the body inside the profile, it may be lazy
+        body = profile.runcall(
+            lambda: list(self.app(environ, start_response)))
+        elapsed = time.time() - start
+        try:
+            profile.create_stats()
+            ProfileSample(
+                # ConferenceApi.getConference -> getConference
+                endpoint=path[len(SPI_PREFIX):].split('.')[-1],
+                wallTime=elapsed * 1000,
+                data=zlib.compress(marshal.dumps(profile.stats))
+            ).put()
+        except Exception:
+            # profiling must never fail the request
+            logging.exception('Could not save the profile of %s', path)
+        return body
+
+
+class _Marshaled(object):
+    """Marshaled stats of a sample, loadable by pstats.Stats."""
+
+    def __init__(self, data):
+        self.stats = marshal.loads(zlib.decompress(data))
+
+    def create_stats(self):
+        pass
+
+
+def countSamples():
+    """Return a dict of the number of samples per endpoint."""
+    counts = {}
+    for sample in ProfileSample.query(projection=[ProfileSample.endpoint]):
+        counts[sample.endpoint] = counts.get(sample.endpoint, 0) + 1
+    return counts
+
+
+def mergeSamples(endpoint):
+    """Return the pstats.Stats merging the latest samples of an endpoint,
+    or None if there are none."""
+    samples = ProfileSample.query(ProfileSample.endpoint == endpoint).order(
+        -ProfileSample.created).fetch(MAX_MERGED_SAMPLES)
+    if not samples:
+        return None
+    merged = pstats.Stats(_Marshaled(samples[0].data))
+    for sample in samples[1:]:
+        merged.add(_Marshaled(sample.data))
+    return merged
+
+
+def dumpStats(stats):
+    """Return the stats in the pstats file format."""
+    return marshal.dumps(stats.stats)
+
+
+def formatStats(stats, sort='cumulative', limit=50):
+    """Return the text report of the stats, sorted by sort."""
+    out = StringIO.StringIO()
+    stats.stream = out
+    stats.sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+
+def purgeSamples():
+    """Delete the samples older than SAMPLE_TTL_DAYS. Used by a cron job."""
+    cutoff = datetime.utcnow() - timedelta(days=SAMPLE_TTL_DAYS)
+    query = ProfileSample.query(ProfileSample.created < cutoff)
+    while True:
+        keys = query.fetch(PURGE_BATCH_SIZE, keys_only=True)
+        if not keys:
+            return
+        ndb.delete_multi(keys)
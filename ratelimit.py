@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""ratelimit.py
+
+Udacity conference server-side Python App Engine per user rate limits of
+the API methods, as token buckets in memcache
+
+"""
+
+import functools
+import math
+import threading
+import time
+
+import endpoints
+from google.appengine.api import memcache
+
+from models import TooManyRequestsException
+from settings import RATE_LIMITS
+from utils import getUserId
+
+
+MEMCACHE_RATELIMIT_PREFIX = 'RATELIMIT'
+# maximum number of buckets remembered by this instance
+LOCAL_BUCKETS_SIZE = 10000
+
+# bucket -> time until which this instance rejects the bucket without
+# asking memcache; and bucket -> last refill tick done by this instance
+_blocked = {}
+_refilled = {}
+
+# Endpoints v1 answers the HTTP status codes it doesn't support, 429
+# included, with a 404; the rejected requests are marked here for
+# RateLimitMiddleware to set their status
+TOO_MANY_REQUESTS = '429 Too Many Requests'
+_rejection = threading.local()
+
+
+def _bucketKey(method, user_id):
+    return '%s:%s:%s' % (MEMCACHE_RATELIMIT_PREFIX, method, user_id)
+
+
+def _refill(bucket, burst, interval, ttl, now):
+    """Give back the tokens earned since the last refill of the bucket.
+
+    The bucket stores the number of tokens used, so refilling is an atomic
+    decr that memcache floors at 0, i.e. a full bucket. The refill from
+    the last refill tick is guarded by an add on that tick, so a single
+    request gives the tokens back before moving the last refill tick on.
+    """
+    tick = int(now / interval)
+    if _refilled.get(bucket) == tick:
+        return
+    if len(_refilled) >= LOCAL_BUCKETS_SIZE:
+        _refilled.clear()
+    _refilled[bucket] = tick
+
+    last_key = bucket + ':last'
+    last = memcache.get(last_key)
+    if last is None:
+        # a new or evicted bucket earns its tokens from now on
+        memcache.add(last_key, tick, time=ttl)
+        return
+    if tick <= last or not memcache.add(
+            '%s:%d' % (bucket, last), 1, time=ttl):
+        return
+    memcache.decr(bucket, delta=min(tick - last, burst))
+    memcache.set(last_key, tick, time=ttl)
+
+
+def takeToken(method, user_id):
+    """Take a token from the bucket of a user for a method.
+    Returns False when the bucket is empty.
+    """
+    burst, seconds = RATE_LIMITS[method]
+    # seconds needed to earn back a single token
+    interval = float(seconds) / burst
+    # the keys of a bucket expire once a full bucket is earned back
+    ttl = int(math.ceil(seconds)) + 1
+    bucket = _bucketKey(method, user_id)
+    now = time.time()
+
+    # fast path: this instance already knows the bucket is empty
+    if _blocked.get(bucket, 0) > now:
+        return False
+
+    _refill(bucket, burst, interval, ttl, now)
+    used = memcache.incr(bucket)
+    if used is None:
+        # a new bucket, unless another request just added it
+        used = (1 if memcache.add(bucket, 1, time=ttl)
+                else memcache.incr(bucket))
+    # memcache unavailable, don't block the user
+    if used is None:
+        return True
+    if used > burst:
+        # the token wasn't taken, give it back
+        memcache.decr(bucket)
+        if len(_blocked) >= LOCAL_BUCKETS_SIZE:
+            _blocked.clear()
+        _blocked[bucket] = now + interval
+        return False
+    return True
+
+
+def limited(func):
+    """Decorate an API method to enforce the per user RATE_LIMITS budget
+    of the method, raising TooManyRequestsException when exceeded.
+    """
+    method = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self, request):
+        user = endpoints.get_current_user()
+        # unauthenticated requests are rejected by the method itself
+        if user and not takeToken(method, getUserId(user)):
+            burst, seconds = RATE_LIMITS[method]
+            # seconds needed to earn back a single token
+            retry_after = int(math.ceil(float(seconds) / burst))
+            _rejection.retry_after = retry_after
+            raise TooManyRequestsException(
+                'Too many requests, please try again in %d seconds.' %
+                retry_after)
+        return func(self, request)
+    return wrapper
+
+
+class RateLimitMiddleware(object):
+    """WSGI middleware in front of the API server answering the requests
+    rejected by limited() with a 429 status and a Retry-After header,
+    keeping the error body of the API server.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        _rejection.retry_after = None
+        response = []
+        body = []
+
+        def capture(status, headers, exc_info=None):
+            response[:] = [status, headers, exc_info]
+            return body.append
+
+        body.extend(self.app(environ, capture))
+        status, headers, exc_info = response
+        retry_after = _rejection.retry_after
+        if retry_after is not None:
+            _rejection.retry_after = None
+            status = TOO_MANY_REQUESTS
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != 'retry-after']
+            headers.append(('Retry-After', str(retry_after)))
+        start_response(status, headers, exc_info)
+        return body
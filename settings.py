@@ -16,3 +16,30 @@ WEB_CLIENT_ID = '212316937539-vepc5s86ajg7avav462kd163udo9lrcd.apps.googleuserco
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Per user rate limits of the write endpoints, as (burst, seconds): a user
+# may call the method `burst` times in a row and gets `burst` new calls every
+# `seconds` seconds.
+RATE_LIMITS = {
+    'registerForConference': (10, 60),
+    'requestRegistration': (10, 60),
+    'addSessionToWishlist': (30, 60),
+    'createSession': (20, 60),
+}
+
+# Layout of the new sessions. False saves them as children of their
+# conference; True saves them as root entities found by their conferenceKey,
+# so session writes don't share the entity group of the conference and its
+# organizer. Run the stampSessionConferences mapper before switching it on.
+ROOT_SESSIONS = False
+
+# Types a session may have, lower case. filterSessions turns the types it
+# doesn't exclude into a datastore IN filter, which takes at most 30 values.
+# The normalizeSessionTypes mapper moves the sessions of any other type to
+# 'other'.
+SESSION_TYPES = ('talk', 'keynote', 'workshop', 'panel', 'lightning talk',
+                 'tutorial', 'other')
+
+# Fraction of the API requests profiled by profiler.py, until an admin
+# changes it on /admin/profiles.
+PROFILE_SAMPLE_RATE = 0.0
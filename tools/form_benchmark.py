@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+"""form_benchmark.py -- compare the compiled form plans with the old
+field-by-field converters
+
+Copies in-memory entities to forms with both implementations, on the
+App Engine testbed. Run it from the app directory:
+
+    python tools/form_benchmark.py --sdk /path/to/google_appengine
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import timeit
+
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setupSdk(sdk):
+    """Put the SDK and the app on the path and activate the testbed."""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    return bed
+
+
+# - - - converters before the compiled plans - - - - - - - - - - - - -
+
+def legacyConferenceToForm(models, conf, displayName):
+    cf = models.ConferenceForm()
+    for field in cf.all_fields():
+        if hasattr(conf, field.name):
+            if field.name.endswith('Date'):
+                setattr(cf, field.name, str(getattr(conf, field.name)))
+            else:
+                setattr(cf, field.name, getattr(conf, field.name))
+        elif field.name == "websafeKey":
+            setattr(cf, field.name, conf.key.urlsafe())
+    if displayName:
+        setattr(cf, 'organizerDisplayName', displayName)
+    cf.check_initialized()
+    return cf
+
+
+def legacySessionToForm(models, sess):
+    session = models.SessionForm()
+    for field in session.all_fields():
+        if hasattr(sess, field.name):
+            if field.name == 'date':
+                setattr(session, field.name, str(getattr(sess, field.name)))
+            else:
+                setattr(session, field.name, getattr(sess, field.name))
+            session.websafeKey = sess.key.urlsafe()
+    session.check_initialized()
+    return session
+
+
+def legacyProfileToForm(models, prof):
+    pf = models.ProfileForm()
+    for field in pf.all_fields():
+        if field.name in ('conferenceKeysToAttend', 'sessionsWishlist'):
+            continue
+        if hasattr(prof, field.name):
+            if field.name == 'teeShirtSize':
+                setattr(pf, field.name,
+                        getattr(models.TeeShirtSize,
+                                getattr(prof, field.name)))
+            else:
+                setattr(pf, field.name, getattr(prof, field.name))
+    pf.conferenceKeysToAttend = [
+        c_key.urlsafe() for c_key in prof.conferencesToAttend]
+    pf.sessionsWishlist = [s_key.urlsafe() for s_key in prof.wishlistKeys]
+    pf.check_initialized()
+    return pf
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def makeEntities(models, ndb, count):
+    p_key = ndb.Key(models.Profile, 'bench@example.com')
+    c_keys = [ndb.Key(models.Conference, i, parent=p_key) for i in (1, 2)]
+    s_keys = [ndb.Key(models.Session, i, parent=c_keys[0]) for i in (1, 2, 3)]
+    prof = models.Profile(
+        key=p_key, displayName='Bench', mainEmail='bench@example.com',
+        teeShirtSize='M_M', conferencesToAttend=c_keys, wishlistKeys=s_keys)
+    confs = []
+    sessions = []
+    for i in range(count):
+        c_key = ndb.Key(models.Conference, i + 1, parent=p_key)
+        confs.append(models.Conference(
+            key=c_key, name='Conference %d' % i, description='Bench',
+            organizerUserId='bench@example.com', topics=['Web', 'Cloud'],
+            city='London', startDate=datetime.date(2016, 6, 1), month=6,
+            endDate=datetime.date(2016, 6, 3), maxAttendees=100,
+            seatsAvailable=50))
+        # no speaker, the speaker lookup is the same in both versions
+        sessions.append(models.Session(
+            key=ndb.Key(models.Session, 1, parent=c_key),
+            name='Session %d' % i, highlights='bench', duration=60,
+            typeOfSession='talk', date=datetime.date(2016, 6, 1),
+            startTime=900))
+    return prof, confs, sessions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sdk', required=True,
+                        help='path of the App Engine Python SDK')
+    parser.add_argument('--entities', type=int, default=1000,
+                        help='entities copied per run')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    bed = setupSdk(args.sdk)
+    from google.appengine.ext import ndb
+    import models
+    import process.conferences
+    import process.profiles
+    import process.sessions
+
+    prof, confs, sessions = makeEntities(models, ndb, args.entities)
+    cases = [
+        ('Conference',
+         lambda: [legacyConferenceToForm(models, c, 'Bench') for c in confs],
+         lambda: [process.conferences.copyConferenceToForm(c, 'Bench')
+                  for c in confs]),
+        ('Session',
+         lambda: [legacySessionToForm(models, s) for s in sessions],
+         lambda: [process.sessions.copySessionToForm(s) for s in sessions]),
+        ('Profile',
+         lambda: [legacyProfileToForm(models, prof) for _ in confs],
+         lambda: [process.profiles.copyProfileToForm(prof) for _ in confs]),
+    ]
+
+    print('%d entities, best of %d runs' % (args.entities, args.runs))
+    for name, legacy, compiled in cases:
+        # both versions must build the same forms
+        assert legacy() == compiled(), name
+        old = min(timeit.repeat(legacy, number=1, repeat=args.runs))
+        new = min(timeit.repeat(compiled, number=1, repeat=args.runs))
+        print('  %-10s legacy %8.1f ms   plan %8.1f ms   %5.1fx' % (
+            name, old * 1000, new * 1000, old / new))
+
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
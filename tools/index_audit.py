@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+
+"""index_audit.py -- derive the minimal index.yaml from the app queries
+
+Lists the shape of every datastore query the app can issue: the endpoint
+and task queries, and every filter combination `utils.getQuery` accepts
+(its fields are read from utils.py). From them it derives the composite
+indexes needed, relying on merge joins: a query with several equality
+filters uses one index per filter, each ending with the same inequality
+and sort orders, instead of one index per combination.
+
+It then compares them with index.yaml, reporting the unused and missing
+indexes, the index rows written per new entity and the indexed properties
+no query uses:
+
+    python tools/index_audit.py
+    python tools/index_audit.py --write      # rewrite index.yaml
+
+Use --no-merge-join for one index per exact query shape. The App Engine
+SDK isn't needed. Add the shape of new queries to QUERIES: the audit
+fails on a function of the app building a query that QUERIES doesn't
+list, and on the QUERIES no function builds any more.
+"""
+
+import argparse
+import ast
+import collections
+import glob
+import itertools
+import os
+import sys
+
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INDEX_FILE = os.path.join(APP_DIR, 'index.yaml')
+
+ASC = 'asc'
+DESC = 'desc'
+
+# property types that are never indexed
+UNINDEXED_TYPES = ('TextProperty', 'BlobProperty', 'JsonProperty',
+                   'PickleProperty', 'LocalStructuredProperty')
+
+# depth of the key path of each kind; ancestor indexes write a row for
+# every ancestor. Sessions are root entities with settings.ROOT_SESSIONS
+KEY_DEPTH = {
+    'Conference': 2,
+    'Session': 3,
+    'Registration': 3,
+    'ConferenceStats': 3,
+    'Tombstone': 3,
+    'WaitlistEntry': 2,
+    'RegistrationTicket': 2,
+}
+
+
+class Query(object):
+    """Shape of a query: the properties it filters and sorts on."""
+
+    def __init__(self, kind, where, equality=(), inequality=None,
+                 orders=(), ancestor=False, projection=()):
+        self.kind = kind
+        self.where = where
+        self.equality = tuple(equality)
+        self.inequality = inequality
+        # (property, direction) pairs
+        self.orders = tuple(
+            order if isinstance(order, tuple) else (order, ASC)
+            for order in orders)
+        self.ancestor = ancestor
+        self.projection = tuple(projection)
+
+    def postfix(self):
+        """Return the properties that end every index of the query: the
+        inequality, the sort orders and the projected properties."""
+        postfix = []
+        if self.inequality and (
+                not self.orders or self.orders[0][0] != self.inequality):
+            postfix.append((self.inequality, ASC))
+        postfix.extend(self.orders)
+        used = set(self.equality) | set(name for name, _ in postfix)
+        postfix.extend((name, ASC) for name in self.projection
+                       if name not in used)
+        return tuple(postfix)
+
+
+# - - - query shapes - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def _readUtilsFields():
+    """Return the properties utils.getQuery may filter on."""
+    with open(os.path.join(APP_DIR, 'utils.py')) as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+                getattr(target, 'id', None) == 'FIELDS'
+                for target in node.targets):
+            return sorted(ast.literal_eval(node.value).values())
+    raise SystemExit('FIELDS not found in utils.py')
+
+
+def readModelProperties():
+    """Return kind -> {indexed property: repeated} from models.py."""
+    with open(os.path.join(APP_DIR, 'models.py')) as f:
+        tree = ast.parse(f.read())
+    kinds = {}
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        props = {}
+        for stmt in node.body:
+            if not (isinstance(stmt, ast.Assign) and
+                    isinstance(stmt.value, ast.Call) and
+                    isinstance(stmt.value.func, ast.Attribute) and
+                    stmt.value.func.attr.endswith('Property')):
+                continue
+            kwargs = dict(
+                (kw.arg, getattr(kw.value, 'id', getattr(
+                    kw.value, 'value', None)))
+                for kw in stmt.value.keywords)
+            indexed = str(kwargs.get('indexed', True)) != 'False'
+            if stmt.value.func.attr in UNINDEXED_TYPES:
+                indexed = False
+            if indexed:
+                props[stmt.targets[0].id] = (
+                    str(kwargs.get('repeated', False)) == 'True')
+        if props:
+            kinds[node.name] = props
+    return kinds
+
+
+# utils.getQuery fields a kind doesn't have, by kind: getQuery rejects
+# their filters, so they need no index
+UNSATISFIABLE = {}
+
+
+def getQueryShapes(kind, where):
+    """Every shape of utils.getQuery: equality filters on any subset of the
+    fields of the kind, at most one inequality field, sorted on it and on
+    name."""
+    props = readModelProperties().get(kind, {})
+    fields = [f for f in _readUtilsFields() if f in props]
+    missing = [f for f in _readUtilsFields() if f not in props]
+    if missing:
+        UNSATISFIABLE[(kind, where)] = missing
+    shapes = []
+    for inequality in [None] + fields:
+        others = [f for f in fields if f != inequality]
+        for size in range(len(others) + 1):
+            for equality in itertools.combinations(others, size):
+                orders = ([inequality] if inequality else []) + ['name']
+                shapes.append(Query(kind, where, equality, inequality,
+                                    orders))
+    return shapes
+
+
+QUERIES = [
+    # Conference
+    Query('Conference', 'getConferencesCreated', ancestor=True),
+    Query('Conference', 'filterPlayground',
+          equality=['city', 'topics', 'month']),
+    Query('Conference', 'announcements.buildAnnouncement',
+          inequality='seatsAvailable', projection=['name']),
+    Query('Conference', 'warmup.primeSchedules',
+          inequality='startDate', orders=['startDate']),
+    Query('Conference', 'autocomplete._inUse',
+          equality=['autocompleteTerms']),
+    Query('Conference', 'migrations.countTermUses',
+          equality=['autocompleteTerms']),
+    Query('Conference', 'facets.recountBatch'),
+    # Session
+    Query('Session', 'getConferenceSessions', ancestor=True,
+          orders=['startTime']),
+    Query('Session', 'getConferenceSessionsByType', ancestor=True,
+          equality=['typeOfSession'], orders=['startTime']),
+    Query('Session', 'getSessionsBySpeaker', equality=['speakerKey'],
+          orders=['startTime']),
+    Query('Session', 'getSessionsBySpeaker', equality=['speakerId'],
+          orders=['startTime']),
+    Query('Session', 'speakers.cacheSpeaker', ancestor=True,
+          equality=['speakerKey']),
+    Query('Session', 'speakers.cacheSpeaker', ancestor=True,
+          equality=['speakerId']),
+    Query('Session', 'migrations.countTermUses', equality=['speakerKey']),
+    Query('Session', 'getSessionsByDate', inequality='startDateTime',
+          orders=['startDateTime']),
+    Query('Session', 'getSessionsByDuration', inequality='duration',
+          orders=['duration', 'startDateTime']),
+    Query('Session', 'filterSessions', equality=['typeOfSession'],
+          inequality='startTime', orders=['startTime']),
+    Query('Session', 'filterSessions', equality=['typeOfSession'],
+          inequality='startDateTime', orders=['startDateTime']),
+    Query('Session', 'sync.syncSchedule', ancestor=True,
+          inequality='modified'),
+    # Session, root layout (settings.ROOT_SESSIONS)
+    Query('Session', 'getConferenceSessions', equality=['conferenceKey'],
+          orders=['startTime']),
+    Query('Session', 'getConferenceSessionsByType',
+          equality=['conferenceKey', 'typeOfSession'], orders=['startTime']),
+    Query('Session', 'speakers.cacheSpeaker',
+          equality=['conferenceKey', 'speakerKey']),
+    Query('Session', 'speakers.cacheSpeaker',
+          equality=['conferenceKey', 'speakerId']),
+    Query('Session', 'sync.syncSchedule', equality=['conferenceKey'],
+          inequality='modified'),
+    # other kinds
+    Query('Speaker', 'getSessionsBySpeaker', equality=['name']),
+    Query('Speaker', 'sessions.createSessionObject', equality=['name']),
+    Query('Speaker', 'migrations.countTermUses', equality=['name']),
+    Query('Registration', 'registrations.getRoster', ancestor=True),
+    Query('Registration', 'registrations.countAttendees', ancestor=True),
+    Query('Profile', 'recommendations.buildRow',
+          equality=['wishlistKeys']),
+    Query('WaitlistEntry', 'waitlist.promoteWaitlist',
+          equality=['conferenceKey'], orders=['joined']),
+    Query('Tombstone', 'sync.syncSchedule', ancestor=True,
+          inequality='deleted'),
+    Query('Tombstone', 'sync.purgeTombstones', inequality='deleted'),
+    Query('AutocompleteTerm', 'autocomplete._buildShard',
+          inequality='__key__'),
+    Query('AutocompleteTerm', 'autocomplete._buildTop',
+          equality=['field'], orders=[('uses', DESC)]),
+    Query('MapperJob', '/admin/mapper', orders=[('created', DESC)]),
+    Query('ProfileSample', 'profiler.mergeSamples', equality=['endpoint'],
+          orders=[('created', DESC)]),
+    Query('ProfileSample', 'profiler.countSamples',
+          projection=['endpoint']),
+    Query('ProfileSample', 'profiler.purgeSamples', inequality='created'),
+]
+QUERIES += getQueryShapes('Conference', 'queryConferences')
+QUERIES += getQueryShapes('Session', 'querySessions')
+
+
+# - - - query call sites - - - - - - - - - - - - - - - - - - - - - - - -
+
+# the calls building or refining a query
+QUERY_METHODS = ('query', 'filter', 'order', 'Query')
+
+# the functions building queries that QUERIES lists under the names of
+# their callers; None for the ones needing no index
+SITE_ALIASES = {
+    'conference.queryProblem': ['filterSessions'],
+    'main.MapperAdminHandler.get': ['/admin/mapper'],
+    # walks every entity of a kind, unfiltered
+    'mapper.runBatch': None,
+    'sessions.getSchedule': ['getConferenceSessions'],
+    'sessions.querySessions': [
+        'getConferenceSessions', 'getConferenceSessionsByType',
+        'speakers.cacheSpeaker', 'sync.syncSchedule',
+        'warmup.primeSchedules'],
+    'sessions.querySpeakerSessions': [
+        'getSessionsBySpeaker', 'speakers.cacheSpeaker'],
+    'sync._deletedSince': ['sync.syncSchedule'],
+    'utils.getQuery': ['queryConferences', 'querySessions'],
+    # the sample 'custom' id_type, never used
+    'utils.getUserId': None,
+}
+
+
+def findQuerySites():
+    """Return the functions of the app modules calling a QUERY_METHODS
+    method, as 'module.function' -> line; the endpoint methods of
+    conference.py are named 'conference.method', the other methods
+    'module.Class.method', and nested functions by the outer one."""
+    sites = {}
+    paths = sorted(glob.glob(os.path.join(APP_DIR, '*.py')) +
+                   glob.glob(os.path.join(APP_DIR, 'process', '*.py')))
+    for path in paths:
+        module = os.path.splitext(os.path.basename(path))[0]
+        with open(path) as f:
+            tree = ast.parse(f.read())
+
+        def visit(node, site, prefix):
+            for child in ast.iter_child_nodes(node):
+                name = site
+                if site is None and isinstance(child, ast.FunctionDef):
+                    name = prefix + child.name
+                elif site is None and isinstance(child, ast.ClassDef):
+                    visit(child, None, prefix if module == 'conference'
+                          else '%s%s.' % (prefix, child.name))
+                    continue
+                if (name and isinstance(child, ast.Call) and
+                        isinstance(child.func, ast.Attribute) and
+                        child.func.attr in QUERY_METHODS):
+                    sites.setdefault(name, child.lineno)
+                visit(child, name, prefix)
+        visit(tree, None, module + '.')
+    return sites
+
+
+def checkQuerySites(queries):
+    """Return the call sites QUERIES doesn't list and the QUERIES names no
+    call site builds."""
+    wheres = set(query.where for query in queries)
+    covered = set()
+    unknown = []
+    for site, line in sorted(findQuerySites().items()):
+        if site in SITE_ALIASES:
+            covered.update(SITE_ALIASES[site] or [])
+            continue
+        # the endpoints are listed by their method name
+        names = [site, site.split('.', 1)[1]]
+        if site.startswith('conference.'):
+            names = names[1:]
+        found = wheres.intersection(names)
+        if found:
+            covered.update(found)
+        else:
+            unknown.append('%s (line %d)' % (site, line))
+    return unknown, sorted(wheres - covered)
+
+
+# - - - index derivation - - - - - - - - - - - - - - - - - - - - - - - -
+
+Index = collections.namedtuple('Index', 'kind ancestor properties')
+
+
+def requiredIndexes(query, merge_join=True):
+    """Return the composite indexes a query needs; none if the built-in
+    single property indexes serve it."""
+    postfix = query.postfix()
+    equality = sorted(set(query.equality))
+    if not postfix:
+        # equality filters only: merge join of the built-in indexes
+        return []
+    if not query.ancestor and not equality and len(postfix) == 1:
+        return []
+    if merge_join and len(equality) > 1:
+        prefixes = [(name,) for name in equality]
+    else:
+        prefixes = [tuple(equality)]
+    return [
+        Index(query.kind, query.ancestor,
+              tuple((name, ASC) for name in prefix) + postfix)
+        for prefix in prefixes
+    ]
+
+
+def deriveIndexes(queries, merge_join=True):
+    """Return a dict of the needed indexes -> queries using them."""
+    indexes = collections.OrderedDict()
+    for query in queries:
+        for index in requiredIndexes(query, merge_join):
+            indexes.setdefault(index, set()).add(query.where)
+    return indexes
+
+
+def parseIndexFile(path):
+    """Parse the indexes of an index.yaml file."""
+    indexes = []
+    current = None
+    with open(path) as f:
+        for line in f:
+            stripped = line.split('#', 1)[0].strip()
+            if stripped.startswith('- kind:'):
+                current = {'kind': stripped.split(':', 1)[1].strip(),
+                           'ancestor': False, 'properties': []}
+                indexes.append(current)
+            elif stripped.startswith('ancestor:') and current:
+                current['ancestor'] = stripped.split(':', 1)[1].strip() in (
+                    'yes', 'true', 'True')
+            elif stripped.startswith('- name:') and current:
+                current['properties'].append(
+                    [stripped.split(':', 1)[1].strip(), ASC])
+            elif stripped.startswith('direction:') and current:
+                direction = stripped.split(':', 1)[1].strip()
+                current['properties'][-1][1] = (
+                    DESC if direction.startswith('desc') else ASC)
+    return [
+        Index(index['kind'], index['ancestor'],
+              tuple(tuple(prop) for prop in index['properties']))
+        for index in indexes
+    ]
+
+
+def formatIndexFile(indexes):
+    lines = [
+        'indexes:',
+        '',
+        '# Derived by tools/index_audit.py from the queries of the app,',
+        '# relying on merge joins for the equality filters. Run it again',
+        '# after adding a query, instead of keeping the indexes the',
+        '# dev_appserver adds below the marker.',
+    ]
+    for index in sorted(indexes):
+        lines.append('')
+        lines.append('- kind: %s' % index.kind)
+        if index.ancestor:
+            lines.append('  ancestor: yes')
+        lines.append('  properties:')
+        for name, direction in index.properties:
+            lines.append('  - name: %s' % name)
+            if direction == DESC:
+                lines.append('    direction: desc')
+    lines += [
+        '',
+        '# AUTOGENERATED',
+        '',
+        '# This index.yaml is automatically updated whenever the dev_appserver',
+        '# detects that a new type of query is run.  If you want to manage the',
+        '# index.yaml file manually, remove the above marker line (the line',
+        '# saying "# AUTOGENERATED").  If you want to manage some indexes',
+        '# manually, move them above the marker line.  The index.yaml file is',
+        '# automatically uploaded to the admin console when you next deploy',
+        '# your application using appcfg.py.',
+        '',
+    ]
+    return '\n'.join(lines)
+
+
+# - - - write cost - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def indexRows(kind, indexes, props, repeated_values):
+    """Return the rows written for a new entity of kind, with every
+    property set and repeated_values values per repeated property: the
+    built-in rows and the rows of the composite indexes of kind."""
+    def values(name):
+        if name not in props:
+            return 0
+        return repeated_values if props[name] else 1
+
+    # the entity, its kind index and ascending plus descending rows
+    builtin = 2 + 2 * sum(values(name) for name in props)
+    composite = 0
+    for index in indexes:
+        if index.kind != kind:
+            continue
+        rows = KEY_DEPTH.get(kind, 1) if index.ancestor else 1
+        for name, _ in index.properties:
+            rows *= values(name)
+        composite += rows
+    return builtin, composite
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def describe(index):
+    return '%s(%s%s)' % (
+        index.kind, 'ancestor, ' if index.ancestor else '',
+        ', '.join(name + (' desc' if direction == DESC else '')
+                  for name, direction in index.properties))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--index-file', default=INDEX_FILE)
+    parser.add_argument('--no-merge-join', action='store_true',
+                        help='one index per exact query shape')
+    parser.add_argument('--repeated', type=int, default=3,
+                        help='values per repeated property in the estimate')
+    parser.add_argument('--write', action='store_true',
+                        help='rewrite the index file with the needed indexes')
+    args = parser.parse_args()
+
+    unknown, stale = checkQuerySites(QUERIES)
+    print('Query call sites missing from QUERIES: %d' % len(unknown))
+    for site in unknown:
+        print('  ' + site)
+    print('QUERIES without a call site: %d' % len(stale))
+    for where in stale:
+        print('  ' + where)
+
+    needed = deriveIndexes(QUERIES, not args.no_merge_join)
+    current = parseIndexFile(args.index_file)
+
+    print('%d query shapes need %d composite indexes' % (
+        len(QUERIES), len(needed)))
+    for index, where in needed.items():
+        print('  %-60s %s' % (describe(index), ', '.join(sorted(where))))
+
+    unused = [index for index in current if index not in needed]
+    missing = [index for index in needed if index not in current]
+    print('Unused indexes in %s: %d' % (
+        os.path.basename(args.index_file), len(unused)))
+    for index in unused:
+        print('  ' + describe(index))
+    print('Missing indexes: %d' % len(missing))
+    for index in missing:
+        print('  ' + describe(index))
+
+    print('utils.getQuery fields missing from the kind (filters '
+          'rejected): %d' % len(UNSATISFIABLE))
+    for (kind, where), fields in sorted(UNSATISFIABLE.items()):
+        print('  %-18s %-16s %s' % (kind, where, ', '.join(fields)))
+
+    kinds = readModelProperties()
+    print('Index rows written per new entity (%d values per repeated '
+          'property), current -> derived:' % args.repeated)
+    for kind in sorted(set(index.kind for index in list(needed) + current)):
+        props = kinds.get(kind, {})
+        builtin, before = indexRows(kind, current, props, args.repeated)
+        _, after = indexRows(kind, needed, props, args.repeated)
+        print('  %-18s built-in %3d   composite %4d -> %4d   total %4d -> %4d'
+              % (kind, builtin, before, after, builtin + before,
+                 builtin + after))
+
+    # indexed properties cost two rows per value even if never queried
+    queried = collections.defaultdict(set)
+    for query in QUERIES:
+        queried[query.kind].update(query.equality)
+        queried[query.kind].update(name for name, _ in query.postfix())
+    print('Indexed properties no query uses (candidates for indexed=False):')
+    for kind in sorted(kinds):
+        idle = sorted(set(kinds[kind]) - queried[kind])
+        if idle:
+            print('  %-18s %s' % (kind, ', '.join(idle)))
+
+    if unknown or stale:
+        sys.exit('QUERIES is out of date with the queries of the app, '
+                 'see above')
+    if args.write:
+        with open(args.index_file, 'w') as f:
+            f.write(formatIndexFile(needed))
+        print('Wrote %s' % args.index_file)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
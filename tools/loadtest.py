@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+
+"""loadtest.py -- simulate registration rushes against the API
+
+Concurrent simulated users run a mix of registrations, wishlist additions,
+schedule reads and session creations, then the harness reports throughput,
+latency percentiles, errors (including transaction collisions) and checks
+that no conference was oversold.
+
+Against the testbed (in-process, datastore and memcache stubs):
+
+    python tools/loadtest.py --sdk /path/to/google_appengine \\
+        --users 200 --ops 20 --seats 100
+
+Against a running dev_appserver, with existing conferences and one OAuth
+bearer token per line in a file:
+
+    python tools/loadtest.py --url http://localhost:8080 \\
+        --tokens tokens.txt --conference <websafeKey> --mix register=100
+
+In testbed mode all the users share one interpreter, so the throughput is
+only comparable between runs of the harness itself.
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib2
+
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_PATH = '/_ah/api/conference/v1/'
+
+DEFAULT_MIX = 'register=60,wishlist=15,read=20,create=5'
+
+
+class Stats(object):
+    """Latencies and outcomes of the operations, shared by the users."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.outcomes = collections.defaultdict(collections.Counter)
+        self.registered = collections.Counter()
+
+    def record(self, op, latency, outcome):
+        with self.lock:
+            self.latencies[op].append(latency)
+            self.outcomes[op][outcome] += 1
+
+    def report(self, elapsed):
+        total = sum(len(lat) for lat in self.latencies.values())
+        print('%d operations in %.1f s: %.1f ops/s' % (
+            total, elapsed, total / elapsed))
+        for op in sorted(self.latencies):
+            lat = sorted(self.latencies[op])
+            pct = lambda p: lat[min(len(lat) - 1, int(len(lat) * p))] * 1000
+            print('  %-9s n=%-6d p50 %7.1f ms  p90 %7.1f ms  p99 %7.1f ms'
+                  '  max %7.1f ms' % (
+                      op, len(lat), pct(0.5), pct(0.9), pct(0.99),
+                      lat[-1] * 1000))
+            print('            %s' % ', '.join(
+                '%s=%d' % item for item in sorted(self.outcomes[op].items())))
+        collisions = sum(
+            outcomes['TransactionFailedError']
+            for outcomes in self.outcomes.values())
+        print('Transaction collisions (after ndb retries): %d' % collisions)
+
+
+def parseMix(mix):
+    ops = []
+    for item in mix.split(','):
+        op, weight = item.split('=')
+        ops.append((op.strip(), int(weight)))
+    return ops
+
+
+def pickOp(ops):
+    choice = random.randint(1, sum(weight for _, weight in ops))
+    for op, weight in ops:
+        choice -= weight
+        if choice <= 0:
+            return op
+
+
+# - - - testbed mode - - - - - - - - - - - - - - - - - - - - - - - - -
+
+class TestbedClient(object):
+    """Calls the ConferenceApi methods in-process on the testbed."""
+
+    def __init__(self, sdk, no_ratelimit):
+        sys.path.insert(0, sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+        sys.path.insert(0, APP_DIR)
+
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+        self.bed = testbed.Testbed()
+        self.bed.activate()
+        # strong consistency, collisions come only from the transactions
+        self.bed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.
+            PseudoRandomHRConsistencyPolicy(probability=1))
+        self.bed.init_memcache_stub()
+        self.bed.init_taskqueue_stub(root_path=APP_DIR)
+        self.bed.init_urlfetch_stub()
+        self.bed.init_mail_stub()
+
+        import endpoints
+        from google.appengine.api import users
+        import conference
+        import ratelimit
+
+        # every simulated user thread acts as its own user
+        self.local = threading.local()
+        endpoints.get_current_user = lambda: users.User(self.local.email)
+        if no_ratelimit:
+            ratelimit.takeToken = lambda method, user_id: True
+        self.module = conference
+        self.api = conference.ConferenceApi()
+
+    def _call(self, email, method, **fields):
+        self.local.email = email
+        func = getattr(self.api, method)
+        return func(func.remote.request_type(**fields))
+
+    def setup(self, conferences, seats, sessions):
+        organizer = 'organizer@example.com'
+        keys = [
+            self._call(organizer, 'createConference',
+                       name='Rush %d' % i, maxAttendees=seats).websafeKey
+            for i in range(conferences)
+        ]
+        session_keys = []
+        for wsck in keys:
+            for j in range(sessions):
+                sess = self._call(organizer, 'createSession',
+                                  websafeConferenceKey=wsck,
+                                  name='Session %d' % j,
+                                  typeOfSession='talk', startTime=900 + j)
+                session_keys.append(sess.websafeKey)
+        return organizer, keys, session_keys
+
+    def register(self, email, wsck):
+        return self._call(email, 'registerForConference',
+                          websafeConferenceKey=wsck).data
+
+    def wishlist(self, email, wssk):
+        self._call(email, 'addSessionToWishlist', websafeSessionKey=wssk)
+
+    def read(self, email, wsck):
+        self._call(email, 'getConferenceSessions', websafeConferenceKey=wsck)
+
+    def create(self, organizer, wsck):
+        self._call(organizer, 'createSession', websafeConferenceKey=wsck,
+                   name='Extra %d' % random.randint(0, 1 << 30),
+                   typeOfSession='workshop', startTime=1400)
+
+    def seatsAvailable(self, wsck):
+        return self._call('organizer@example.com', 'getConference',
+                          websafeConferenceKey=wsck).seatsAvailable
+
+    def checkIndexes(self, keys, seats):
+        """Compare the seats with the Registration index and profiles."""
+        import models
+        import process.profiles
+        from google.appengine.ext import ndb
+        problems = []
+        attending = collections.Counter()
+        for prof in models.Profile.query():
+            prof = process.profiles.upgradeProfile(prof)
+            for c_key in prof.conferencesToAttend:
+                attending[c_key.urlsafe()] += 1
+        for wsck in keys:
+            conf = ndb.Key(urlsafe=wsck).get()
+            regs = models.Registration.query(ancestor=conf.key).count()
+            if regs != seats - conf.seatsAvailable:
+                problems.append('%s: %d registrations for %d taken seats' % (
+                    conf.name, regs, seats - conf.seatsAvailable))
+            if attending[wsck] != regs:
+                problems.append('%s: %d profiles attending, %d registered' % (
+                    conf.name, attending[wsck], regs))
+        return problems
+
+
+# - - - dev_appserver mode - - - - - - - - - - - - - - - - - - - - - - -
+
+class HttpError(Exception):
+    pass
+
+
+class HttpClient(object):
+    """Calls the REST API of a running server, one token per user."""
+
+    def __init__(self, url, tokens_file):
+        self.base = url.rstrip('/') + API_PATH
+        with open(tokens_file) as f:
+            self.tokens = [line.strip() for line in f if line.strip()]
+
+    def _call(self, token, method, path, body=None):
+        req = urllib2.Request(self.base + path,
+                              data=json.dumps(body or {}) if method != 'GET'
+                              else None)
+        req.get_method = lambda: method
+        req.add_header('Content-Type', 'application/json')
+        req.add_header('Authorization', 'Bearer %s' % token)
+        try:
+            return json.loads(urllib2.urlopen(req).read() or '{}')
+        except urllib2.HTTPError as e:
+            raise HttpError('HTTP %d' % e.code)
+
+    def register(self, token, wsck):
+        return self._call(token, 'POST', 'conference/%s' % wsck).get('data')
+
+    def wishlist(self, token, wssk):
+        self._call(token, 'POST', 'addSessionToWishlist/%s' % wssk)
+
+    def read(self, token, wsck):
+        self._call(token, 'GET', 'conference/%s/sessions' % wsck)
+
+    def create(self, token, wsck):
+        self._call(token, 'POST', 'conference/%s/createSession' % wsck, {
+            'name': 'Extra %d' % random.randint(0, 1 << 30),
+            'typeOfSession': 'workshop', 'startTime': 1400})
+
+    def sessionKeys(self, wsck):
+        data = self._call(self.tokens[0], 'GET', 'conference/%s/sessions' % wsck)
+        return [item['websafeKey'] for item in data.get('items', [])]
+
+    def seatsAvailable(self, wsck):
+        data = self._call(self.tokens[0], 'GET', 'conference/%s' % wsck)
+        return int(data.get('seatsAvailable', 0))
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def runUser(client, stats, user, organizer, ops, count, keys, session_keys):
+    for _ in range(count):
+        op = pickOp(ops)
+        wsck = random.choice(keys)
+        start = time.time()
+        outcome = 'ok'
+        try:
+            if op == 'register':
+                if client.register(user, wsck):
+                    with stats.lock:
+                        stats.registered[wsck] += 1
+            elif op == 'wishlist':
+                if session_keys:
+                    client.wishlist(user, random.choice(session_keys))
+            elif op == 'read':
+                client.read(user, wsck)
+            elif op == 'create':
+                client.create(organizer, wsck)
+        except Exception as e:
+            outcome = type(e).__name__
+            if isinstance(e, HttpError):
+                outcome = str(e)
+        stats.record(op, time.time() - start, outcome)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sdk', help='SDK path, runs on the testbed')
+    parser.add_argument('--url', help='server URL, runs over HTTP')
+    parser.add_argument('--tokens', help='bearer tokens file (HTTP mode)')
+    parser.add_argument('--conference', action='append', default=[],
+                        help='websafe key of a conference (HTTP mode)')
+    parser.add_argument('--organizer-token',
+                        help='token of the organizer (HTTP mode)')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--ops', type=int, default=10,
+                        help='operations per user')
+    parser.add_argument('--conferences', type=int, default=1)
+    parser.add_argument('--seats', type=int, default=50)
+    parser.add_argument('--sessions', type=int, default=10)
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--no-ratelimit', action='store_true',
+                        help='disable the rate limits (testbed mode)')
+    args = parser.parse_args()
+
+    if args.sdk:
+        client = TestbedClient(args.sdk, args.no_ratelimit)
+        organizer, keys, session_keys = client.setup(
+            args.conferences, args.seats, args.sessions)
+        users = ['user%d@example.com' % i for i in range(args.users)]
+    elif args.url and args.tokens and args.conference:
+        client = HttpClient(args.url, args.tokens)
+        keys = args.conference
+        session_keys = sum((client.sessionKeys(k) for k in keys), [])
+        organizer = args.organizer_token
+        users = [client.tokens[i % len(client.tokens)]
+                 for i in range(args.users)]
+    else:
+        parser.error('use --sdk, or --url with --tokens and --conference')
+
+    initial = dict((wsck, client.seatsAvailable(wsck)) for wsck in keys)
+    ops = parseMix(args.mix)
+    stats = Stats()
+    threads = [
+        threading.Thread(target=runUser, args=(
+            client, stats, user, organizer, ops, args.ops, keys,
+            session_keys))
+        for user in users
+    ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats.report(time.time() - start)
+
+    # no seat may be sold twice or below zero
+    problems = []
+    for wsck in keys:
+        seats = client.seatsAvailable(wsck)
+        if seats < 0:
+            problems.append('%s: %d seats available' % (wsck, seats))
+        if initial[wsck] - seats != stats.registered[wsck]:
+            problems.append('%s: %d seats taken, %d registrations' % (
+                wsck, initial[wsck] - seats, stats.registered[wsck]))
+    if args.sdk:
+        problems.extend(client.checkIndexes(keys, args.seats))
+    print('Oversell check: %s' % ('OK' if not problems else 'FAILED'))
+    for problem in problems:
+        print('  ' + problem)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""startup_time.py -- measure the import time of the app modules
+
+Every measure runs on a fresh interpreter, like a new App Engine instance.
+The modules imported on demand are measured too, which is the time saved
+on startup by not importing them eagerly. Run it from the app directory:
+
+    python tools/startup_time.py --sdk /path/to/google_appengine
+
+Compare the output of two revisions to see the cold start improvement.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# imported by the scripts in app.yaml on a new instance
+STARTUP_MODULES = ['main', 'conference']
+# imported by the handlers and endpoints only when they are used
+DEFERRED_MODULES = [
+    'process.recommendations',
+    'google.appengine.api.mail',
+]
+
+MEASURE_TPL = """
+import sys
+sys.path.insert(0, %(sdk)r)
+import dev_appserver
+dev_appserver.fix_sys_path()
+sys.path.insert(0, %(app)r)
+import time
+start = time.time()
+import %(module)s
+print(time.time() - start)
+"""
+
+
+def measure(module, sdk, runs):
+    """Return the import times of a module in fresh interpreters."""
+    times = []
+    for _ in range(runs):
+        code = MEASURE_TPL % {'sdk': sdk, 'app': APP_DIR, 'module': module}
+        out = subprocess.check_output([sys.executable, '-c', code])
+        times.append(float(out.strip().splitlines()[-1]))
+    return sorted(times)
+
+
+def report(modules, sdk, runs):
+    for module in modules:
+        times = measure(module, sdk, runs)
+        print('  %-28s min %7.1f ms   median %7.1f ms' % (
+            module, times[0] * 1000, times[len(times) // 2] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sdk', required=True,
+                        help='path of the App Engine Python SDK')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='fresh interpreters per module')
+    args = parser.parse_args()
+
+    print('Startup imports:')
+    report(STARTUP_MODULES, args.sdk, args.runs)
+    print('Deferred imports (saved on startup):')
+    report(DEFERRED_MODULES, args.sdk, args.runs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+"""write_benchmark.py -- compare the tasklet write paths of conference and
+session creation with the old sequential ones
+
+Creates conferences and sessions with both implementations on the App
+Engine testbed, counting their RPCs. The stubs answer at once, so the
+latency is simulated: every RPC takes --latency ms (memcache calls
+--memcache-latency ms) from the moment it is made, and RPCs in flight at
+the same time overlap like they do in production. Run it from the app
+directory:
+
+    python tools/write_benchmark.py --sdk /path/to/google_appengine
+"""
+
+import argparse
+import os
+import sys
+import time
+
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ORGANIZER = 'organizer@example.com'
+
+
+def setupSdk(sdk):
+    """Put the SDK and the app on the path and activate the testbed."""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=APP_DIR)
+
+    import endpoints
+    from google.appengine.api import users
+    endpoints.get_current_user = lambda: users.User(ORGANIZER)
+    return bed
+
+
+class RpcClock(object):
+    """Simulated time of the RPCs. An RPC ends its latency after the time
+    it was made at; waiting for it moves the clock to its end."""
+
+    def __init__(self, latency, memcache_latency):
+        self.latency = latency
+        self.memcache_latency = memcache_latency
+        self.now = 0.0
+        self.calls = 0
+        self.started = {}
+
+    def install(self):
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'rpc_clock', self.pre)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'rpc_clock', self.post)
+
+    def pre(self, service, call, request, response):
+        self.started[id(request)] = self.now
+        self.calls += 1
+
+    def post(self, service, call, request, response):
+        start = self.started.pop(id(request), self.now)
+        latency = self.latency
+        if service == 'memcache':
+            latency = self.memcache_latency
+        self.now = max(self.now, start + latency)
+
+    def measure(self, func):
+        """Run func, returning its simulated milliseconds and RPCs."""
+        self.now = 0.0
+        self.calls = 0
+        func()
+        return self.now, self.calls
+
+
+# - - - write paths before the tasklets - - - - - - - - - - - - - - - -
+
+def legacyCreateConference(request):
+    import endpoints
+    from google.appengine.api import taskqueue
+    from google.appengine.ext import ndb
+    import models
+    import process.autocomplete
+    import utils
+
+    user = endpoints.get_current_user()
+    user_id = utils.getUserId(user)
+    p_key = ndb.Key(models.Profile, user_id)
+    c_id = models.Conference.allocate_ids(size=1, parent=p_key)[0]
+    c_key = ndb.Key(models.Conference, c_id, parent=p_key)
+    models.Conference(key=c_key, name=request.name, city=request.city,
+                      topics=request.topics, organizerUserId=user_id,
+                      version=1).put()
+    process.autocomplete.queueUpdate(
+        process.autocomplete.CITY, added=[request.city])
+    process.autocomplete.queueUpdate(
+        process.autocomplete.TOPIC, added=request.topics)
+    taskqueue.add(params={'email': user.email(),
+        'conferenceInfo': repr(request)},
+        url='/tasks/send_confirmation_email'
+    )
+    return request
+
+
+def legacyCreateSession(request):
+    import endpoints
+    from google.appengine.api import taskqueue
+    from google.appengine.ext import ndb
+    import models
+    import process.autocomplete
+    import process.conferences
+    import process.sessions
+    import process.stats
+    import utils
+
+    user_id = utils.getUserId(endpoints.get_current_user())
+    conf = process.sessions.getConference(
+        ndb.Key(urlsafe=request.websafeConferenceKey))
+    assert conf and conf.organizerUserId == user_id
+
+    sp_key = None
+    if request.speaker:
+        speaker = models.Speaker.query(
+            models.Speaker.name == request.speaker).get()
+        if speaker:
+            sp_key = speaker.key
+        else:
+            sp_key = ndb.Key(models.Speaker,
+                             models.Speaker.allocate_ids(size=1)[0])
+            models.Speaker(key=sp_key, name=request.speaker).put()
+            process.autocomplete.queueUpdate(
+                process.autocomplete.SPEAKER, added=[request.speaker])
+
+    c_key = conf.key
+    s_id = models.Session.allocate_ids(size=1, parent=c_key)[0]
+    s_key = ndb.Key(models.Session, s_id, parent=c_key)
+
+    def save():
+        conf = c_key.get()
+        process.conferences.touch(conf)
+        ndb.put_multi([models.Session(
+            key=s_key, name=request.name, typeOfSession=request.typeOfSession,
+            startTime=request.startTime, speakerKey=sp_key), conf])
+        process.stats.addSession(c_key, request.typeOfSession, sp_key)
+    ndb.transaction(save)
+    if sp_key:
+        taskqueue.add(params={
+                'conferenceKey': c_key.urlsafe(),
+                'speakerKey': sp_key.urlsafe()
+            },
+            url='/tasks/set_featured_speaker'
+        )
+    return process.sessions.copySessionToForm(s_key.get())
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sdk', required=True,
+                        help='path of the App Engine Python SDK')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='creations per case and implementation')
+    parser.add_argument('--latency', type=float, default=20,
+                        help='simulated ms of a datastore or task queue RPC')
+    parser.add_argument('--memcache-latency', type=float, default=1,
+                        help='simulated ms of a memcache RPC')
+    args = parser.parse_args()
+
+    bed = setupSdk(args.sdk)
+    from google.appengine.ext import ndb
+    import conference
+    import models
+    import process.conferences
+    import process.sessions
+
+    SessionRequest = conference.SESSION_POST_REQUEST.combined_message_class
+    wsck = process.conferences.createConferenceObject(models.ConferenceForm(
+        name='Bench', city='London', topics=['Web'])).websafeKey
+    # warm the conference cache, both versions read it
+    process.sessions.getConference(ndb.Key(urlsafe=wsck))
+    models.Speaker(name='Known Speaker').put()
+
+    def conferenceRequest(i):
+        return models.ConferenceForm(
+            name='Conference %d' % i, city='City %d' % i,
+            topics=['Topic %d' % i])
+
+    def sessionRequest(i, speaker):
+        return SessionRequest(
+            websafeConferenceKey=wsck, name='Session %d' % i,
+            typeOfSession='talk', startTime=900, speaker=speaker)
+
+    cases = [
+        ('Conference',
+         lambda i: legacyCreateConference(conferenceRequest(i)),
+         lambda i: process.conferences.createConferenceObject(
+             conferenceRequest(i))),
+        ('Session, new speaker',
+         lambda i: legacyCreateSession(
+             sessionRequest(i, 'Legacy Speaker %d' % i)),
+         lambda i: process.sessions.createSessionObject(
+             sessionRequest(i, 'Speaker %d' % i))),
+        ('Session, known speaker',
+         lambda i: legacyCreateSession(sessionRequest(i, 'Known Speaker')),
+         lambda i: process.sessions.createSessionObject(
+             sessionRequest(i, 'Known Speaker'))),
+        ('Session, no speaker',
+         lambda i: legacyCreateSession(sessionRequest(i, None)),
+         lambda i: process.sessions.createSessionObject(
+             sessionRequest(i, None))),
+    ]
+
+    clock = RpcClock(args.latency, args.memcache_latency)
+    clock.install()
+    print('%d creations per case, %.0f ms per RPC (memcache %.0f ms)' % (
+        args.runs, args.latency, args.memcache_latency))
+    for name, legacy, tasklets in cases:
+        results = []
+        for func in (legacy, tasklets):
+            simulated = calls = 0
+            start = time.time()
+            for i in range(args.runs):
+                ms, n = clock.measure(lambda: func(i))
+                simulated += ms
+                calls += n
+            results.append((simulated / args.runs, float(calls) / args.runs,
+                            (time.time() - start) * 1000 / args.runs))
+        (old, old_calls, old_wall), (new, new_calls, new_wall) = results
+        print('  %-22s legacy %6.1f ms %4.1f RPCs   tasklets %6.1f ms '
+              '%4.1f RPCs   -%4.1f%%   (testbed %.1f / %.1f ms)' % (
+                  name, old, old_calls, new, new_calls,
+                  100 * (old - new) / old, old_wall, new_wall))
+
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,15 @@
+import hashlib
 import json
 import os
 import time
 import uuid
 
 import endpoints
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+
+import cache
 from models import Profile
 
 
@@ -25,6 +30,24 @@ FIELDS = {
 }
 
 
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
+TOKENINFO_DEADLINE = 5
+TOKENINFO_ATTEMPTS = 3
+# seconds between tokeninfo attempts, doubled up to the max
+TOKENINFO_BACKOFF = 0.1
+TOKENINFO_MAX_BACKOFF = 0.4
+
+TOKEN_CACHE_PREFIX = 'OAUTH_TOKEN:'
+TOKEN_CACHE_SIZE = 1000
+TOKEN_CACHE_TTL = 3600
+# the instance cache is short lived, it doesn't know the token expiration
+# when the user id comes from memcache
+TOKEN_LOCAL_TTL = 60
+
+
+_token_cache = cache.LRUCache(TOKEN_CACHE_SIZE)
+
+
 def getUserId(user, id_type="email"):
     if id_type == "email":
         return user.email()
@@ -33,25 +56,7 @@ def getUserId(user, id_type="email"):
         """A workaround implementation for getting userid."""
         auth = os.getenv('HTTP_AUTHORIZATION')
         bearer, token = auth.split()
-        token_type = 'id_token'
-        if 'OAUTH_USER_ID' in os.environ:
-            token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return getOAuthUserId(token)
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm
@@ -64,10 +69,124 @@ def getUserId(user, id_type="email"):
             return str(uuid.uuid1().get_hex())
 
 
+def getOAuthUserId(token):
+    """Return the user id of an OAuth token, cached by token so repeated
+    requests with the same token don't call the tokeninfo endpoint.
+    """
+    # tokens are secrets and can be longer than a memcache key
+    cache_key = TOKEN_CACHE_PREFIX + hashlib.sha256(token).hexdigest()
+    user_id = _token_cache.get(cache_key)
+    if user_id:
+        return user_id
+
+    user_id = memcache.get(cache_key)
+    if user_id:
+        _token_cache.set(cache_key, user_id, TOKEN_LOCAL_TTL)
+        return user_id
+
+    user = _fetchTokenInfo(token)
+    user_id = user.get('user_id', '')
+    if user_id:
+        # never keep the id for longer than the token is valid
+        ttl = min(int(user.get('expires_in', TOKEN_CACHE_TTL)),
+                  TOKEN_CACHE_TTL)
+        if ttl > 0:
+            memcache.set(cache_key, user_id, time=ttl)
+            _token_cache.set(cache_key, user_id, min(ttl, TOKEN_LOCAL_TTL))
+    return user_id
+
+
+def _fetchTokenInfo(token):
+    """Return the tokeninfo of a token, or an empty dict if it is invalid.
+
+    The token is tried as an id token and an access token with concurrent
+    fetches. Only server errors are retried, with a short bounded backoff.
+    """
+    token_types = ['id_token', 'access_token']
+    if 'OAUTH_USER_ID' in os.environ:
+        token_types = ['access_token']
+
+    wait = TOKENINFO_BACKOFF
+    for attempt in range(TOKENINFO_ATTEMPTS):
+        rpcs = []
+        for token_type in token_types:
+            rpc = urlfetch.create_rpc(deadline=TOKENINFO_DEADLINE)
+            urlfetch.make_fetch_call(rpc, TOKENINFO_URL % (token_type, token))
+            rpcs.append(rpc)
+
+        retry = False
+        for rpc in rpcs:
+            try:
+                resp = rpc.get_result()
+            except urlfetch.Error:
+                retry = True
+                continue
+            if resp.status_code == 200:
+                return json.loads(resp.content)
+            if resp.status_code >= 500:
+                retry = True
+
+        # the token was rejected, trying again won't help
+        if not retry or attempt == TOKENINFO_ATTEMPTS - 1:
+            break
+        time.sleep(wait)
+        wait = min(wait * 2, TOKENINFO_MAX_BACKOFF)
+    return {}
+
+
+def keysFromWebsafe(websafeKeys, kind):
+    """Return the keys of websafe keys, with None for the malformed ones
+    and the ones of another kind."""
+    keys = []
+    for websafeKey in websafeKeys:
+        try:
+            key = ndb.Key(urlsafe=websafeKey)
+        except Exception:
+            # malformed keys raise assorted protocol buffer errors
+            key = None
+        keys.append(key if key and key.kind() == kind else None)
+    return keys
+
+
+def getMultiByKeys(keys):
+    """Return a dict of the entities of keys, skipping the None keys,
+    fetched with a single get_multi."""
+    unique = list(set(key for key in keys if key))
+    return dict(zip(unique, ndb.get_multi(unique)))
+
+
+def compileFormPlan(model, form, converters=None):
+    """Return the plan copying an ndb model to a ProtoRPC form: the
+    (field name, converter) pairs of the form fields that are properties
+    of the model. Computed once, instead of inspecting every field of the
+    form for every entity.
+    """
+    converters = converters or {}
+    return tuple(
+        (field.name, converters.get(field.name))
+        for field in form.all_fields() if field.name in model._properties
+    )
+
+
+def copyToForm(entity, form, plan):
+    """Copy the properties of entity to form following a compiled plan."""
+    for name, convert in plan:
+        value = getattr(entity, name)
+        if convert is not None:
+            value = convert(value)
+        setattr(form, name, value)
+    return form
+
+
 def getQuery(request, model):
     """Return formatted query from the submitted filters."""
     q = model.query()
     inequality_filter, filters = formatFilters(request.filters)
+    for filtr in filters:
+        if filtr["field"] not in model._properties:
+            raise endpoints.BadRequestException(
+                "Filter field %s is not a %s property." % (
+                    filtr["field"], model.__name__))
 
     # If exists, sort on inequality filter first
     if not inequality_filter: